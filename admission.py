@@ -0,0 +1,56 @@
+import asyncio
+import collections
+
+#seconds a client turned away is asked to wait before it tries again
+BUSY_RETRY_AFTER = 2
+#seconds a connection turned away on accept is kept open so the client can read the reply
+BUSY_CLOSE_GRACE = 1
+#seconds a transfer waits in the queue for a slot before it is turned away after all
+SLOT_WAIT_TIMEOUT = 30
+
+
+class TransferSlots:
+    #at most limit transfers run at once and up to queue_size more wait for a slot in arrival order,
+    #anything past that is turned away so a storm of requests cannot pile up without bound;
+    #limit 0 means unlimited. only used on the event loop
+    def __init__(self, limit, queue_size):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.active = 0
+        self.waiting = collections.deque()  #futures of requests waiting for a slot
+
+    async def acquire(self, wait=True, timeout=SLOT_WAIT_TIMEOUT):
+        #returns False when the server is saturated; without wait only a slot that is free right away
+        #is taken, and a queued request gives up after timeout seconds
+        if not self.limit or (self.active < self.limit and not self.waiting):
+            self.active += 1
+            return True
+        if not wait or len(self.waiting) >= self.queue_size:
+            return False
+        slot = asyncio.get_running_loop().create_future()
+        self.waiting.append(slot)
+        try:
+            await asyncio.wait_for(slot, timeout)
+        except asyncio.TimeoutError:
+            self.give_up(slot)
+            return False
+        except asyncio.CancelledError:
+            self.give_up(slot)
+            raise
+        return True
+
+    def give_up(self, slot):
+        #a slot handed over just before the waiter gave up goes to the next one
+        if not slot.cancelled():
+            self.release()
+        elif slot in self.waiting:
+            self.waiting.remove(slot)
+
+    def release(self):
+        #the slot passes straight to the longest waiting request, cancelled waiters are skipped
+        while self.waiting:
+            slot = self.waiting.popleft()
+            if not slot.done():
+                slot.set_result(None)
+                return
+        self.active -= 1
@@ -0,0 +1,77 @@
+import asyncio
+import collections
+import time
+
+#transfers are paced in slices of this size, small enough that the turns of different clients interleave finely
+SHAPING_SLICE = 256 * 1024
+
+
+class TokenBucket:
+    #rate bytes per second with bursts of up to one second. bytes are taken right away and the bucket
+    #goes into debt, the caller waits until it is paid off; that way requests larger than the burst
+    #still go through and concurrent callers are spaced out one after the other
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.stamp = time.monotonic()
+
+    def take(self, size):
+        #returns the seconds to wait before sending size bytes
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.stamp) * self.rate) - size
+        self.stamp = now
+        return max(0.0, -self.tokens / self.rate)
+
+
+class Shaper:
+    #bandwidth of one direction, limited per client and over all clients (0 means unlimited). the
+    #global budget is handed out round robin between clients, one slice per turn, so a client with a
+    #small request waits for one slice of each busy client instead of behind their whole transfers.
+    #only used on the event loop
+    def __init__(self, client_rate=0, global_rate=0):
+        self.client_rate = client_rate
+        self.buckets = {}  #client -> TokenBucket
+        self.bucket = TokenBucket(global_rate) if global_rate else None
+        self.waiting = collections.OrderedDict()  #client -> queue of futures, in turn order
+        self.dispatcher = None
+
+    def __bool__(self):
+        return bool(self.client_rate or self.bucket)
+
+    async def wait(self, client, size):
+        #returns once client may move size more bytes
+        if self.client_rate:
+            bucket = self.buckets.get(client)
+            if bucket is None:
+                bucket = self.buckets[client] = TokenBucket(self.client_rate)
+            delay = bucket.take(size)
+            if delay:
+                await asyncio.sleep(delay)
+        if self.bucket:
+            loop = asyncio.get_running_loop()
+            turn = loop.create_future()
+            self.waiting.setdefault(client, collections.deque()).append((turn, size))
+            if self.dispatcher is None or self.dispatcher.done():
+                self.dispatcher = loop.create_task(self.dispatch())
+            await turn
+
+    async def dispatch(self):
+        while self.waiting:
+            #the first client in line gets one turn and goes to the back if it has more waiting
+            client, turns = next(iter(self.waiting.items()))
+            turn, size = turns.popleft()
+            if turns:
+                self.waiting.move_to_end(client)
+            else:
+                del self.waiting[client]
+            #a waiter whose transfer was cancelled is skipped without using the budget
+            if turn.done():
+                continue
+            delay = self.bucket.take(size)
+            if delay:
+                await asyncio.sleep(delay)
+            if not turn.done():
+                turn.set_result(None)
+
+    def forget(self, client):
+        self.buckets.pop(client, None)
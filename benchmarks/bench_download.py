@@ -0,0 +1,142 @@
+import argparse
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from catalog import FileRecord
+from server import Server, file_digest
+from protocol import HEADER_SIZE, HELLO, REQUEST, RESPONSE, DATA, END, FramedSocket, recv_exact, unpack_header
+
+
+class QuietServer(Server):
+    #no gui and no log file while measuring
+    def log_message(self, message):
+        pass
+
+
+def download(port, filename, owner, buffer):
+    sock = socket.create_connection(("127.0.0.1", port))
+    connection = FramedSocket(sock)
+    connection.send_frame(HELLO, 0, b"bench")
+    frame_type, _, _ = connection.recv_frame()
+    assert frame_type == RESPONSE
+    connection.send_message(REQUEST, 1, command="DOWNLOAD", filename=filename, owner=owner)
+
+    #payloads are read into one reusable buffer so the client is not the bottleneck
+    view = memoryview(buffer)
+    received = 0
+    while True:
+        frame_type, _, length = unpack_header(recv_exact(sock, HEADER_SIZE))
+        if frame_type == END:
+            break
+        if frame_type != DATA:
+            #notifications and replies are skipped
+            if length:
+                recv_exact(sock, length)
+            continue
+        while length:
+            count = sock.recv_into(view, min(length, len(buffer)))
+            if count == 0:
+                raise ConnectionError("Server closed the connection.")
+            length -= count
+            received += count
+    sock.close()
+    return received
+
+
+def serve_baseline(listener, path):
+    #the download loop the server started with: a thread per client reading 4096 bytes at a time and
+    #sending each block with sendall, the bytes go out without frames as in the original protocol
+    while True:
+        try:
+            client_socket, _ = listener.accept()
+        except OSError:
+            return
+        with client_socket, open(path, "rb") as f:
+            while True:
+                chunk = f.read(4096)
+                if not chunk:
+                    break
+                client_socket.sendall(chunk)
+
+
+def download_baseline(port, size, buffer):
+    sock = socket.create_connection(("127.0.0.1", port))
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view, min(size - received, len(buffer)))
+        if count == 0:
+            raise ConnectionError("Server closed the connection.")
+        received += count
+    sock.close()
+    return received
+
+
+def measure(name, size_mb, rounds, download_once):
+    download_once()  #warm the page cache
+    start = time.perf_counter()
+    for _ in range(rounds):
+        assert download_once() == size_mb * 1024 * 1024
+    rate = size_mb * rounds / (time.perf_counter() - start)
+    print(f"{name:>14}: {rate:8.1f} MB/s")
+    return rate
+
+
+def run(size_mb, rounds):
+    directory = tempfile.mkdtemp(prefix="bench_download_")
+    payload_path = os.path.join(directory, "payload.bin")
+    with open(payload_path, "wb") as f:
+        block = os.urandom(1024 * 1024)
+        for _ in range(size_mb):
+            f.write(block)
+
+    server = QuietServer()
+    server.file_directory = directory
+    server.load_file_list()
+    record = FileRecord("payload.bin", "owner", size_mb * 1024 * 1024, time.time(), file_digest(payload_path))
+    server.add_to_file_list(record, payload_path)
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    server.start_server(port)
+    time.sleep(0.2)
+
+    buffer = bytearray(4 * 1024 * 1024)
+    results = {}
+    #the loop sendfile replaced, served from the same stored blob
+    listener = socket.create_server(("127.0.0.1", 0))
+    threading.Thread(target=serve_baseline, args=(listener, server.blobs.path(record.digest)), daemon=True).start()
+    baseline_port = listener.getsockname()[1]
+    results['baseline'] = measure("baseline 4 KiB", size_mb, rounds,
+                                  lambda: download_baseline(baseline_port, size_mb * 1024 * 1024, buffer))
+    listener.close()
+
+    modes = [("chunked loop", False)]
+    if hasattr(os, "sendfile"):
+        modes.append(("sendfile", True))
+    for name, use_sendfile in modes:
+        server.use_sendfile = use_sendfile
+        results[name] = measure(name, size_mb, rounds, lambda: download(port, "payload.bin", "owner", buffer))
+
+    best = 'sendfile' if 'sendfile' in results else 'chunked loop'
+    print(f"{'speedup':>14}: {results[best] / results['baseline']:8.2f}x over the baseline loop, "
+          f"{results[best] / results['chunked loop']:.2f}x over the chunked loop")
+    server.stop_server()
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare download throughput of sendfile, the chunked read loop and "
+                                                 "the original 4 KiB sendall loop.")
+    parser.add_argument("--size-mb", type=int, default=256, help="size of the downloaded file")
+    parser.add_argument("--rounds", type=int, default=5, help="downloads per mode")
+    args = parser.parse_args()
+    run(args.size_mb, args.rounds)
@@ -0,0 +1,446 @@
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shlex
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from protocol import (
+    HEADER_SIZE, HELLO, REQUEST, RESPONSE, ERROR, DATA, END, NOTIFICATION, EVENT,
+    FramedSocket, decode_message, recv_exact, unpack_header,
+)
+
+#weights of the operations each simulated client picks from, and of the sizes its uploads have
+DEFAULT_MIX = "upload=1,download=4,list=1,delete=1"
+DEFAULT_SIZES = "4K=70,64K=20,1M=9,16M=1"
+OPERATIONS = ("upload", "download", "list", "delete")
+SIZE_UNITS = {"": 1, "K": 1024, "M": 1024 * 1024, "G": 1024 * 1024 * 1024}
+UPLOAD_FRAME_SIZE = 1024 * 1024
+RECEIVE_BUFFER_SIZE = 4 * 1024 * 1024
+#a change is reported as a regression when it is worse than the baseline by more than the tolerance;
+#latencies below the floor are too noisy to compare
+LATENCY_FLOOR_MS = 1.0
+MAX_ERROR_SAMPLES = 10
+
+
+def parse_size(text):
+    text = text.strip().upper().rstrip("B")
+    unit = text[-1] if text and text[-1] in SIZE_UNITS else ""
+    return int(float(text[:len(text) - len(unit)]) * SIZE_UNITS[unit])
+
+
+def parse_weights(text, parse_key):
+    #"a=3,b=1" -> [(a, 3.0), (b, 1.0)]
+    weights = []
+    for item in text.split(","):
+        key, _, weight = item.partition("=")
+        weights.append((parse_key(key.strip()), float(weight or 1)))
+    if not weights or sum(weight for _, weight in weights) <= 0:
+        raise ValueError(f"No positive weights in '{text}'.")
+    return weights
+
+
+def parse_operation(name):
+    if name not in OPERATIONS:
+        raise ValueError(f"Unknown operation '{name}', expected one of {', '.join(OPERATIONS)}.")
+    return name
+
+
+class BenchClient:
+    #one simulated client on a connection of its own, speaking the protocol directly so the
+    #measurement is not limited by the gui client
+    def __init__(self, port, name, payload):
+        self.name = name
+        self.payload = payload  #random bytes uploads are cut from, each upload gets a unique prefix
+        self.sock = socket.create_connection(("127.0.0.1", port), timeout=120)
+        self.connection = FramedSocket(self.sock)
+        self.buffer = bytearray(RECEIVE_BUFFER_SIZE)
+        self.request_ids = itertools.count(1)
+        self.files = []  #(filename, size) uploaded by this client and not deleted
+        self.uploads = itertools.count(1)
+        self.connection.send_frame(HELLO, 0, name.encode())
+        frame_type, payload = self.reply(0)
+        if frame_type != RESPONSE:
+            raise ConnectionError(decode_message(payload).get("message", "Login refused."))
+
+    def reply(self, request_id):
+        #the next control frame of the request as (frame type, payload), notifications are skipped
+        while True:
+            frame = self.connection.recv_frame()
+            if frame is None:
+                raise ConnectionError("Server closed the connection.")
+            frame_type, reply_id, payload = frame
+            if frame_type in (NOTIFICATION, EVENT) or reply_id != request_id:
+                continue
+            if frame_type == ERROR:
+                raise RuntimeError(decode_message(payload).get("message", "Error reply."))
+            return frame_type, payload
+
+    def upload(self, size):
+        request_id = next(self.request_ids)
+        filename = f"{self.name}_{next(self.uploads)}.bin"
+        self.connection.send_message(REQUEST, request_id, command="UPLOAD", filename=filename, size=size)
+        #without a unique prefix every upload would be deduplicated into the same blob
+        prefix = os.urandom(min(16, size))
+        self.connection.send_frame(DATA, request_id, prefix)
+        view = memoryview(self.payload)
+        sent = len(prefix)
+        while sent < size:
+            count = min(UPLOAD_FRAME_SIZE, size - sent)
+            self.connection.send_frame(DATA, request_id, view[sent:sent + count])
+            sent += count
+        self.connection.send_frame(END, request_id)
+        self.expect(request_id, RESPONSE)
+        self.files.append((filename, size))
+        return size
+
+    def download(self, filename, size):
+        request_id = next(self.request_ids)
+        self.connection.send_message(REQUEST, request_id, command="DOWNLOAD", filename=filename, owner=self.name)
+        self.expect(request_id, RESPONSE)
+        received = self.read_data(request_id)
+        if received != size:
+            raise RuntimeError(f"Downloaded {received} bytes of '{filename}' instead of {size}.")
+        return received
+
+    def list_files(self):
+        request_id = next(self.request_ids)
+        self.connection.send_message(REQUEST, request_id, command="LIST", owner=self.name, page_size=100)
+        self.expect(request_id, RESPONSE)
+        self.read_data(request_id)
+        return 0
+
+    def delete(self, filename):
+        request_id = next(self.request_ids)
+        self.connection.send_message(REQUEST, request_id, command="DELETE", filename=filename)
+        self.expect(request_id, RESPONSE)
+        return 0
+
+    def stats(self):
+        request_id = next(self.request_ids)
+        self.connection.send_message(REQUEST, request_id, command="STATS")
+        _, payload = self.expect(request_id, RESPONSE)
+        return decode_message(payload).get("stats")
+
+    def expect(self, request_id, expected):
+        frame_type, payload = self.reply(request_id)
+        if frame_type != expected:
+            raise RuntimeError(f"Unexpected frame type {frame_type}.")
+        return frame_type, payload
+
+    def read_data(self, request_id):
+        #counts the data bytes of the request up to its END frame
+        received = 0
+        while True:
+            header = recv_exact(self.sock, HEADER_SIZE)
+            if header is None:
+                raise ConnectionError("Server closed the connection.")
+            frame_type, reply_id, length = unpack_header(header)
+            if frame_type == END and reply_id == request_id:
+                return received
+            if frame_type == ERROR and reply_id == request_id:
+                raise RuntimeError(decode_message(recv_exact(self.sock, length)).get("message", "Error reply."))
+            if frame_type == DATA and reply_id == request_id:
+                received += length
+            view = memoryview(self.buffer)
+            while length:
+                count = self.sock.recv_into(view, min(length, len(self.buffer)))
+                if count == 0:
+                    raise ConnectionError("Server closed the connection.")
+                length -= count
+
+    def run_operation(self, operation, sizes, weights):
+        #returns the bytes moved; downloads and deletes need a file, the client uploads one first
+        if operation in ("download", "delete") and not self.files:
+            self.upload(random.choices(sizes, weights)[0])
+        if operation == "upload":
+            return self.upload(random.choices(sizes, weights)[0])
+        if operation == "download":
+            return self.download(*random.choice(self.files))
+        if operation == "list":
+            return self.list_files()
+        filename, _ = self.files.pop(random.randrange(len(self.files)))
+        return self.delete(filename)
+
+    def close(self):
+        try:
+            self.connection.send_message(REQUEST, 0, command="DISCONNECT")
+        except OSError:
+            pass
+        self.connection.close()
+
+
+def run_worker(port, names, settings, start_at, results):
+    #one process of simulated clients, each on a thread; samples are sent back in one piece
+    mix = settings['mix']
+    operations = [operation for operation, _ in mix]
+    operation_weights = [weight for _, weight in mix]
+    sizes = [size for size, _ in settings['sizes']]
+    size_weights = [weight for _, weight in settings['sizes']]
+    payload = os.urandom(max(sizes))
+    samples = {operation: [] for operation in operations}
+    errors = []
+    lock = threading.Lock()
+
+    def simulate(name):
+        try:
+            client = BenchClient(port, name, payload)
+            for _ in range(settings['files']):
+                client.upload(random.choices(sizes, size_weights)[0])
+        except Exception as e:
+            with lock:
+                errors.append(("connect", f"{name}: {e}"))
+            return
+        time.sleep(max(0.0, start_at - time.time()))
+        deadline = start_at + settings['duration']
+        while time.time() < deadline:
+            operation = random.choices(operations, operation_weights)[0]
+            start = time.perf_counter()
+            try:
+                moved = client.run_operation(operation, sizes, size_weights)
+                sample = (time.perf_counter() - start, moved, True)
+            except Exception as e:
+                sample = (time.perf_counter() - start, 0, False)
+                with lock:
+                    errors.append((operation, f"{name}: {e}"))
+                if isinstance(e, (ConnectionError, OSError)):
+                    break
+            with lock:
+                samples[operation].append(sample)
+        client.close()
+
+    threads = [threading.Thread(target=simulate, args=(name,)) for name in names]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results.put((samples, errors))
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def summarize(samples, elapsed):
+    latencies = sorted(latency for latency, _, _ in samples)
+    moved = sum(moved for _, moved, _ in samples)
+
+    def ms(seconds):
+        return None if seconds is None else round(seconds * 1000, 3)
+    return {
+        'count': len(samples),
+        'errors': sum(1 for _, _, ok in samples if not ok),
+        'ops_per_second': round(len(samples) / elapsed, 2),
+        'mb_per_second': round(moved / elapsed / (1024 * 1024), 2),
+        'latency_ms': {
+            'mean': ms(sum(latencies) / len(latencies)) if latencies else None,
+            'p50': ms(percentile(latencies, 0.5)),
+            'p99': ms(percentile(latencies, 0.99)),
+            'p999': ms(percentile(latencies, 0.999)),
+            'max': ms(latencies[-1]) if latencies else None,
+        },
+    }
+
+
+def process_usage(pid):
+    #cpu seconds and resident memory of the server from /proc, None where that is not available
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        cpu = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+        memory = {}
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key in ("VmRSS", "VmHWM"):
+                    memory[key] = int(value.split()[0]) / 1024
+        return {'cpu_seconds': cpu, 'rss_mb': memory.get("VmRSS"), 'peak_rss_mb': memory.get("VmHWM")}
+    except (OSError, ValueError, IndexError):
+        return {'cpu_seconds': None, 'rss_mb': None, 'peak_rss_mb': None}
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def start_server(directory, server_args):
+    #the headless server in a process of its own, so its cpu and memory can be told apart from the clients'
+    port = free_port()
+    command = [sys.executable, os.path.join(ROOT, "server.py"), "--headless", "--port", str(port),
+               "--directory", os.path.join(directory, "files"),
+               "--log-file", os.path.join(directory, "server_log.txt"),
+               "--error-log-file", os.path.join(directory, "server_error_log.txt")] + shlex.split(server_args)
+    process = subprocess.Popen(command, cwd=directory, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited: {process.stderr.read().decode(errors='replace').strip()}")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return process, port
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("Server did not start listening in time.")
+
+
+def stop_server(process):
+    process.send_signal(signal.SIGTERM if hasattr(signal, "SIGTERM") else signal.SIGINT)
+    try:
+        process.wait(30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def compare(result, baseline, tolerance):
+    #throughput that dropped or tail latency that grew by more than the tolerance
+    regressions = []
+    for operation, current in result['operations'].items():
+        previous = baseline.get('operations', {}).get(operation)
+        if not previous:
+            continue
+        if previous['ops_per_second'] and current['ops_per_second'] < previous['ops_per_second'] * (1 - tolerance):
+            regressions.append(f"{operation}: {current['ops_per_second']} ops/s, was {previous['ops_per_second']}")
+        for key in ("p99", "p999"):
+            before, now = previous['latency_ms'][key], current['latency_ms'][key]
+            if before and now and max(before, now) >= LATENCY_FLOOR_MS and now > before * (1 + tolerance):
+                regressions.append(f"{operation}: {key} {now} ms, was {before} ms")
+    return regressions
+
+
+def run(args):
+    settings = {
+        'mix': parse_weights(args.mix, parse_operation),
+        'sizes': parse_weights(args.sizes, parse_size),
+        'duration': args.duration,
+        'files': args.files,
+    }
+    processes = args.processes or min(args.clients, max(1, (os.cpu_count() or 2) // 2))
+    directory = tempfile.mkdtemp(prefix="bench_load_")
+    server, port = start_server(directory, args.server_args)
+    try:
+        names = [f"bench{index}" for index in range(args.clients)]
+        context = multiprocessing.get_context("spawn")
+        results = context.Queue()
+        #the clients log in and upload their first files, then all start at the same moment
+        start_at = time.time() + args.warmup
+        workers = [context.Process(target=run_worker, args=(port, names[index::processes], settings, start_at, results))
+                   for index in range(processes)]
+        for worker in workers:
+            worker.start()
+        time.sleep(max(0.0, start_at - time.time()))
+        usage_before = process_usage(server.pid)
+        samples = {}
+        errors = []
+        for _ in workers:
+            worker_samples, worker_errors = results.get()
+            for operation, values in worker_samples.items():
+                samples.setdefault(operation, []).extend(values)
+            errors.extend(worker_errors)
+        elapsed = time.time() - start_at
+        usage_after = process_usage(server.pid)
+        for worker in workers:
+            worker.join()
+        try:
+            observer = BenchClient(port, "bench_stats", b"")
+            server_stats = observer.stats()
+            observer.close()
+        except Exception as e:
+            server_stats = {'error': str(e)}
+    finally:
+        stop_server(server)
+        shutil.rmtree(directory, ignore_errors=True)
+
+    cpu = None
+    if usage_before['cpu_seconds'] is not None and usage_after['cpu_seconds'] is not None:
+        cpu = usage_after['cpu_seconds'] - usage_before['cpu_seconds']
+    return {
+        'config': {
+            'clients': args.clients, 'processes': processes, 'duration': args.duration, 'files': args.files,
+            'mix': args.mix, 'sizes': args.sizes, 'server_args': args.server_args,
+            'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count(),
+        },
+        'started': time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(start_at)),
+        'elapsed': round(elapsed, 3),
+        'operations': {operation: summarize(values, elapsed) for operation, values in sorted(samples.items())},
+        'total': summarize([sample for values in samples.values() for sample in values], elapsed),
+        'errors': {'count': len(errors), 'samples': [f"{operation}: {message}" for operation, message in errors[:MAX_ERROR_SAMPLES]]},
+        'server': {
+            'cpu_seconds': None if cpu is None else round(cpu, 3),
+            'cpu_percent': None if cpu is None else round(100.0 * cpu / elapsed, 1),
+            'rss_mb': usage_after['rss_mb'],
+            'peak_rss_mb': usage_after['peak_rss_mb'],
+            'stats': server_stats,
+        },
+    }
+
+
+def print_summary(result):
+    print(f"{result['config']['clients']} clients for {result['elapsed']:.1f}s")
+    print(f"{'operation':>10} {'count':>8} {'errors':>7} {'ops/s':>9} {'MB/s':>8} {'p50 ms':>9} {'p99 ms':>9} {'p999 ms':>9}")
+    rows = list(result['operations'].items()) + [("total", result['total'])]
+    for operation, summary in rows:
+        latency = summary['latency_ms']
+        print(f"{operation:>10} {summary['count']:>8} {summary['errors']:>7} {summary['ops_per_second']:>9.1f} "
+              f"{summary['mb_per_second']:>8.1f} {latency['p50'] or 0:>9.2f} {latency['p99'] or 0:>9.2f} {latency['p999'] or 0:>9.2f}")
+    server = result['server']
+    if server['cpu_seconds'] is not None:
+        print(f"server: {server['cpu_percent']}% cpu, {server['rss_mb']:.0f} MB rss, {server['peak_rss_mb']:.0f} MB peak")
+    for message in result['errors']['samples']:
+        print(f"error: {message}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run simulated clients against a local headless server and report "
+                                                 "throughput, latency percentiles and server resource use as JSON.")
+    parser.add_argument("--clients", type=int, default=16, help="simulated clients, each on its own connection")
+    parser.add_argument("--processes", type=int, default=0, help="processes the clients are spread over (default: half the cpus)")
+    parser.add_argument("--duration", type=float, default=30, help="seconds of measured load")
+    parser.add_argument("--warmup", type=float, default=5, help="seconds for logging in and the first uploads")
+    parser.add_argument("--files", type=int, default=5, help="files every client uploads before the measurement")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"operation weights (default {DEFAULT_MIX})")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help=f"upload size weights (default {DEFAULT_SIZES})")
+    parser.add_argument("--server-args", default="", help="extra server flags, e.g. \"--cache-bytes 0\"")
+    parser.add_argument("--output", help="write the JSON result to this file instead of stdout")
+    parser.add_argument("--baseline", help="JSON result of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed relative slowdown against the baseline")
+    args = parser.parse_args(argv)
+
+    result = run(args)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+        print_summary(result)
+    else:
+        print(json.dumps(result, indent=2))
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"regression: {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,114 @@
+import os
+import threading
+
+
+class BlobStore:
+    #file contents are kept once under blobs/<first two hex digits>/<sha256>, no matter how many
+    #owners and filenames refer to them. the reference counts are rebuilt from the catalog on load
+    #and only change with the catalog lock held; renames and removals happen after that lock is
+    #released, under a lock of their own that the event loop never takes. a stored blob is pinned
+    #until its record is in the catalog so a removal running at the same time leaves it alone
+    DIRECTORY_NAME = "blobs"
+
+    def __init__(self, directory):
+        self.directory = os.path.join(directory, self.DIRECTORY_NAME)
+        self.refs = {}  #digest -> number of catalog records using it
+        self.sizes = {}  #digest -> size in bytes, so requests never have to stat a blob
+        self.pins = {}  #digest -> stored blobs whose records are not in the catalog yet
+        self.lock = threading.Lock()  #guards pins and the files themselves
+
+    def __contains__(self, digest):
+        return digest in self.refs
+
+    def __len__(self):
+        return len(self.refs)
+
+    def path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def size(self, digest):
+        return self.sizes.get(digest)
+
+    def store(self, source, digest):
+        #moves a finished upload into the store, or drops it when the content is already there, and
+        #pins the blob until unpin; returns whether a new blob was added
+        path = self.path(digest)
+        with self.lock:
+            self.pins[digest] = self.pins.get(digest, 0) + 1
+            if os.path.exists(path):
+                os.remove(source)
+                return False
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(source, path)
+            except OSError:
+                self.pins[digest] -= 1
+                if not self.pins[digest]:
+                    del self.pins[digest]
+                raise
+            return True
+
+    def unpin(self, digests):
+        #returns the digests no record ended up using, their blobs are for remove_unused
+        unused = []
+        with self.lock:
+            for digest in digests:
+                count = self.pins[digest] - 1
+                if count:
+                    self.pins[digest] = count
+                    continue
+                del self.pins[digest]
+                if digest not in self.refs:
+                    unused.append(digest)
+        return unused
+
+    def add_ref(self, digest, size=None):
+        if digest:
+            self.refs[digest] = self.refs.get(digest, 0) + 1
+            if size is not None:
+                self.sizes[digest] = size
+
+    def release(self, digest):
+        #called with the catalog lock held, returns whether that was the last reference; the blob
+        #itself is deleted by remove_unused once the lock is released
+        if not digest or digest not in self.refs:
+            return False
+        count = self.refs[digest] - 1
+        if count:
+            self.refs[digest] = count
+            return False
+        del self.refs[digest]
+        self.sizes.pop(digest, None)
+        return True
+
+    def remove_unused(self, digests):
+        #called without the catalog lock; a blob that was referenced or stored again in the meantime stays
+        with self.lock:
+            for digest in digests:
+                if digest in self.refs or digest in self.pins:
+                    continue
+                try:
+                    os.remove(self.path(digest))
+                except FileNotFoundError:
+                    pass
+
+    def rebuild(self, records):
+        self.refs = {}
+        self.sizes = {}
+        for record in records:
+            self.add_ref(record.digest, record.size)
+
+    def collect_garbage(self):
+        #blobs no record points to are left behind by a crash between storing and journaling
+        removed = 0
+        try:
+            prefixes = os.listdir(self.directory)
+        except FileNotFoundError:
+            return 0
+        for prefix in prefixes:
+            prefix_directory = os.path.join(self.directory, prefix)
+            for name in os.listdir(prefix_directory):
+                if name not in self.refs:
+                    os.remove(os.path.join(prefix_directory, name))
+                    removed += 1
+        return removed
@@ -0,0 +1,412 @@
+import collections
+import fnmatch
+import heapq
+import itertools
+import json
+import os
+import shutil
+import threading
+import uuid
+
+
+class FileRecord:
+    #one stored file, slots keep the per-file overhead small for large catalogs
+    __slots__ = ("filename", "owner", "size", "mtime", "digest")
+
+    def __init__(self, filename, owner, size=None, mtime=None, digest=None):
+        self.filename = filename
+        self.owner = owner
+        self.size = size
+        self.mtime = mtime
+        self.digest = digest
+
+    @property
+    def key(self):
+        return (self.owner, self.filename)
+
+    def __repr__(self):
+        return f"FileRecord({self.filename!r}, {self.owner!r}, size={self.size!r})"
+
+
+class Catalog:
+    #files keyed by (owner, filename) with secondary indexes by owner and by filename,
+    #all lookups and mutations are O(1); iteration follows upload order like the old list
+    def __init__(self):
+        self.records = {}   #(owner, filename) -> FileRecord
+        self.by_owner = {}  #owner -> {filename: FileRecord}
+        self.by_name = {}   #filename -> {owner: FileRecord}
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(self.records.values())
+
+    def __contains__(self, key):
+        return key in self.records
+
+    def get(self, owner, filename):
+        return self.records.get((owner, filename))
+
+    def add(self, record):
+        #replaces and returns an existing record with the same key, the new one moves to the end
+        previous = self.remove(record.owner, record.filename)
+        self.records[record.key] = record
+        self.by_owner.setdefault(record.owner, {})[record.filename] = record
+        self.by_name.setdefault(record.filename, {})[record.owner] = record
+        return previous
+
+    def remove(self, owner, filename):
+        record = self.records.pop((owner, filename), None)
+        if record is None:
+            return None
+        owned = self.by_owner[owner]
+        del owned[filename]
+        if not owned:
+            del self.by_owner[owner]
+        named = self.by_name[filename]
+        del named[owner]
+        if not named:
+            del self.by_name[filename]
+        return record
+
+    def owners_of(self, filename):
+        return list(self.by_name.get(filename, {}))
+
+    def candidates(self, owner=None):
+        #copy of the records a query has to look at, the owner index narrows it down
+        if owner is None:
+            return list(self.records.values())
+        return list(self.by_owner.get(owner, {}).values())
+
+    def files_of(self, owner):
+        return list(self.by_owner.get(owner, {}).values())
+
+    def clear(self):
+        self.records.clear()
+        self.by_owner.clear()
+        self.by_name.clear()
+
+
+class ChangeLog:
+    #numbered ADD/DELETE/OVERWRITE events of the catalog; the epoch changes whenever the
+    #versions restart, so a client can tell whether its version still means anything
+    MAX_EVENTS = 10000
+
+    def __init__(self):
+        self.epoch = uuid.uuid4().hex
+        self.version = 0
+        self.events = collections.deque(maxlen=self.MAX_EVENTS)
+
+    def append(self, kind, record):
+        self.version += 1
+        event = {
+            'version': self.version,
+            'event': kind,
+            'filename': record.filename,
+            'owner': record.owner,
+            'size': record.size,
+            'mtime': record.mtime,
+        }
+        self.events.append(event)
+        return event
+
+    def since(self, version):
+        #events after version, or None when they are no longer retained and a snapshot is needed
+        if version > self.version:
+            return None
+        oldest = self.events[0]['version'] if self.events else self.version + 1
+        if version < oldest - 1:
+            return None
+        return list(itertools.islice(self.events, version - oldest + 1, None))
+
+
+#sort orders accepted by LIST, every key ends with the unique (owner, filename) pair so
+#the last key of a page can serve as the cursor of the next one
+SORT_KEYS = {
+    "name": lambda r: (r.filename, r.owner),
+    "owner": lambda r: (r.owner, r.filename),
+    "size": lambda r: (-1 if r.size is None else r.size, r.owner, r.filename),
+    "mtime": lambda r: (0.0 if r.mtime is None else r.mtime, r.owner, r.filename),
+}
+
+
+def matches_name(filename, pattern):
+    #glob when the pattern has wildcards, plain prefix otherwise
+    if any(c in pattern for c in "*?["):
+        return fnmatch.fnmatchcase(filename, pattern)
+    return filename.startswith(pattern)
+
+
+def select_page(records, pattern=None, sort=None, cursor=None, limit=None):
+    #returns (page, next cursor, number of matching records); sort=None keeps upload order and
+    #uses an offset as cursor, the other orders resume after the key in the cursor
+    if pattern:
+        records = [r for r in records if matches_name(r.filename, pattern)]
+    total = len(records)
+    if sort is None:
+        start = int(cursor or 0)
+        end = total if limit is None else start + limit
+        page = records[start:end]
+        return page, (end if end < total else None), total
+
+    key = SORT_KEYS[sort]
+    if cursor is not None:
+        after = tuple(json.loads(cursor))
+        records = [r for r in records if key(r) > after]
+    if limit is None:
+        page = sorted(records, key=key)
+    else:
+        #only the page is sorted, not the whole catalog
+        page = heapq.nsmallest(limit, records, key=key)
+    more = limit is not None and len(records) > len(page)
+    next_cursor = json.dumps(key(page[-1])) if more else None
+    return page, next_cursor, total
+
+
+def parse_file_list_line(line):
+    #filename,owner[,size,mtime,sha256]; filenames may contain commas, owners cannot. the filename of an
+    #old filename,owner line can hold four commas as well, so the extra fields only count when they parse
+    fields = line.rsplit(",", 4)
+    if len(fields) == 5:
+        filename, owner, size, mtime, digest = fields
+        if filename and owner and (not digest or (len(digest) == 64 and all(c in "0123456789abcdef" for c in digest))):
+            try:
+                return FileRecord(filename, owner, int(size) if size else None, float(mtime) if mtime else None, digest or None)
+            except ValueError:
+                pass
+    filename, owner = line.rsplit(",", 1)
+    if not filename or not owner:
+        raise ValueError(line)
+    return FileRecord(filename, owner)
+
+
+def format_file_list_line(record):
+    size = "" if record.size is None else record.size
+    mtime = "" if record.mtime is None else record.mtime
+    return f"{record.filename},{record.owner},{size},{mtime},{record.digest or ''}\n"
+
+
+class CatalogJournal:
+    #file_list.txt is a snapshot, every change after it is appended to file_list.journal as one
+    #json record per line, so no filename can break a record apart; appends are fsynced in groups
+    #by a background thread and the journal is folded into a new snapshot once it grows larger than the catalog
+    SNAPSHOT_NAME = "file_list.txt"
+    JOURNAL_NAME = "file_list.journal"
+    ROTATED_NAME = "file_list.journal.rotated"
+    COMPACTING_NAME = "file_list.journal.compacting"
+    COMPACT_MIN_RECORDS = 10000
+
+    def __init__(self, directory, log=print):
+        self.snapshot_path = os.path.join(directory, self.SNAPSHOT_NAME)
+        self.journal_path = os.path.join(directory, self.JOURNAL_NAME)
+        self.rotated_path = os.path.join(directory, self.ROTATED_NAME)
+        self.compacting_path = os.path.join(directory, self.COMPACTING_NAME)
+        self.log = log
+        self.condition = threading.Condition()
+        self.file = None  #only the sync thread writes to it while it runs
+        self.pending = []  #lines appended but not written yet
+        self.appended = 0  #sequence number of the last appended record
+        self.synced = 0    #sequence number of the last record known to be on disk
+        self.journal_records = 0
+        self.compacting = False
+        self.rotate_for = None  #records source of a compaction waiting for the journal to be rotated
+        self.stopping = False
+        self.closed = False
+        self.sync_thread = None
+
+    def load(self, catalog):
+        #replays snapshot, an interrupted compaction and the journal; returns the number of bad lines
+        catalog.clear()
+        malformed = 0
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, "r") as f:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        try:
+                            catalog.add(parse_file_list_line(line))
+                        except ValueError:
+                            malformed += 1
+                            self.log(f"Malformed line in file list: {line}")
+        self.journal_records = 0
+        for path in (self.compacting_path, self.rotated_path, self.journal_path):
+            if os.path.exists(path):
+                malformed += self.replay(path, catalog)
+        return malformed
+
+    def replay(self, path, catalog):
+        malformed = 0
+        with open(path, "r") as f:
+            for line in f:
+                line = line.rstrip("\n")
+                if not line:
+                    continue
+                try:
+                    if line.startswith("{"):
+                        entry = json.loads(line)
+                        if entry["op"] == "add":
+                            catalog.add(FileRecord(entry["filename"], entry["owner"], entry["size"], entry["mtime"],
+                                                   entry["digest"]))
+                        elif entry["op"] == "del":
+                            catalog.remove(entry["owner"], entry["filename"])
+                        else:
+                            raise ValueError(line)
+                    #plain ADD and DEL lines of journals written before the records were json
+                    elif line.startswith("ADD "):
+                        catalog.add(parse_file_list_line(line[4:]))
+                    elif line.startswith("DEL "):
+                        filename, owner = line[4:].rsplit(",", 1)
+                        catalog.remove(owner, filename)
+                    else:
+                        raise ValueError(line)
+                    self.journal_records += 1
+                except (ValueError, KeyError, TypeError):
+                    #a torn last line after a crash ends up here
+                    malformed += 1
+                    self.log(f"Malformed line in file list journal: {line}")
+        return malformed
+
+    def open(self):
+        #a journal rotated just before a crash joins the older records, the next rotation reuses its name
+        if os.path.exists(self.rotated_path):
+            self.fold_rotated()
+        self.file = open(self.journal_path, "a")
+        self.stopping = False
+        self.closed = False
+        self.sync_thread = threading.Thread(target=self.sync_loop, daemon=True)
+        self.sync_thread.start()
+
+    def append_add(self, record):
+        return self.append(json.dumps({'op': "add", 'filename': record.filename, 'owner': record.owner,
+                                       'size': record.size, 'mtime': record.mtime, 'digest': record.digest}) + "\n")
+
+    def append_delete(self, owner, filename):
+        return self.append(json.dumps({'op': "del", 'filename': filename, 'owner': owner}) + "\n")
+
+    def append(self, line):
+        #constant cost and no file access, callers hold the catalog lock; the sync thread writes the line
+        with self.condition:
+            self.pending.append(line)
+            self.appended += 1
+            self.journal_records += 1
+            self.condition.notify_all()
+            return self.appended
+
+    def wait_synced(self, sequence):
+        with self.condition:
+            while self.synced < sequence and not self.closed:
+                self.condition.wait()
+
+    def sync_loop(self):
+        while True:
+            with self.condition:
+                while not self.pending and self.rotate_for is None and not self.stopping:
+                    self.condition.wait()
+                if self.stopping:
+                    return
+                lines, self.pending = self.pending, []
+                sequence = self.appended
+                records_source, self.rotate_for = self.rotate_for, None
+            self.write_lines(lines)
+            if records_source is not None:
+                self.rotate(records_source)
+            with self.condition:
+                self.synced = max(self.synced, sequence)
+                self.condition.notify_all()
+
+    def write_lines(self, lines):
+        #everything appended since the last round goes to disk with a single fsync
+        if not lines:
+            return
+        try:
+            self.file.write("".join(lines))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        except (OSError, ValueError) as e:
+            self.log(f"Error syncing file list journal: {e}")
+
+    def needs_compaction(self, live_records):
+        return not self.compacting and self.journal_records > max(self.COMPACT_MIN_RECORDS, live_records)
+
+    def start_compaction(self, records_source):
+        #called with the catalog lock held, so it only asks the sync thread to rotate the journal; the
+        #file work happens there without any lock and records_source() is asked for the catalog after that
+        with self.condition:
+            self.compacting = True
+            self.rotate_for = records_source
+            self.condition.notify_all()
+
+    def rotate(self, records_source):
+        #the rotated journal holds synced records up to here, the new one gets everything after. the
+        #catalog is copied later, so replaying the new journal over the snapshot repeats some changes
+        #it already contains; adds and deletes of a key are last-writer-wins, the result is the same
+        try:
+            self.file.close()
+            os.replace(self.journal_path, self.rotated_path)
+        except OSError as e:
+            self.log(f"Error compacting file list journal: {e}")
+            self.compacting = False
+            return
+        finally:
+            self.file = open(self.journal_path, "a")
+        with self.condition:
+            self.journal_records = len(self.pending)
+        threading.Thread(target=self.compact, args=(records_source,), daemon=True).start()
+
+    def compact(self, records_source):
+        #the rotated records are moved aside, then a snapshot of the catalog replaces them
+        try:
+            self.fold_rotated()
+        except OSError as e:
+            #compacting stays set, no rotation may overwrite the records that could not be moved
+            self.log(f"Error compacting file list journal: {e}")
+            return
+        self.write_snapshot(records_source())
+
+    def fold_rotated(self):
+        if os.path.exists(self.compacting_path):
+            #a previous compaction failed, its records are still needed until a snapshot succeeds
+            with open(self.compacting_path, "a") as older, open(self.rotated_path, "r") as newer:
+                shutil.copyfileobj(newer, older)
+                older.flush()
+                os.fsync(older.fileno())
+            os.remove(self.rotated_path)
+        else:
+            os.replace(self.rotated_path, self.compacting_path)
+
+    def write_snapshot(self, records):
+        temp_path = self.snapshot_path + ".tmp"
+        try:
+            with open(temp_path, "w") as f:
+                for record in records:
+                    f.write(format_file_list_line(record))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.snapshot_path)
+            #the rotated journal is only needed until the new snapshot is in place
+            os.remove(self.compacting_path)
+            self.log(f"Compacted file list journal into a snapshot of {len(records)} files.")
+        except OSError as e:
+            self.log(f"Error compacting file list journal: {e}")
+        finally:
+            self.compacting = False
+
+    def close(self):
+        with self.condition:
+            if self.file is None:
+                return
+            self.stopping = True
+            self.condition.notify_all()
+        self.sync_thread.join()
+        #whatever the sync thread did not get to is written here
+        try:
+            self.write_lines(self.pending)
+        finally:
+            with self.condition:
+                self.pending = []
+                self.synced = self.appended
+                self.closed = True
+                self.file.close()
+                self.file = None
+                self.condition.notify_all()
@@ -1,211 +1,35 @@
-import os
-import socket
-import threading
 import queue
+import threading
+import time
 from tkinter import Tk, Label, Button, Listbox, Scrollbar, filedialog, Entry, END, messagebox
 from tkinter import simpledialog
-
-class Client:
-    def __init__(self):
-        self.client_socket = None
-        self.server_ip = None
-        self.server_port = None
-        self.username = None
-        self.download_directory = None
-        self.listener_thread = None
-        self.listening = False
-        self.socket_lock = threading.Lock()  #to use threads safely with concurrency
-        self.gui_queue = queue.Queue()    #to use threads safely with concurrency   
-        self.current_download = None         
-
-    def connect_to_server(self, ip, port, username):
-        max_attempts = 1
-        for attempt in range(max_attempts):
-            try:
-                #close any existing socket
-                with self.socket_lock:
-                    if self.client_socket:
-                        try:
-                            self.client_socket.close()
-                            self.client_socket = None
-                        except:
-                            pass
-                        self.client_socket = None  #reset to None
-
-                    #creating a new socket
-                    self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-
-                    #setting timeout for connection
-                    self.client_socket.settimeout(10)  
-
-                    self.client_socket.connect((ip, port))
-
-                    #setting a longer timeout for operations
-                    self.client_socket.settimeout(60)  
-
-                    #sending username
-                    self.client_socket.send(username.encode())
-
-                    #receiving a response
-                    response = self.client_socket.recv(1024).decode()
-
-                    if response == "CONNECTED":
-                        self.gui_queue.put(f"Connected to server as {username}.")
-                        self.username = username
-                        self.server_ip = ip
-                        self.server_port = port
-
-                        #starting the listener thread
-                        self.listening = True
-                        self.listener_thread = threading.Thread(target=self.listen_to_server, daemon=True)
-                        self.listener_thread.start()
-
-                        return True
-                    
-                    #if there is an error
-                    elif response.startswith("ERROR"):
-                        self.gui_queue.put(response)
-                        self.client_socket.close()
-                        self.client_socket = None  
-                        return False
-                    else:
-                        self.gui_queue.put(f"Unexpected response from server: {response}")
-                        self.client_socket.close()
-                        self.client_socket = None  
-                        return False
-
-            #if it cannot connect to the server
-            except ConnectionRefusedError:
-                self.gui_queue.put("Server is not open.")
-                self.client_socket = None  
-                return False
-            except (socket.timeout, OSError) as e:
-                self.gui_queue.put(f"Connection attempt {attempt + 1} failed: {e}")
-                if attempt == max_attempts - 1:
-                    self.client_socket = None  
-                    self.gui_queue.put("Failed to connect after multiple attempts.")
-                    return False
-                import time
-                time.sleep(2)
-                self.client_socket = None  
-            except Exception as e:
-                self.gui_queue.put(f"An unexpected error occurred: {e}")
-                self.client_socket = None
-                return False
-
-        self.gui_queue.put("Failed to connect after multiple attempts.")
-        return False
-
-    def listen_to_server(self):
-        while self.listening and self.client_socket:
-            try:
-                message = self.client_socket.recv(4096)
-                if not message:
-                    self.gui_queue.put("Disconnected from server.")
-                    self.disconnect()
-                    break
-
-                decoded_message = message.decode()
-
-                #ignore debug messages
-                if decoded_message.startswith("DEBUG:"):
-                    continue  
-
-                #if the server is shutdown
-                if decoded_message.startswith("SERVER_SHUTDOWN:"):
-                    shutdown_msg = decoded_message.replace("SERVER_SHUTDOWN:", "").strip()
-                    self.gui_queue.put(f"** Server Shutdown: {shutdown_msg} **")
-                    self.disconnect()
-                    break
-
-                #handling notifications (e.g., file downloaded)
-                if decoded_message.startswith("NOTIFICATION:"):
-                    notification = decoded_message.replace("NOTIFICATION:", "").strip()
-                    self.gui_queue.put(f"** Notification: {notification} **")
-                    continue  #continue to next message
-
-                #handling file list
-                if "Owner:" in decoded_message:
-                    lines = decoded_message.strip().split('\n')
-                    file_entries = []
-                    for line in lines:
-                        if "Owner:" in line:
-                            #extracting filename and owner
-                            try:
-                                filename_part, owner_part = line.split(" (Owner: ")
-                                owner = owner_part.rstrip(")")
-                                filename = filename_part.strip()
-                                file_entries.append(f"{filename} - {owner}")
-                            except ValueError:
-                                #handle unexpected format
-                                file_entries.append(f"Invalid file entry: {line}")
-
-                    if file_entries:
-                        self.gui_queue.put("File List:")
-                        for entry in file_entries:
-                            self.gui_queue.put(entry)
-                    else:
-                        self.gui_queue.put("No files available on the server.")
-                    continue  #continue to next message
-
-                #handling upload 
-                if decoded_message.startswith("UPLOAD_RESPONSE:"):
-                    upload_response = decoded_message.replace("UPLOAD_RESPONSE:", "").strip()
-                    self.gui_queue.put(upload_response)
-                    if "overwritten" in upload_response.lower():
-                        filename = self.current_download['filename'] if self.current_download else "unknown"
-                        self.gui_queue.put(f"SHOWINFO:File Overwritten:The file '{filename}' has been overwritten on the server.")
-                    elif "uploaded successfully" in upload_response.lower():
-                        filename = self.current_download['filename'] if self.current_download else "unknown"
-                        self.gui_queue.put(f"SHOWINFO:Upload Successful:The file '{filename}' has been uploaded successfully.")
-                    continue  #continue to next message
-
-                #handling file download 
-                if decoded_message.startswith("FILESIZE"):
-                    parts = decoded_message.split(" ")
-                    if len(parts) == 2:
-                        try:
-                            file_size = int(parts[1])
-                            if self.current_download and self.current_download['filename'] and self.current_download['owner']:
-                                self.current_download['file_size'] = file_size
-                                #sending acknowledgment
-                                self.client_socket.send("READY".encode())
-                                #writing to file
-                                self.current_download['file'] = open(self.current_download['save_path'], "wb")
-                                self.gui_queue.put(f"Downloading file '{self.current_download['filename']}'...")
-                        except ValueError:
-                            self.gui_queue.put("Invalid FILESIZE value received.")
-                    else:
-                        self.gui_queue.put("Invalid FILESIZE response from server.")
-                    continue  #continue to next message
-
-                #handling if other messages or file data are received
-                if self.current_download and self.current_download['file']:
-                    try:
-                        #write the incoming data to the file
-                        self.current_download['file'].write(message)
-                        self.current_download['bytes_received'] += len(message)
-                        if self.current_download['bytes_received'] >= self.current_download['file_size']:
-                            self.current_download['file'].close()
-                            self.gui_queue.put(f"File '{self.current_download['filename']}' downloaded successfully.")
-                            self.current_download = None
-                    except Exception as e:
-                        self.gui_queue.put(f"Error writing to file: {e}")
-                        if self.current_download['file']:
-                            self.current_download['file'].close()
-                        self.current_download = None
-                else:
-                    self.gui_queue.put(decoded_message)
-            except socket.timeout:
-                continue  #continue listening
-            except (ConnectionResetError, OSError):
-                self.gui_queue.put("Connection lost.")
-                self.disconnect()
-                break
-            except Exception as e:
-                self.gui_queue.put(f"Error receiving message: {e}")
-                self.disconnect()
-                break
+from client_api import (
+    FileClient, ServerError, describe_transfer, describe_stats, LIST_PAGE_SIZE, DEFAULT_STREAMS, DEFAULT_CONCURRENCY,
+)
+
+
+class Client(FileClient):
+    #the tk window over FileClient. events of the client and results of requests run on worker
+    #threads reach the window through gui_queue, which the tk thread drains every 100 ms
+    def __init__(self, streams=DEFAULT_STREAMS, dedup=True, compression="zlib", concurrency=DEFAULT_CONCURRENCY):
+        self.gui_queue = queue.Queue()    #to use threads safely with concurrency
+        super().__init__(streams, dedup, compression, concurrency, on_event=self.queue_event)
+        self.next_list_page = None  #filters and cursor of the next LIST page
+        self.list_shown = 0
+        self.transfers_shown = None  #what the transfer list showed when it was last drawn
+        self.connecting = False  #set while a connection attempt runs in the background
+
+    def queue_event(self, kind, message):
+        #popups are marked by a prefix, everything else goes to the log box as it is
+        if kind == "error":
+            message = f"ERROR: {message}"
+        elif kind == "notification":
+            message = f"** Notification: {message} **"
+        elif kind == "shutdown":
+            message = f"** Server Shutdown: {message} **"
+        elif kind == "finished":
+            message = f"SHOWINFO:Transfers Finished:{message}"
+        self.gui_queue.put(message)
 
     def process_gui_queue(self):
         try:
@@ -218,6 +42,9 @@ class Client:
                 elif message.startswith("SHOWWARNING:"):
                     _, title, content = message.split(":", 2)
                     messagebox.showwarning(title, content)
+                elif message.startswith("SHOWERROR:"):
+                    _, title, content = message.split(":", 2)
+                    messagebox.showerror(title, content)
                 elif message.startswith("** Notification:"):
                     #notification for something like download
                     notification_text = message.replace("** Notification:", "").strip()
@@ -237,114 +64,71 @@ class Client:
             #scheduling the next check after 100 milliseconds
             self.root.after(100, self.process_gui_queue)
 
+    def run_in_background(self, action, *args):
+        #requests that wait for the server run off the tk thread so the window stays responsive
+        threading.Thread(target=action, args=args, daemon=True).start()
 
-    def disconnect(self):
-        try:
-            self.listening = False
-            with self.socket_lock:
-                if self.client_socket:
-                    try:
-                        self.client_socket.send("DISCONNECT".encode())
-                    except:
-                        pass
-                    self.client_socket.close()
-                    self.client_socket = None
-            #closing any open download files
-            if self.current_download and self.current_download.get('file'):
-                self.current_download['file'].close()
-                self.current_download = None
-            self.gui_queue.put("Disconnected from server.")
-            self.username = None  #reset username
-        except Exception as e:
-            self.gui_queue.put(f"Error disconnecting: {e}")
-            self.client_socket = None  #ensure client_socket is reset
-            self.username = None  #reset username
+    def view_files(self):
+        #served from the mirror when it is current, no catalog transfer needed
+        entries = self.mirror_files()
+        if entries is None:
+            self.request_file_list()
+            return
+        if not entries:
+            self.log_message("No files available on the server.")
+            return
+        self.log_message("File List:")
+        for entry in entries[:LIST_PAGE_SIZE]:
+            self.log_message(f"{entry['filename']} - {entry['owner']}")
+        if len(entries) > LIST_PAGE_SIZE:
+            self.log_message(f"Showing {LIST_PAGE_SIZE} of {len(entries)} files. Use 'Filter Files' to narrow the list down.")
 
-    def upload_file(self, file_path):
+    def request_file_list(self, owner=None, pattern=None, sort=None, page_size=LIST_PAGE_SIZE, cursor=None):
         if not self.client_socket:
-            self.gui_queue.put("Error: Not connected to a server.")
+            self.log_message("Not connected to a server.")
             return
+        filters = {'owner': owner, 'pattern': pattern, 'sort': sort, 'page_size': page_size}
+        self.run_in_background(self.show_file_list, filters, cursor)
 
+    def show_file_list(self, filters, cursor):
         try:
-            filename = os.path.basename(file_path)
-            if not os.path.exists(file_path) or not filename.strip():
-                self.gui_queue.put("Error: Invalid file path or filename.")
-                return
-
-            #getting the file size
-            file_size = int(os.path.getsize(file_path))
-
-            #notifying the server about the upload, including the file size
-            self.gui_queue.put(f"Uploading file '{filename}'...")
-            self.client_socket.send(f"UPLOAD {filename} {file_size}".encode())
-
-            #tracking the upload as a current download for potential overwrite notifications
-            self.current_download = {
-                'filename': filename,
-                'owner': self.username,  #assuming uploader is the owner
-                'save_path': None,       
-                'file_size': 0,
-                'bytes_received': 0,
-                'file': None
-            }
-
-            #sending the file content
-            with open(file_path, "rb") as f:
-                while True:
-                    chunk = f.read(4096)
-                    if not chunk:
-                        break
-                    self.client_socket.sendall(chunk)
-
-            #not performing recv, listener thread handles the response
-        except Exception as e:
-            self.gui_queue.put(f"Unexpected error during upload: {e}")
-
-    def request_file_list(self):
-        try:
-            if not self.client_socket:
-                self.gui_queue.put("Not connected to a server.")
-                return
-
-            #request the file list from the server
-            self.client_socket.send("LIST".encode())
-            #not performing recv, listener thread handles the response
+            entries, next_cursor, total = self.list_page(cursor=cursor, **filters)
         except Exception as e:
-            self.gui_queue.put(f"Error requesting file list: {e}")
-
-    def download_file(self, filename, owner):
-        if not self.download_directory:
-            messagebox.showerror("Error", "Download directory not set.")
+            self.log_message(f"Error requesting file list: {e}")
             return
-        try:
-            #if a download is already in progress
-            if self.current_download and self.current_download['file']:
-                self.gui_queue.put("Error: A download is already in progress.")
-                messagebox.showerror("Download Error", "A download is already in progress.")
-                return
+        if entries:
+            self.log_message("File List:")
+        else:
+            self.log_message("No files available on the server.")
+        for entry in entries:
+            self.log_message(f"{entry['filename']} - {entry['owner']}")
+        self.list_shown = len(entries) if cursor is None else self.list_shown + len(entries)
+        if next_cursor is not None:
+            #remembering the query so the next page continues where this one stopped
+            self.next_list_page = dict(filters, cursor=next_cursor)
+            self.log_message(f"Showing {self.list_shown} of {total} files. Use 'Next Page' for more.")
+        else:
+            self.next_list_page = None
 
-            #tracking the current download
-            self.current_download = {
-                'filename': filename,
-                'owner': owner,
-                'save_path': os.path.join(self.download_directory, filename),
-                'file_size': 0,
-                'bytes_received': 0,
-                'file': None
-            }
-
-            self.client_socket.send(f"DOWNLOAD {filename} {owner}".encode())
-            self.gui_queue.put(f"Initiated download for '{filename}' from '{owner}'.")
-            #listener thread handles the rest
-        except Exception as e:
-            self.gui_queue.put(f"Error initiating download: {e}")
+    def request_next_page(self):
+        if not self.next_list_page:
+            self.log_message("No more files to show.")
+            return
+        self.request_file_list(**self.next_list_page)
 
-    def delete_file(self, filename):
+    def delete_and_report(self, filenames):
         try:
-            self.client_socket.send(f"DELETE {filename}".encode())
-            #not performing recv, listener thread handles the response
+            if len(filenames) == 1:
+                self.log_message(self.delete_file(filenames[0]))
+                return
+            deleted, errors = self.delete_files(filenames)
+            self.log_message(f"{len(deleted)} files deleted successfully.")
+            for filename, error in errors.items():
+                self.queue_event("error", f"Could not delete '{filename}': {error}")
+        except ServerError as e:
+            self.queue_event("error", str(e))
         except Exception as e:
-            self.gui_queue.put(f"Error deleting file: {e}")
+            self.log_message(f"Error deleting files: {e}")
 
     def log_message(self, message):
         self.gui_queue.put(message)
@@ -352,7 +136,7 @@ class Client:
     def setup_gui(self):
         self.root = Tk()
         self.root.title("Client")
-        self.root.geometry("600x400")
+        self.root.geometry("600x590")
 
         #Server Connection Form
         Label(self.root, text="Server IP:").pack()
@@ -368,11 +152,20 @@ class Client:
 
         #File Operations Buttons
         Button(self.root, text="Upload File", command=self.upload_gui).pack()
-        Button(self.root, text="View Files", command=self.request_file_list).pack()
+        Button(self.root, text="View Files", command=self.view_files).pack()
+        Button(self.root, text="Filter Files", command=self.filter_gui).pack()
+        Button(self.root, text="Next Page", command=self.request_next_page).pack()
         Button(self.root, text="Download File", command=self.download_gui).pack()
+        Button(self.root, text="Download Archive", command=self.archive_gui).pack()
         Button(self.root, text="Delete File", command=self.delete_gui).pack()
+        Button(self.root, text="Retry Failed Transfers", command=self.retry_gui).pack()
+        Button(self.root, text="Server Stats", command=self.stats_gui).pack()
         Button(self.root, text="Disconnect", command=self.disconnect_gui).pack()
 
+        #Transfer Queue
+        self.transfer_listbox = Listbox(self.root, height=6)
+        self.transfer_listbox.pack(fill="x")
+
         #Log Box
         self.log_listbox = Listbox(self.root)
         self.log_listbox.pack(fill="both", expand=True)
@@ -382,6 +175,7 @@ class Client:
 
         #start processing the GUI queue
         self.process_gui_queue()
+        self.refresh_transfers()
 
         self.root.protocol("WM_DELETE_WINDOW", self.disconnect_gui)
         self.root.mainloop()
@@ -391,14 +185,15 @@ class Client:
         port = self.port_entry.get().strip()
         username = self.username_entry.get().strip()
 
+        if self.connecting:
+            self.log_message("Already connecting, please wait.")
+            return
+
         #handling reconnecting
+        reconnect = False
         if self.client_socket:
-            response = messagebox.askyesno("Reconnect", "You are already connected. Do you want to reconnect?")
-            if response:
-                self.disconnect()
-                import time
-                time.sleep(0.5)
-            else:
+            reconnect = messagebox.askyesno("Reconnect", "You are already connected. Do you want to reconnect?")
+            if not reconnect:
                 return
 
         #checking IP address
@@ -424,21 +219,51 @@ class Client:
             self.log_message("Error! Username cannot be empty.")
             return
 
-        #attempting to connect
-        if self.connect_to_server(ip, port_num, username):
-            messagebox.showinfo("Success", f"Connected to {ip}:{port_num} as '{username}'.")
-        else:
-            messagebox.showerror("Error", "Failed to connect to server.")
+        #attempting to connect, a busy server is asked again after a while so this runs off the tk thread
+        self.connecting = True
+        self.log_message(f"Connecting to {ip}:{port_num}...")
+        self.run_in_background(self.connect_and_report, ip, port_num, username, reconnect)
+
+    def connect_and_report(self, ip, port, username, reconnect):
+        try:
+            if reconnect:
+                self.disconnect()
+                time.sleep(0.5)
+            if self.connect_to_server(ip, port, username):
+                self.gui_queue.put(f"SHOWINFO:Success:Connected to {ip}:{port} as '{username}'.")
+            else:
+                self.gui_queue.put("SHOWERROR:Error:Failed to connect to server.")
+        finally:
+            self.connecting = False
 
     def upload_gui(self):
         if not self.client_socket:
             self.log_message("Not connected to a server.")
             return
-        file_path = filedialog.askopenfilename(filetypes=[("All files", "*.*")])
-        if file_path:
-            self.upload_file(file_path)
-        else:
+        file_paths = filedialog.askopenfilenames(filetypes=[("All files", "*.*")])
+        if not file_paths:
             self.log_message("Upload cancelled: No filename provided.")
+            return
+        #the transfer manager works through the queue on its own threads, the gui stays responsive
+        self.queue_uploads(list(file_paths))
+        self.log_message(f"Queued {len(file_paths)} upload(s).")
+
+    def filter_gui(self):
+        if not self.client_socket:
+            self.log_message("Not connected to a server.")
+            return
+
+        #empty answers mean no filter
+        owner = simpledialog.askstring("Filter Files", "Only files of this owner (leave empty for all):")
+        if owner is None:
+            return
+        pattern = simpledialog.askstring("Filter Files", "Filename prefix or glob such as *.csv (leave empty for all):")
+        if pattern is None:
+            return
+        sort = simpledialog.askstring("Filter Files", "Sort by name, owner, size or mtime (leave empty for upload order):")
+        if sort is None:
+            return
+        self.request_file_list(owner=owner.strip() or None, pattern=pattern.strip() or None, sort=sort.strip() or None)
 
     def download_gui(self):
         if not self.client_socket:
@@ -446,8 +271,8 @@ class Client:
             return
 
         #asking user to enterr file name to download
-        filename = simpledialog.askstring("Download File", "Enter the filename to download:")
-        if not filename:
+        names = simpledialog.askstring("Download File", "Enter the filenames to download, separated by commas (patterns such as *.csv are allowed):")
+        if not names or not names.strip():
             self.log_message("Download cancelled: No filename provided.")
             return
 
@@ -466,7 +291,55 @@ class Client:
         #setting the download directory and proceeding
         self.download_directory = download_directory
         self.log_message(f"Download directory set to: {self.download_directory}")
-        self.download_file(filename, owner)
+        filenames = self.match_files(owner, [name.strip() for name in names.split(",") if name.strip()])
+        if not filenames:
+            self.log_message(f"No files of '{owner}' match '{names}'.")
+            return
+        self.queue_downloads(filenames, owner, download_directory)
+        self.log_message(f"Queued {len(filenames)} download(s).")
+
+    def archive_gui(self):
+        if not self.client_socket:
+            self.log_message("Not connected to a server.")
+            return
+        owner = simpledialog.askstring("Download Archive", "Only files of this owner (leave empty for all):")
+        if owner is None:
+            return
+        pattern = simpledialog.askstring("Download Archive", "Filename prefix or glob such as *.csv (leave empty for all):")
+        if pattern is None:
+            return
+        save_path = filedialog.asksaveasfilename(title="Save Archive As", defaultextension=".tar", filetypes=[("Tar archives", "*.tar")])
+        if not save_path:
+            self.log_message("Download cancelled: No archive name selected.")
+            return
+        self.transfers.add_archive(save_path, owner.strip() or None, pattern.strip() or None)
+        self.log_message(f"Queued archive download to {save_path}.")
+
+    def stats_gui(self):
+        if not self.client_socket:
+            self.log_message("Not connected to a server.")
+            return
+        self.run_in_background(self.show_stats)
+
+    def show_stats(self):
+        try:
+            self.gui_queue.put(f"SHOWINFO:Server Stats:{describe_stats(self.request_stats())}")
+        except Exception as e:
+            self.log_message(f"Error requesting server stats: {e}")
+
+    def retry_gui(self):
+        count = self.transfers.retry_failed()
+        self.log_message(f"Retrying {count} failed transfer(s)." if count else "No failed transfers to retry.")
+
+    def refresh_transfers(self):
+        #redrawn from a snapshot twice a second, only when something changed
+        lines = [describe_transfer(transfer) for transfer in self.transfers.snapshot()]
+        if lines != self.transfers_shown:
+            self.transfer_listbox.delete(0, END)
+            for line in lines:
+                self.transfer_listbox.insert(END, line)
+            self.transfers_shown = lines
+        self.root.after(500, self.refresh_transfers)
 
     def delete_gui(self):
         if not self.client_socket:
@@ -474,17 +347,24 @@ class Client:
             return
 
         #asking user to enter the filename to delete
-        filename = simpledialog.askstring("Delete File", "Enter filename to delete:")
-        if not filename:
+        names = simpledialog.askstring("Delete File", "Enter filenames to delete, separated by commas (patterns such as *.csv are allowed):")
+        if not names or not names.strip():
             self.log_message("Delete cancelled: No filename provided.")
             return
+        filenames = self.match_files(self.username, [name.strip() for name in names.split(",") if name.strip()])
+        if not filenames:
+            self.log_message(f"None of your files match '{names}'.")
+            return
 
         #confirming deletion
-        confirm = messagebox.askyesno("Confirm Delete", f"Are you sure you want to delete '{filename}'?")
-        if confirm:
-            self.delete_file(filename)
+        if len(filenames) == 1:
+            confirm = messagebox.askyesno("Confirm Delete", f"Are you sure you want to delete '{filenames[0]}'?")
         else:
+            confirm = messagebox.askyesno("Confirm Delete", f"Are you sure you want to delete {len(filenames)} files?")
+        if not confirm:
             self.log_message("Delete cancelled by user.")
+        else:
+            self.run_in_background(self.delete_and_report, filenames)
 
     def disconnect_gui(self):
         self.disconnect()
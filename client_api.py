@@ -0,0 +1,1388 @@
+import os
+import socket
+import threading
+import queue
+import itertools
+import json
+import hashlib
+import time
+import fnmatch
+import random
+import asyncio
+import concurrent.futures
+from compression import (
+    CODECS, COMPRESS_BLOCK_SIZE, MIN_COMPRESS_SIZE, is_compressible, compress_block, decompress_block, describe_savings,
+    frame_slices,
+)
+from protocol import (
+    FramedSocket, ProtocolError, decode_message, FRAME_NAMES, NO_REQUEST,
+    HELLO, REQUEST, RESPONSE, ERROR, DATA, END, NOTIFICATION, SHUTDOWN, EVENT,
+)
+
+#entries requested per LIST page
+LIST_PAGE_SIZE = 1000
+#seconds to wait for the reply of a request the caller blocks on
+REPLY_TIMEOUT = 30
+#downloads are written next to their target with this suffix and renamed once complete
+PARTIAL_SUFFIX = ".part"
+#files at least this large are split into chunks and moved over several connections
+DEFAULT_STREAMS = 4
+PARALLEL_THRESHOLD = 64 * 1024 * 1024
+TRANSFER_CHUNK_SIZE = 8 * 1024 * 1024
+STREAM_TIMEOUT = 60
+HASH_BLOCK_SIZE = 1024 * 1024
+#progress is reported after every block of this size
+PROGRESS_BLOCK_SIZE = 1024 * 1024
+#transfers the manager runs at once, and how often a failed one is tried again
+DEFAULT_CONCURRENCY = 3
+TRANSFER_RETRIES = 3
+RETRY_DELAY = 2
+#a busy server is asked again this many times when connecting
+BUSY_RETRIES = 3
+#smaller files are moved many at a time in one batch request
+BATCH_FILE_SIZE = 1024 * 1024
+BATCH_MAX_FILES = 500
+BATCH_MAX_BYTES = 32 * 1024 * 1024
+#kinds of the events a client reports to its on_event callback
+EVENT_KINDS = ("log", "error", "notification", "shutdown", "finished")
+
+
+class ServerError(Exception):
+    #an ERROR reply to a request
+    pass
+
+
+class ServerBusy(ServerError):
+    #the server turned the request away because it is saturated, it can be tried again later
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def server_error(message):
+    #the exception for the fields of an ERROR frame
+    if message.get("code") == "BUSY":
+        return ServerBusy(message.get("message", ""), message.get("retry_after"))
+    return ServerError(message.get("message", ""))
+
+
+def save_path_in(directory, filename):
+    #filenames come from the server, anything but a plain name could point outside the directory
+    if filename in ("", ".", "..") or os.path.basename(filename) != filename:
+        raise ValueError(f"Refusing to save '{filename}', it is not a plain filename.")
+    return os.path.join(directory, filename)
+
+
+def backoff_delay(attempt, retry_after=None):
+    #doubles with every attempt and never undercuts what a busy server asked for; the random factor
+    #spreads out clients that were turned away together so they do not all come back at once
+    delay = max(RETRY_DELAY * 2 ** (attempt - 1), retry_after or 0)
+    return delay * random.uniform(0.5, 1.5)
+
+
+def file_digest(path):
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(HASH_BLOCK_SIZE)
+            if not block:
+                return hasher.hexdigest()
+            hasher.update(block)
+
+
+def describe_transfer(transfer):
+    line = f"#{transfer['id']} {transfer['kind']} '{transfer['name']}'"
+    if transfer.get('owner'):
+        line += f" from '{transfer['owner']}'"
+    line += f": {transfer['state']}"
+    if transfer['size']:
+        line += f" {100.0 * transfer['bytes'] / transfer['size']:.0f}%"
+    if transfer['state'] == "running" and transfer['rate']:
+        line += f" {transfer['rate'] / (1024 * 1024):.1f} MB/s"
+    if transfer['error'] and transfer['state'] != "done":
+        line += f" ({transfer['error']})"
+    return line
+
+
+def describe_stats(stats):
+    #the STATS reply as a few lines of text, latencies in milliseconds
+    def ms(seconds):
+        return "-" if seconds is None else f"{seconds * 1000:.1f}"
+    lines = [f"Uptime: {stats['uptime'] / 3600:.1f} h, {stats['clients']} clients on {stats['connections']} connections",
+             f"Transfers: {stats['transfers']['active']} active, {stats['transfers']['queued']} queued, "
+             f"{stats['transfers']['rejected']} turned away",
+             f"Traffic: {stats['bytes_received'] / (1024 * 1024):.1f} MB in, {stats['bytes_sent'] / (1024 * 1024):.1f} MB out",
+             f"Catalog: {stats['files']} files, {stats['blobs']} distinct contents"]
+    cache = stats.get('cache')
+    if cache:
+        hit_rate = "-" if cache['hit_rate'] is None else f"{100.0 * cache['hit_rate']:.0f}%"
+        lines.append(f"Cache: {hit_rate} hits, {cache['bytes'] / (1024 * 1024):.1f} of {cache['max_bytes'] / (1024 * 1024):.0f} MB used")
+    for name, waits in stats['lock_waits'].items():
+        lines.append(f"{name}: p50 {ms(waits['p50'])} ms, p99 {ms(waits['p99'])} ms wait")
+    for command, timing in stats['requests'].items():
+        lines.append(f"{command}: {timing['count']} requests, {timing['errors']} errors, "
+                     f"p50 {ms(timing['p50'])} ms, p99 {ms(timing['p99'])} ms")
+    return "\n".join(lines)
+
+
+class TransferManager:
+    #queues uploads and downloads and runs up to concurrency of them at once, each on a worker
+    #thread with data connections of its own; a failed transfer is queued again after a growing
+    #delay and resumes where the last attempt stopped. every add returns a concurrent.futures.Future
+    #that completes with the result of the transfer, or its error once no retries are left
+    def __init__(self, client, concurrency=DEFAULT_CONCURRENCY, retries=TRANSFER_RETRIES):
+        self.client = client
+        self.concurrency = concurrency
+        self.retries = retries
+        self.pending = queue.Queue()
+        self.transfers = []  #every transfer queued so far, in order
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)  #signalled when the last unfinished transfer ends
+        self.unfinished = 0
+        self.finished = {'done': 0, 'failed': 0}  #outcomes since the queue last ran empty
+        self.transfer_ids = itertools.count(1)
+        self.workers = []
+
+    def add_upload(self, file_path):
+        return self.add({'kind': "upload", 'name': os.path.basename(file_path),
+                         'action': lambda progress: self.client.upload_file(file_path, progress)})
+
+    def add_download(self, filename, owner, directory):
+        return self.add({'kind': "download", 'name': filename, 'owner': owner,
+                         'action': lambda progress: self.client.download_file(filename, owner, directory, progress)})
+
+    def add_upload_batch(self, file_paths):
+        return self.add({'kind': "batch upload", 'name': f"{len(file_paths)} files",
+                         'action': lambda progress: self.client.upload_batch(file_paths, progress)})
+
+    def add_download_batch(self, filenames, owner, directory):
+        files = [(owner, filename) for filename in filenames]
+        return self.add({'kind': "batch download", 'name': f"{len(filenames)} files", 'owner': owner,
+                         'action': lambda progress: self.client.download_batch(files, directory, progress)})
+
+    def add_archive(self, save_path, owner=None, pattern=None):
+        return self.add({'kind': "archive", 'name': os.path.basename(save_path), 'owner': owner,
+                         'action': lambda progress: self.client.download_archive(save_path, owner, pattern, progress)})
+
+    def add(self, transfer):
+        transfer.update({'id': next(self.transfer_ids), 'state': "queued", 'attempts': 0, 'bytes': 0,
+                         'size': None, 'rate': 0.0, 'error': None, 'future': concurrent.futures.Future()})
+        with self.lock:
+            self.transfers.append(transfer)
+            self.unfinished += 1
+            #workers are started on demand and then stay for the lifetime of the client
+            if len(self.workers) < self.concurrency:
+                worker = threading.Thread(target=self.work, daemon=True)
+                self.workers.append(worker)
+                worker.start()
+        self.pending.put(transfer)
+        return transfer['future']
+
+    def work(self):
+        while True:
+            transfer = self.pending.get()
+            #a transfer cancelled while it sat in the queue is skipped
+            with self.lock:
+                if transfer['state'] != "queued":
+                    continue
+                transfer['state'] = "running"
+            self.run(transfer)
+
+    def run(self, transfer):
+        if not self.client.client_socket:
+            error = ConnectionError("Not connected to a server.")
+            transfer['error'] = str(error)
+            self.finish(transfer, "failed", error)
+            return
+        transfer['attempts'] += 1
+        started = time.monotonic()
+        start_bytes = None
+
+        def progress(done, total):
+            nonlocal start_bytes
+            #the rate only counts bytes moved by this attempt, not what it resumed from
+            if start_bytes is None:
+                start_bytes = done
+            transfer['bytes'] = done
+            transfer['size'] = total
+            elapsed = time.monotonic() - started
+            if elapsed > 0:
+                transfer['rate'] = (done - start_bytes) / elapsed
+
+        try:
+            result = transfer['action'](progress)
+        except Exception as e:
+            transfer['error'] = str(e)
+            #the server refusing a request or a bad local path does not get better by waiting,
+            #a busy server does
+            refused = isinstance(e, (ServerError, ValueError)) and not isinstance(e, ServerBusy)
+            if refused or transfer['attempts'] > self.retries:
+                self.client.report(f"Transfer of '{transfer['name']}' failed: {e}", "error")
+                self.finish(transfer, "failed", e)
+                return
+            delay = backoff_delay(transfer['attempts'], getattr(e, 'retry_after', None))
+            transfer['state'] = "waiting"
+            self.client.report(f"Transfer of '{transfer['name']}' failed: {str(e).rstrip('.')}. "
+                                      f"Trying again in {delay:.1f}s ({transfer['attempts']} of {self.retries + 1} attempts made).")
+            timer = threading.Timer(delay, self.requeue, args=(transfer,))
+            timer.daemon = True
+            timer.start()
+            return
+        transfer['error'] = None
+        self.finish(transfer, "done", result=result)
+
+    def requeue(self, transfer):
+        with self.lock:
+            if transfer['state'] != "waiting":
+                return
+            transfer['state'] = "queued"
+        self.pending.put(transfer)
+
+    def finish(self, transfer, state, error=None, result=None):
+        with self.lock:
+            summary = self.settle(transfer, state)
+            future = transfer['future']
+        #done callbacks run here, outside the lock, so they may queue more transfers
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+        if summary:
+            self.client.report(f"{summary}.", "finished")
+
+    def settle(self, transfer, state):
+        #called with the lock held, returns a summary once the queue has run empty
+        transfer['state'] = state
+        self.finished[state] += 1
+        self.unfinished -= 1
+        if self.unfinished:
+            return None
+        summary = f"{self.finished['done']} done, {self.finished['failed']} failed"
+        self.finished = {'done': 0, 'failed': 0}
+        self.idle.notify_all()
+        return summary
+
+    def retry_failed(self):
+        with self.lock:
+            failed = [transfer for transfer in self.transfers if transfer['state'] == "failed"]
+            for transfer in failed:
+                #the old future already holds the failure, the new attempt gets a fresh one
+                transfer['state'] = "queued"
+                transfer['attempts'] = 0
+                transfer['future'] = concurrent.futures.Future()
+                self.unfinished += 1
+        for transfer in failed:
+            self.pending.put(transfer)
+        return len(failed)
+
+    def cancel(self):
+        #transfers still waiting for a worker or a retry are dropped, running ones end with the connection
+        summary = None
+        cancelled = []
+        with self.lock:
+            for transfer in self.transfers:
+                if transfer['state'] in ("queued", "waiting"):
+                    transfer['error'] = "Cancelled."
+                    summary = self.settle(transfer, "failed") or summary
+                    cancelled.append(transfer['future'])
+        for future in cancelled:
+            future.cancel()
+        if summary:
+            self.client.report(f"{summary}.", "finished")
+
+    def wait(self, timeout=None):
+        #blocks until every queued transfer has finished, returns False on timeout
+        with self.idle:
+            return self.idle.wait_for(lambda: self.unfinished == 0, timeout)
+
+    def snapshot(self):
+        with self.lock:
+            return [dict(transfer) for transfer in self.transfers]
+
+
+class FileClient:
+    #the protocol side of the client without any window: the blocking methods raise on failure and
+    #everything else that happens (progress messages, notifications, server errors) is reported as
+    #on_event(kind, message) with kind one of EVENT_KINDS, on the thread it happened on
+    def __init__(self, streams=DEFAULT_STREAMS, dedup=True, compression="zlib", concurrency=DEFAULT_CONCURRENCY, on_event=None):
+        self.on_event = on_event
+        self.client_socket = None  #framed connection to the server
+        self.server_ip = None
+        self.server_port = None
+        self.username = None
+        self.download_directory = None
+        self.listener_thread = None
+        self.listening = False
+        self.socket_lock = threading.Lock()  #to use threads safely with concurrency
+        self.pending_requests = {}  #request id -> state of a request waiting for its reply
+        self.pending_lock = threading.Lock()
+        self.request_ids = itertools.count(1)
+        #local copy of the server catalog kept current by pushed change events
+        self.mirror = {}  #(owner, filename) -> file entry
+        self.mirror_server = None
+        self.mirror_epoch = None
+        self.mirror_version = None
+        self.mirror_synced = False
+        self.mirror_lock = threading.Lock()  #the listener updates the mirror while callers read it
+        self.streams = streams  #connections used for one large transfer, 1 disables chunking
+        self.active_downloads = set()  #save paths being downloaded to, guarded by pending_lock
+        self.dedup = dedup  #offer the digest first so content the server already has is not sent
+        self.compression = compression  #preferred codec for transfers, None sends everything raw
+        self.server_codecs = []  #codecs the server announced when we connected
+        self.transfers = TransferManager(self, concurrency)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.client_socket:
+            self.disconnect()
+
+    def report(self, message, kind="log"):
+        if self.on_event:
+            self.on_event(kind, message)
+
+    def connect_to_server(self, ip, port, username):
+        #reports why it failed instead of raising, returns whether we are connected
+        try:
+            self.connect(ip, port, username)
+            return True
+        except Exception as e:
+            self.report(str(e), "error")
+            return False
+
+    def connect(self, ip, port, username):
+        #a busy server is asked again after the time it named, with some jitter
+        for attempt in range(BUSY_RETRIES + 1):
+            try:
+                return self.connect_once(ip, port, username)
+            except ServerBusy as busy:
+                if attempt == BUSY_RETRIES:
+                    raise
+                delay = backoff_delay(attempt + 1, busy.retry_after)
+                self.report(f"Server is busy, trying again in {delay:.1f}s.")
+                time.sleep(delay)
+
+    def connect_once(self, ip, port, username):
+        #raises ServerError when the server turns us away and ConnectionError when it cannot be reached
+        with self.socket_lock:
+            #close any existing socket
+            if self.client_socket:
+                try:
+                    self.client_socket.close()
+                except OSError:
+                    pass
+                self.client_socket = None
+
+            try:
+                #creating a new socket, with a timeout for the connection
+                sock = socket.create_connection((ip, port), timeout=10)
+            except ConnectionRefusedError:
+                raise ConnectionError("Server is not open.")
+            except OSError as e:
+                raise ConnectionError(f"Connection attempt failed: {e}")
+
+            try:
+                #setting a longer timeout for the handshake
+                sock.settimeout(60)
+                stream = FramedSocket(sock)
+
+                #sending username
+                stream.send_frame(HELLO, NO_REQUEST, username.encode())
+
+                #receiving a response
+                frame = stream.recv_frame()
+                if frame is None:
+                    raise ConnectionError("Server closed the connection.")
+                frame_type, _, payload = frame
+                hello = decode_message(payload)
+                if frame_type == ERROR:
+                    raise server_error(hello)
+                if frame_type != RESPONSE or hello.get("message") != "CONNECTED":
+                    raise ProtocolError(f"Unexpected response from server: {hello.get('message', '')}")
+            except (socket.timeout, ProtocolError) as e:
+                sock.close()
+                raise ConnectionError(f"Connection attempt failed: {e}")
+            except Exception:
+                sock.close()
+                raise
+
+            self.client_socket = stream
+            self.report(f"Connected to server as {username}.")
+            self.username = username
+            self.server_ip = ip
+            self.server_port = port
+            self.server_codecs = hello.get("codecs", [])
+
+            #the listener blocks until a frame arrives, a timeout could cut a frame in half
+            sock.settimeout(None)
+
+            #starting the listener thread
+            self.listening = True
+            self.listener_thread = threading.Thread(target=self.listen_to_server, daemon=True)
+            self.listener_thread.start()
+
+        #keeping the file list current without asking for it again
+        self.subscribe()
+
+    def send_request(self, command, state=None, **fields):
+        #registering the request before sending it so the reply can never arrive first
+        #the state dict itself is registered so the caller sees what the listener fills in
+        request_id = next(self.request_ids)
+        request = state if state is not None else {}
+        request['command'] = command
+        with self.pending_lock:
+            self.pending_requests[request_id] = request
+        try:
+            self.client_socket.send_message(REQUEST, request_id, command=command, **fields)
+        except Exception:
+            self.finish_request(request_id)
+            raise
+        return request_id
+
+    def finish_request(self, request_id):
+        with self.pending_lock:
+            request = self.pending_requests.pop(request_id, None)
+        if request and request.get('file'):
+            request['file'].close()
+        if request and request.get('reply'):
+            #wakes up a caller that is still waiting, e.g. when the connection is lost
+            request['reply']['event'].set()
+        if request and request.get('event'):
+            request['event'].set()
+        return request
+
+    def call(self, command, **fields):
+        #sends a request and blocks until the listener thread hands over its reply
+        reply = {'event': threading.Event(), 'frame': None}
+        request_id = self.send_request(command, {'reply': reply}, **fields)
+        if not reply['event'].wait(REPLY_TIMEOUT):
+            self.finish_request(request_id)
+            raise TimeoutError(f"No reply to {command} from the server.")
+        if reply['frame'] is None:
+            raise ConnectionError("Connection lost before the server replied.")
+        frame_type, message = reply['frame']
+        if frame_type == ERROR:
+            raise server_error(message)
+        return message
+
+    def listen_to_server(self):
+        while self.listening and self.client_socket:
+            try:
+                frame = self.client_socket.recv_frame()
+                if frame is None:
+                    #disconnect() already reported it when we closed the connection ourselves
+                    if self.listening:
+                        self.disconnect()
+                    break
+
+                frame_type, request_id, payload = frame
+
+                #if the server is shutdown
+                if frame_type == SHUTDOWN:
+                    shutdown_msg = decode_message(payload).get("message", "")
+                    self.report(shutdown_msg, "shutdown")
+                    self.disconnect()
+                    break
+
+                #handling notifications (e.g., file downloaded)
+                if frame_type == NOTIFICATION:
+                    message = decode_message(payload)
+                    notification = message.get("message", "")
+                    #the server merges identical notifications that queued up while we were slow to read
+                    if message.get("repeat", 1) > 1:
+                        notification += f" ({message['repeat']} times)"
+                    self.report(notification, "notification")
+                    continue  #continue to next message
+
+                #everything else answers one of our requests
+                with self.pending_lock:
+                    request = self.pending_requests.get(request_id)
+                if request is None:
+                    self.report(f"Ignoring {FRAME_NAMES[frame_type]} frame for unknown request {request_id}.")
+                    continue
+                self.handle_reply(request_id, request, frame_type, payload)
+            except ProtocolError as e:
+                self.report(f"Protocol error: {e}", "error")
+                self.disconnect()
+                break
+            except (ConnectionResetError, OSError):
+                self.report("Connection lost.", "error")
+                self.disconnect()
+                break
+            except Exception as e:
+                self.report(f"Error receiving message: {e}", "error")
+                self.disconnect()
+                break
+
+    def handle_reply(self, request_id, request, frame_type, payload):
+        #frames answering a request, from the control connection or from a data connection
+        if 'reply' in request:
+            request['reply']['frame'] = (frame_type, decode_message(payload))
+            self.finish_request(request_id)
+            return
+
+        if frame_type == ERROR:
+            error = decode_message(payload)
+            error_message = error.get("message", "")
+            if 'error' in request:
+                #run_on_stream and list_page raise it to whoever made the request, it is set before
+                #finish_request wakes up a waiting caller
+                request['error'] = server_error(error)
+            self.finish_request(request_id)
+            if 'error' in request:
+                return
+            if request['command'] == "SUBSCRIBE":
+                #a dropped subscription continues from the last version we applied
+                self.mirror_synced = False
+                self.subscribe()
+                return
+            self.report(error_message, "error")
+            return
+
+        if request['command'] == "DOWNLOAD":
+            self.handle_download_frame(request_id, request, frame_type, payload)
+            return
+        if request['command'] in ("DOWNLOAD_BATCH", "DOWNLOAD_ARCHIVE"):
+            self.handle_batch_frame(request_id, request, frame_type, payload)
+            return
+        if request['command'] == "LIST":
+            self.handle_list_frame(request_id, request, frame_type, payload)
+            return
+        if request['command'] == "SUBSCRIBE":
+            self.handle_subscription_frame(request_id, request, frame_type, payload)
+            return
+
+        if frame_type != RESPONSE:
+            self.report(f"Unexpected {FRAME_NAMES[frame_type]} frame for request {request_id}.")
+            return
+        self.finish_request(request_id)
+        response = decode_message(payload)
+        request['done'] = True
+
+        #handling upload 
+        if request['command'] in ("UPLOAD", "FINISH_UPLOAD"):
+            self.show_upload_result(request['filename'], response)
+
+        elif request['command'] == "UPLOAD_BATCH":
+            self.report(response.get("message", ""))
+            overwritten = [entry['filename'] for entry in response.get("files", []) if entry.get("overwritten")]
+            if overwritten:
+                self.report(f"Overwritten on the server: {', '.join(overwritten)}")
+
+        else:
+            self.report(response.get("message", ""))
+
+    def show_upload_result(self, filename, response):
+        #the transfer manager shows one popup when its queue is done instead of one per file
+        self.report(response.get("message", ""))
+        if response.get("overwritten"):
+            self.report(f"The file '{filename}' has been overwritten on the server.")
+
+    def subscribe(self):
+        try:
+            #a mirror of the same server resumes from its version, otherwise a snapshot is sent
+            server = (self.server_ip, self.server_port)
+            if self.mirror_server != server:
+                self.mirror = {}
+                self.mirror_server = server
+                self.mirror_epoch = None
+                self.mirror_version = None
+            self.mirror_synced = False
+            self.send_request("SUBSCRIBE", {'snapshot': None}, since=self.mirror_version, epoch=self.mirror_epoch)
+        except Exception as e:
+            self.report(f"Error subscribing to file list changes: {e}", "error")
+
+    def handle_subscription_frame(self, request_id, subscription, frame_type, payload):
+        if frame_type == RESPONSE:
+            header = decode_message(payload)
+            self.mirror_epoch = header.get("epoch")
+            self.mirror_version = header.get("version")
+            if header.get("mode") == "snapshot":
+                #the snapshot is collected separately and replaces the mirror once complete
+                subscription['snapshot'] = {}
+            else:
+                self.mirror_synced = True
+
+        elif frame_type == DATA:
+            for entry in decode_message(payload).get("files", []):
+                subscription['snapshot'][(entry['owner'], entry['filename'])] = entry
+
+        elif frame_type == END:
+            if subscription['snapshot'] is not None:
+                with self.mirror_lock:
+                    self.mirror = subscription['snapshot']
+                subscription['snapshot'] = None
+                self.mirror_synced = True
+            else:
+                #the server ended the subscription
+                self.finish_request(request_id)
+                self.mirror_synced = False
+
+        elif frame_type == EVENT:
+            event = decode_message(payload)
+            key = (event['owner'], event['filename'])
+            #an overwritten file moves to the end like on the server
+            with self.mirror_lock:
+                self.mirror.pop(key, None)
+                if event['event'] != "DELETE":
+                    self.mirror[key] = {name: event[name] for name in ('filename', 'owner', 'size', 'mtime')}
+                self.mirror_version = event['version']
+
+    def handle_list_frame(self, request_id, listing, frame_type, payload):
+        #the page arrives as a header, batches of entries and an END frame
+        if frame_type == RESPONSE:
+            header = decode_message(payload)
+            listing['total'] = header.get("total", 0)
+            listing['next_cursor'] = header.get("next_cursor")
+
+        elif frame_type == DATA:
+            listing['entries'].extend(decode_message(payload).get("files", []))
+
+        elif frame_type == END:
+            listing['done'] = True
+            self.finish_request(request_id)
+
+    def handle_download_frame(self, request_id, download, frame_type, payload):
+        try:
+            #handling file download 
+            if frame_type == RESPONSE:
+                header = decode_message(payload)
+                download['file_size'] = int(header["size"])
+                offset = int(header.get("offset", 0))
+                part_path = download['save_path'] + PARTIAL_SUFFIX
+                #the server starts over when the file changed since the partial copy was made
+                if offset:
+                    download['file'] = open(part_path, "r+b")
+                    download['file'].seek(offset)
+                    download['file'].truncate()
+                    self.report(f"Resuming download of '{download['filename']}' at byte {offset}...")
+                else:
+                    download['file'] = open(part_path, "wb")
+                    self.report(f"Downloading file '{download['filename']}'...")
+                    with open(part_path + ".json", "w") as f:
+                        json.dump({'owner': download['owner'], 'etag': header.get("etag")}, f)
+                download['bytes_received'] = offset
+                download['offset'] = offset
+                download['codec'] = header.get("codec")
+                download['decompressor'] = CODECS[download['codec']][1]() if download['codec'] else None
+
+            #handling the file data
+            elif frame_type == DATA:
+                if download['decompressor']:
+                    data, cpu = decompress_block(download['decompressor'], payload)
+                    download['wire_bytes'] += len(payload)
+                    download['cpu'] += cpu
+                    payload = data
+                download['file'].write(payload)
+                download['bytes_received'] += len(payload)
+                if download['progress']:
+                    download['progress'](download['bytes_received'], download['file_size'])
+
+            elif frame_type == END:
+                self.finish_request(request_id)
+                complete = download['bytes_received'] == download['file_size']
+                if download['decompressor']:
+                    complete = complete and download['decompressor'].eof
+                    raw_bytes = download['bytes_received'] - download['offset']
+                    self.report(f"Download of '{download['filename']}' compressed with "
+                                       f"{describe_savings(download['codec'], raw_bytes, download['wire_bytes'], download['cpu'])}")
+                if complete:
+                    part_path = download['save_path'] + PARTIAL_SUFFIX
+                    os.replace(part_path, download['save_path'])
+                    os.remove(part_path + ".json")
+                    download['done'] = True
+                    self.report(f"File '{download['filename']}' downloaded successfully.")
+                else:
+                    download['error'] = ConnectionError("The download ended early.")
+        except Exception as e:
+            download['error'] = e
+            self.finish_request(request_id)
+
+    def handle_batch_frame(self, request_id, batch, frame_type, payload):
+        #the data of a batch or archive download is split into its target files by their sizes
+        try:
+            if frame_type == RESPONSE:
+                header = decode_message(payload)
+                if batch['command'] == "DOWNLOAD_ARCHIVE":
+                    batch['targets'] = [(batch['save_path'], header["size"])]
+                    self.report(f"Downloading {header['count']} files as '{os.path.basename(batch['save_path'])}'...")
+                else:
+                    batch['targets'] = []
+                    for entry in header["files"]:
+                        if 'error' in entry:
+                            self.report(f"Skipping '{entry['filename']}' from '{entry['owner']}': {entry['error']}", "error")
+                        else:
+                            batch['targets'].append((save_path_in(batch['directory'], entry['filename']), entry['size']))
+                    self.report(f"Downloading {len(batch['targets'])} files in one batch...")
+                batch['total'] = sum(size for _, size in batch['targets'])
+                self.next_batch_target(batch)
+
+            elif frame_type == DATA:
+                view = memoryview(payload)
+                while view:
+                    if batch['file'] is None:
+                        raise ValueError("Received more data than announced.")
+                    count = min(len(view), batch['remaining'])
+                    batch['file'].write(view[:count])
+                    view = view[count:]
+                    batch['remaining'] -= count
+                    batch['received'] += count
+                    self.next_batch_target(batch)
+                if batch['progress']:
+                    batch['progress'](batch['received'], batch['total'])
+
+            elif frame_type == END:
+                self.finish_request(request_id)
+                if batch['file'] is not None or batch['index'] < len(batch['targets']):
+                    batch['error'] = ConnectionError("The download ended early.")
+                    return
+                batch['done'] = True
+                if batch['command'] == "DOWNLOAD_ARCHIVE":
+                    self.report(f"Archive '{batch['save_path']}' downloaded successfully.")
+                else:
+                    self.report(f"{len(batch['targets'])} files downloaded successfully.")
+        except Exception as e:
+            batch['error'] = e
+            self.finish_request(request_id)
+
+    def next_batch_target(self, batch):
+        #a finished file gets its final name, then the next one is opened; empty files are done at once
+        if batch['file'] is not None and batch['remaining'] == 0:
+            batch['file'].close()
+            batch['file'] = None
+            save_path = batch['targets'][batch['index']][0]
+            os.replace(save_path + PARTIAL_SUFFIX, save_path)
+            batch['index'] += 1
+        while batch['file'] is None and batch['index'] < len(batch['targets']):
+            save_path, size = batch['targets'][batch['index']]
+            batch['file'] = open(save_path + PARTIAL_SUFFIX, "wb")
+            batch['remaining'] = size
+            if size:
+                return
+            batch['file'].close()
+            batch['file'] = None
+            os.replace(save_path + PARTIAL_SUFFIX, save_path)
+            batch['index'] += 1
+
+    def disconnect(self):
+        try:
+            self.listening = False
+            #queued transfers would only fail one by one without a connection
+            self.transfers.cancel()
+            with self.socket_lock:
+                if self.client_socket:
+                    try:
+                        self.client_socket.send_message(REQUEST, next(self.request_ids), command="DISCONNECT")
+                    except:
+                        pass
+                    self.client_socket.close()
+                    self.client_socket = None
+            #closing any open download files
+            with self.pending_lock:
+                request_ids = list(self.pending_requests)
+            for request_id in request_ids:
+                self.finish_request(request_id)
+            #the mirror is kept so a reconnect only needs the changes since mirror_version
+            self.mirror_synced = False
+            self.report("Disconnected from server.")
+            self.username = None  #reset username
+        except Exception as e:
+            self.report(f"Error disconnecting: {e}", "error")
+            self.client_socket = None  #ensure client_socket is reset
+            self.username = None  #reset username
+
+    def upload_file(self, file_path, progress=None):
+        #blocks until the upload is over, returns the filename on the server and raises when it failed;
+        #progress(sent, size) is called as the file goes out. the transfer manager runs it on its worker threads
+        if not self.client_socket:
+            raise ConnectionError("Not connected to a server.")
+        filename = os.path.basename(file_path)
+        if not os.path.exists(file_path) or not filename.strip():
+            raise ValueError("Invalid file path or filename.")
+        progress = progress or (lambda sent, size: None)
+
+        #getting the file size
+        stat = os.stat(file_path)
+        file_size = stat.st_size
+
+        #size and modification time identify this version of the file, the server only
+        #continues an interrupted upload of the same version
+        validator = f"{file_size}-{stat.st_mtime_ns}"
+        if self.dedup:
+            reply = self.call("UPLOAD_DIGEST", filename=filename, size=file_size, digest=file_digest(file_path))
+            if reply.get("stored"):
+                self.report(f"'{filename}' was already stored on the server, no data had to be sent.")
+                self.show_upload_result(filename, reply)
+                progress(file_size, file_size)
+                return filename
+        if self.streams > 1 and file_size >= PARALLEL_THRESHOLD:
+            self.upload_file_parallel(file_path, filename, file_size, validator, progress)
+            return filename
+        offset = self.call("UPLOAD_STATUS", filename=filename, size=file_size, validator=validator)["offset"]
+
+        #notifying the server about the upload, including the file size
+        if offset:
+            self.report(f"Resuming upload of '{filename}' at byte {offset}...")
+        else:
+            self.report(f"Uploading file '{filename}'...")
+        codec = self.upload_codec(file_path, file_size - offset)
+
+        def send_content(stream, request_id):
+            #sending the file content as data frames of the request
+            with open(file_path, "rb") as f:
+                wire_bytes, cpu = self.send_file_data(stream, request_id, f, offset, file_size - offset, codec,
+                                                      lambda sent: progress(offset + sent, file_size))
+            stream.send_frame(END, request_id)
+            if codec:
+                self.report(f"Upload of '{filename}' compressed with {describe_savings(codec, file_size - offset, wire_bytes, cpu)}")
+
+        progress(offset, file_size)
+        self.run_on_stream({'command': "UPLOAD", 'filename': filename}, send_content, filename=filename, size=file_size,
+                           offset=offset, validator=validator, codec=codec)
+        return filename
+
+    def upload_file_parallel(self, file_path, filename, file_size, validator, progress):
+        #the server reports the chunks it still needs, they are sent over several streams at once
+        session = self.call("OPEN_UPLOAD", filename=filename, size=file_size, validator=validator, chunk_size=TRANSFER_CHUNK_SIZE)
+        chunk_size = session["chunk_size"]
+        missing = session["missing"]
+        if len(missing) < session["chunks"]:
+            self.report(f"Resuming upload of '{filename}', {len(missing)} of {session['chunks']} chunks left...")
+        else:
+            self.report(f"Uploading file '{filename}' over {min(self.streams, len(missing))} streams...")
+
+        #every chunk is compressed on its own so the server can decompress it independently
+        codec = self.upload_codec(file_path, file_size)
+        totals = {'raw': 0, 'wire': 0, 'cpu': 0.0}
+        totals_lock = threading.Lock()
+        held = file_size - sum(min(chunk_size, file_size - index * chunk_size) for index in missing)
+        progress(held, file_size)
+
+        def upload_chunk(stream, request_id, index):
+            start = index * chunk_size
+            count = min(chunk_size, file_size - start)
+            stream.send_message(REQUEST, request_id, command="UPLOAD_CHUNK", session=session["session"], index=index, codec=codec)
+            with open(file_path, "rb") as f:
+                wire_bytes, cpu = self.send_file_data(stream, request_id, f, start, count, codec)
+            stream.send_frame(END, request_id)
+            self.expect_reply(stream, request_id)
+            with totals_lock:
+                totals['raw'] += count
+                totals['wire'] += wire_bytes
+                totals['cpu'] += cpu
+                progress(held + totals['raw'], file_size)
+
+        errors = self.run_streams(missing, upload_chunk)
+        if codec:
+            self.report(f"Upload of '{filename}' compressed with {describe_savings(codec, totals['raw'], totals['wire'], totals['cpu'])}")
+        if errors:
+            #the chunks that made it stay with the server for the next attempt
+            raise errors[0]
+        #the server hashes the whole file before it answers, so this waits on a data connection too
+        self.run_on_stream({'command': "FINISH_UPLOAD", 'filename': filename}, session=session["session"])
+
+    def upload_codec(self, file_path, count):
+        #compressing only pays off for data that shrinks, a sample of the file tells
+        if self.compression not in self.server_codecs or count < MIN_COMPRESS_SIZE:
+            return None
+        return self.compression if is_compressible(file_path) else None
+
+    def download_codecs(self):
+        return [self.compression] if self.compression in self.server_codecs else []
+
+    def send_file_data(self, stream, request_id, f, offset, count, codec, progress=None):
+        #sends count bytes of f as data frames and returns (bytes on the wire, cpu seconds compressing);
+        #progress(sent) gets the number of file bytes sent so far
+        if not codec:
+            if not progress:
+                stream.send_file(request_id, f, offset, count)
+                return count, 0.0
+            sent = 0
+            while sent < count:
+                size = min(PROGRESS_BLOCK_SIZE, count - sent)
+                stream.send_file(request_id, f, offset + sent, size)
+                sent += size
+                progress(sent)
+            return count, 0.0
+        compressor = CODECS[codec][0]()
+        f.seek(offset)
+        total = count
+        wire_bytes = 0
+        cpu = 0.0
+        while count:
+            block = f.read(min(COMPRESS_BLOCK_SIZE, count))
+            if not block:
+                raise ValueError("File changed size while it was being sent.")
+            count -= len(block)
+            output, used = compress_block(compressor, block, not count)
+            cpu += used
+            for piece in frame_slices(output):
+                stream.send_frame(DATA, request_id, piece)
+                wire_bytes += len(piece)
+            if progress:
+                progress(total - count)
+        return wire_bytes, cpu
+
+    def upload_batch(self, file_paths, progress=None):
+        #many small files in one request, the data frames carry their contents one after another
+        if not self.client_socket:
+            raise ConnectionError("Not connected to a server.")
+        files = [{'filename': os.path.basename(file_path), 'size': os.path.getsize(file_path)} for file_path in file_paths]
+        total = sum(entry['size'] for entry in files)
+        progress = progress or (lambda sent, size: None)
+
+        def send_contents(stream, request_id):
+            sent = 0
+            for file_path, entry in zip(file_paths, files):
+                with open(file_path, "rb") as f:
+                    stream.send_file(request_id, f, 0, entry['size'])
+                sent += entry['size']
+                progress(sent, total)
+            stream.send_frame(END, request_id)
+
+        self.report(f"Uploading {len(files)} files in one batch...")
+        self.run_on_stream({'command': "UPLOAD_BATCH"}, send_contents, files=files)
+        return [entry['filename'] for entry in files]
+
+    def download_batch(self, files, directory, progress=None):
+        #files are (owner, filename) pairs, all of them arrive on one data connection
+        if not self.client_socket:
+            raise ConnectionError("Not connected to a server.")
+        batch = {'command': "DOWNLOAD_BATCH", 'directory': directory, 'progress': progress}
+        self.run_batch_download(batch, files=[{'owner': owner, 'filename': filename} for owner, filename in files])
+        return [save_path for save_path, _ in batch['targets']]
+
+    def download_archive(self, save_path, owner=None, pattern=None, progress=None):
+        #every file of owner (or of everyone) matching pattern as one tar file
+        if not self.client_socket:
+            raise ConnectionError("Not connected to a server.")
+        batch = {'command': "DOWNLOAD_ARCHIVE", 'save_path': save_path, 'progress': progress}
+        self.run_batch_download(batch, owner=owner, pattern=pattern)
+        return save_path
+
+    def run_batch_download(self, batch, **fields):
+        batch.update({'targets': [], 'index': 0, 'file': None, 'remaining': 0, 'received': 0, 'total': 0})
+        try:
+            self.run_on_stream(batch, **fields)
+        except Exception:
+            #the file that was being written is incomplete, the finished ones are kept
+            if batch['index'] < len(batch['targets']):
+                try:
+                    os.remove(batch['targets'][batch['index']][0] + PARTIAL_SUFFIX)
+                except FileNotFoundError:
+                    pass
+            raise
+
+    def queue_uploads(self, file_paths):
+        #small files go to the server in batches, the others one by one with resume and dedup;
+        #returns the futures of the transfers
+        small = [file_path for file_path in file_paths if os.path.getsize(file_path) < BATCH_FILE_SIZE]
+        batched = set(small)
+        futures = []
+        for file_path in file_paths:
+            if file_path not in batched:
+                futures.append(self.transfers.add_upload(file_path))
+        for group in self.batch_groups(small, os.path.getsize):
+            if len(group) == 1:
+                futures.append(self.transfers.add_upload(group[0]))
+            else:
+                futures.append(self.transfers.add_upload_batch(group))
+        return futures
+
+    def queue_downloads(self, filenames, owner, directory, sizes=None):
+        #sizes come from the mirror unless given, files of unknown size are downloaded one by one;
+        #returns the futures of the transfers
+        if sizes is None:
+            with self.mirror_lock:
+                sizes = {filename: self.mirror[(owner, filename)]['size'] for filename in filenames if (owner, filename) in self.mirror}
+        small = [filename for filename in filenames if sizes.get(filename) is not None and sizes[filename] < BATCH_FILE_SIZE]
+        batched = set(small)
+        futures = []
+        for filename in filenames:
+            if filename not in batched:
+                futures.append(self.transfers.add_download(filename, owner, directory))
+        for group in self.batch_groups(small, sizes.get):
+            if len(group) == 1:
+                futures.append(self.transfers.add_download(group[0], owner, directory))
+            else:
+                futures.append(self.transfers.add_download_batch(group, owner, directory))
+        return futures
+
+    def batch_groups(self, items, size_of):
+        group = []
+        group_bytes = 0
+        for item in items:
+            size = size_of(item)
+            if group and (len(group) == BATCH_MAX_FILES or group_bytes + size > BATCH_MAX_BYTES):
+                yield group
+                group = []
+                group_bytes = 0
+            group.append(item)
+            group_bytes += size
+        if group:
+            yield group
+
+    def run_on_stream(self, request, send_data=None, **fields):
+        #runs one request on a data connection of its own and blocks until it is answered; the
+        #reply frames go through the same handlers as on the control connection, which stays
+        #free for listings, notifications and other transfers in the meantime
+        stream = self.open_streams(1)[0]
+        request_id = next(self.request_ids)
+        request['error'] = None
+        with self.pending_lock:
+            self.pending_requests[request_id] = request
+        try:
+            stream.send_message(REQUEST, request_id, command=request['command'], **fields)
+            if send_data:
+                send_data(stream, request_id)
+            while request_id in self.pending_requests:
+                frame = stream.recv_frame()
+                if frame is None:
+                    raise ConnectionError("Server closed the data connection.")
+                frame_type, reply_id, payload = frame
+                if reply_id != request_id:
+                    raise ProtocolError(f"Unexpected {FRAME_NAMES[frame_type]} frame on data connection.")
+                self.handle_reply(request_id, request, frame_type, payload)
+            if request['error']:
+                raise request['error']
+            if not request.get('done'):
+                raise ConnectionError("The transfer was interrupted.")
+        finally:
+            self.finish_request(request_id)
+            self.close_streams([stream])
+
+    def open_streams(self, count):
+        #data connections for one transfer, they join this session with a transfer token from the server
+        grant = self.call("OPEN_STREAMS")
+        streams = []
+        try:
+            for _ in range(min(count, grant["max_streams"])):
+                sock = socket.create_connection((self.server_ip, self.server_port), timeout=10)
+                sock.settimeout(STREAM_TIMEOUT)
+                stream = FramedSocket(sock)
+                streams.append(stream)
+                stream.send_message(REQUEST, 1, command="ATTACH", token=grant["token"])
+                self.expect_reply(stream, 1)
+        except Exception:
+            self.close_streams(streams)
+            raise
+        return streams
+
+    def close_streams(self, streams):
+        for stream in streams:
+            try:
+                stream.send_message(REQUEST, NO_REQUEST, command="DISCONNECT")
+            except OSError:
+                pass
+            stream.close()
+
+    def expect_reply(self, stream, request_id):
+        #streams carry one request at a time, so the next frame is its reply
+        frame = stream.recv_frame()
+        if frame is None:
+            raise ConnectionError("Server closed the stream.")
+        frame_type, reply_id, payload = frame
+        if frame_type == ERROR:
+            raise server_error(decode_message(payload))
+        if frame_type != RESPONSE or reply_id != request_id:
+            raise ProtocolError(f"Unexpected {FRAME_NAMES[frame_type]} frame on stream.")
+        return decode_message(payload)
+
+    def run_streams(self, chunks, transfer):
+        #every stream takes the next chunk until none are left, a failed stream stops and its
+        #chunk stays missing; returns the errors of the failed streams
+        if not chunks:
+            return []
+        pending = queue.SimpleQueue()
+        for index in chunks:
+            pending.put(index)
+        errors = []
+
+        def work(stream):
+            request_ids = itertools.count(2)
+            try:
+                while True:
+                    try:
+                        index = pending.get_nowait()
+                    except queue.Empty:
+                        return
+                    transfer(stream, next(request_ids), index)
+            except Exception as e:
+                errors.append(e)
+
+        streams = self.open_streams(min(self.streams, len(chunks)))
+        try:
+            threads = [threading.Thread(target=work, args=(stream,), daemon=True) for stream in streams]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            self.close_streams(streams)
+        if not errors and not pending.empty():
+            errors.append(ConnectionError("No stream could be opened."))
+        return errors
+
+    def list_page(self, owner=None, pattern=None, sort=None, page_size=LIST_PAGE_SIZE, cursor=None):
+        #blocks until one page of the catalog has arrived, returns (entries, cursor of the next page
+        #or None, number of matching files)
+        if not self.client_socket:
+            raise ConnectionError("Not connected to a server.")
+        listing = {'entries': [], 'event': threading.Event(), 'error': None}
+        request_id = self.send_request("LIST", listing, owner=owner, pattern=pattern, sort=sort, page_size=page_size, cursor=cursor)
+        if not listing['event'].wait(REPLY_TIMEOUT):
+            self.finish_request(request_id)
+            raise TimeoutError("No reply to LIST from the server.")
+        if listing['error']:
+            raise listing['error']
+        if not listing.get('done'):
+            raise ConnectionError("Connection lost before the server replied.")
+        return listing['entries'], listing['next_cursor'], listing['total']
+
+    def list_files(self, owner=None, pattern=None, sort=None):
+        #every matching file, page after page
+        entries, cursor, _ = self.list_page(owner, pattern, sort)
+        while cursor is not None:
+            page, cursor, _ = self.list_page(owner, pattern, sort, cursor=cursor)
+            entries.extend(page)
+        return entries
+
+    def mirror_files(self):
+        #the files of the mirror, or None while it is not current
+        if not self.mirror_synced:
+            return None
+        with self.mirror_lock:
+            return list(self.mirror.values())
+
+    def match_files(self, owner, names):
+        #patterns are expanded against the mirror of the catalog, plain names are taken as they are
+        filenames = []
+        for name in names:
+            if not any(character in name for character in "*?["):
+                filenames.append(name)
+                continue
+            with self.mirror_lock:
+                matches = sorted(filename for file_owner, filename in self.mirror if file_owner == owner and fnmatch.fnmatchcase(filename, name))
+            filenames.extend(matches)
+        return list(dict.fromkeys(filenames))
+
+    def download_file(self, filename, owner, directory=None, progress=None):
+        #blocks until the download is over, returns where the file was saved and raises when it failed;
+        #the partial file is kept so the next attempt resumes. progress(received, size) is called as the data arrives
+        if not self.client_socket:
+            raise ConnectionError("Not connected to a server.")
+        directory = directory or self.download_directory
+        if not directory:
+            raise ValueError("Download directory not set.")
+        save_path = save_path_in(directory, filename)
+
+        #two downloads must not write to the same file
+        with self.pending_lock:
+            busy = save_path in self.active_downloads
+            self.active_downloads.add(save_path)
+        if busy:
+            raise ValueError(f"'{filename}' is already being downloaded.")
+        try:
+
+            #tracking the download until its END frame
+            download = {
+                'command': "DOWNLOAD",
+                'filename': filename,
+                'owner': owner,
+                'save_path': save_path,
+                'file_size': 0,
+                'bytes_received': 0,
+                'file': None,
+                'wire_bytes': 0,
+                'cpu': 0.0,
+                'progress': progress,
+            }
+
+            self.report(f"Initiated download for '{filename}' from '{owner}'.")
+            #large files are fetched in chunks over several streams
+            if self.streams > 1:
+                info = self.call("STAT", filename=filename, owner=owner)
+                if info["size"] >= PARALLEL_THRESHOLD:
+                    self.download_file_parallel(filename, owner, save_path, info, progress)
+                    return save_path
+
+            #a partial copy of an earlier attempt is continued if the file did not change on the server
+            offset, etag = self.partial_download(save_path, owner)
+            self.run_on_stream(download, filename=filename, owner=owner, offset=offset, if_range=etag,
+                               codecs=self.download_codecs())
+            return save_path
+        finally:
+            with self.pending_lock:
+                self.active_downloads.discard(save_path)
+
+    def partial_download(self, save_path, owner):
+        #returns (bytes already downloaded, version they belong to)
+        part_path = save_path + PARTIAL_SUFFIX
+        try:
+            with open(part_path + ".json", "r") as f:
+                partial = json.load(f)
+            offset = os.path.getsize(part_path)
+        except (OSError, ValueError):
+            return 0, None
+        if partial.get("owner") != owner or not partial.get("etag") or "done" in partial:
+            return 0, None
+        return offset, partial["etag"]
+
+    def download_file_parallel(self, filename, owner, save_path, info, progress=None):
+        part_path = save_path + PARTIAL_SUFFIX
+        size = info["size"]
+        etag = info["etag"]
+        chunks = (size + TRANSFER_CHUNK_SIZE - 1) // TRANSFER_CHUNK_SIZE
+        done = self.partial_chunks(part_path, owner, etag)
+        with open(part_path, "r+b" if done else "wb") as f:
+            f.truncate(size)
+        done = done or set()
+        done_lock = threading.Lock()
+        totals = {'raw': 0, 'wire': 0, 'cpu': 0.0}
+        self.save_download_manifest(part_path, owner, etag, done)
+        missing = [index for index in range(chunks) if index not in done]
+        progress = progress or (lambda received, size: None)
+        progress(min(len(done) * TRANSFER_CHUNK_SIZE, size), size)
+        if done:
+            self.report(f"Resuming download of '{filename}', {len(missing)} of {chunks} chunks left...")
+        else:
+            self.report(f"Downloading file '{filename}' over {min(self.streams, chunks)} streams...")
+
+        def download_chunk(stream, request_id, index):
+            start = index * TRANSFER_CHUNK_SIZE
+            count = min(TRANSFER_CHUNK_SIZE, size - start)
+            stream.send_message(REQUEST, request_id, command="DOWNLOAD", filename=filename, owner=owner,
+                                offset=start, length=count, if_range=etag, codecs=self.download_codecs())
+            header = self.expect_reply(stream, request_id)
+            if header.get("etag") != etag or header.get("offset") != start:
+                raise ValueError(f"'{filename}' changed on the server, download it again")
+            codec = header.get("codec")
+            decompressor = CODECS[codec][1]() if codec else None
+            wire_bytes = 0
+            cpu = 0.0
+            #each chunk is written at its own position of the partial file
+            with open(part_path, "r+b") as f:
+                f.seek(start)
+                while True:
+                    frame = stream.recv_frame()
+                    if frame is None:
+                        raise ConnectionError("Server closed the stream.")
+                    frame_type, _, payload = frame
+                    if frame_type == END:
+                        break
+                    if frame_type != DATA:
+                        raise ProtocolError(f"Unexpected {FRAME_NAMES[frame_type]} frame on stream.")
+                    wire_bytes += len(payload)
+                    if decompressor:
+                        payload, used = decompress_block(decompressor, payload)
+                        cpu += used
+                    f.write(payload)
+                if f.tell() != start + count or (decompressor and not decompressor.eof):
+                    raise ConnectionError("Chunk ended early.")
+            with done_lock:
+                totals['raw'] += count
+                totals['wire'] += wire_bytes
+                totals['cpu'] += cpu
+                done.add(index)
+                self.save_download_manifest(part_path, owner, etag, done)
+                progress(min(len(done) * TRANSFER_CHUNK_SIZE, size), size)
+
+        errors = self.run_streams(missing, download_chunk)
+        if totals['wire'] < totals['raw']:
+            self.report(f"Download of '{filename}' compressed with "
+                               f"{describe_savings(self.compression, totals['raw'], totals['wire'], totals['cpu'])}")
+        if errors:
+            #the manifest keeps the finished chunks for the next attempt
+            raise errors[0]
+        os.replace(part_path, save_path)
+        os.remove(part_path + ".json")
+        self.report(f"File '{filename}' downloaded successfully.")
+
+    def partial_chunks(self, part_path, owner, etag):
+        #chunks of an earlier attempt at the same file version, None when there is nothing to continue
+        try:
+            with open(part_path + ".json", "r") as f:
+                partial = json.load(f)
+            held = os.path.getsize(part_path)
+        except (OSError, ValueError):
+            return None
+        if partial.get("owner") != owner or partial.get("etag") != etag:
+            return None
+        if partial.get("chunk_size") == TRANSFER_CHUNK_SIZE:
+            return set(partial.get("done", []))
+        if "chunk_size" not in partial:
+            #an interrupted single-stream download covers the chunks below its size
+            return set(range(held // TRANSFER_CHUNK_SIZE))
+        return None
+
+    def save_download_manifest(self, part_path, owner, etag, done):
+        with open(part_path + ".json", "w") as f:
+            json.dump({'owner': owner, 'etag': etag, 'chunk_size': TRANSFER_CHUNK_SIZE, 'done': sorted(done)}, f)
+
+    def delete_file(self, filename):
+        #raises ServerError when the file cannot be deleted
+        return self.call("DELETE", filename=filename).get("message", "")
+
+    def delete_files(self, filenames):
+        #one request per batch, returns (deleted filenames, filename -> why it could not be deleted)
+        deleted = []
+        errors = {}
+        for start in range(0, len(filenames), BATCH_MAX_FILES):
+            reply = self.call("DELETE_BATCH", filenames=filenames[start:start + BATCH_MAX_FILES])
+            deleted.extend(reply.get("deleted", []))
+            errors.update(reply.get("errors", {}))
+        return deleted, errors
+
+    def request_stats(self):
+        return self.call("STATS")["stats"]
+
+
+class AsyncFileClient:
+    #the same client for asyncio code: transfers are awaited through the futures of the transfer
+    #manager, the other blocking calls run on the default executor so the event loop is never held up
+    def __init__(self, client=None, **options):
+        self.client = client or FileClient(**options)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.disconnect()
+
+    async def run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+    async def connect(self, ip, port, username):
+        await self.run(self.client.connect, ip, port, username)
+
+    async def disconnect(self):
+        if self.client.client_socket:
+            await self.run(self.client.disconnect)
+
+    async def upload(self, file_path):
+        return await asyncio.wrap_future(self.client.transfers.add_upload(file_path))
+
+    async def download(self, filename, owner, directory):
+        return await asyncio.wrap_future(self.client.transfers.add_download(filename, owner, directory))
+
+    async def upload_files(self, file_paths):
+        #batched like queue_uploads, returns the results or exceptions of its transfers
+        futures = await self.run(self.client.queue_uploads, file_paths)
+        return await asyncio.gather(*(asyncio.wrap_future(future) for future in futures), return_exceptions=True)
+
+    async def download_files(self, filenames, owner, directory, sizes=None):
+        futures = await self.run(self.client.queue_downloads, filenames, owner, directory, sizes)
+        return await asyncio.gather(*(asyncio.wrap_future(future) for future in futures), return_exceptions=True)
+
+    async def download_archive(self, save_path, owner=None, pattern=None):
+        return await asyncio.wrap_future(self.client.transfers.add_archive(save_path, owner, pattern))
+
+    async def list_files(self, owner=None, pattern=None, sort=None):
+        return await self.run(self.client.list_files, owner, pattern, sort)
+
+    async def delete_files(self, filenames):
+        return await self.run(self.client.delete_files, filenames)
+
+    async def request_stats(self):
+        return await self.run(self.client.request_stats)
@@ -0,0 +1,168 @@
+import argparse
+import concurrent.futures
+import getpass
+import glob
+import os
+import sys
+from client_api import FileClient, ServerError, DEFAULT_STREAMS, DEFAULT_CONCURRENCY
+
+
+def has_magic(name):
+    return any(character in name for character in "*?[")
+
+
+def local_files(paths, recursive):
+    #expands patterns (for shells that do not) and, with recursive, the files below directories
+    files = []
+    for path in paths:
+        matches = sorted(glob.glob(path)) if has_magic(path) else [path]
+        if not matches:
+            raise ValueError(f"No local files match '{path}'.")
+        for match in matches:
+            if os.path.isdir(match):
+                if not recursive:
+                    raise ValueError(f"'{match}' is a directory, use -r to upload what is in it.")
+                for directory, subdirectories, filenames in os.walk(match):
+                    subdirectories.sort()
+                    files.extend(os.path.join(directory, filename) for filename in sorted(filenames))
+            elif os.path.isfile(match):
+                files.append(match)
+            else:
+                raise ValueError(f"'{match}' does not exist.")
+    files = list(dict.fromkeys(files))
+    #filenames on the server have no directories, two files with the same name would overwrite each other
+    seen = {}
+    for file_path in files:
+        other = seen.setdefault(os.path.basename(file_path), file_path)
+        if other != file_path:
+            raise ValueError(f"'{other}' and '{file_path}' would both be uploaded as '{os.path.basename(file_path)}'.")
+    return files
+
+
+def remote_files(client, owner, names):
+    #plain names are taken as they are, patterns are matched on the server; returns filename -> size
+    #(None when unknown)
+    files = {}
+    for name in names:
+        if not has_magic(name):
+            files.setdefault(name, None)
+            continue
+        matches = client.list_files(owner=owner, pattern=name)
+        if not matches:
+            raise ValueError(f"No files of '{owner}' match '{name}'.")
+        for entry in matches:
+            files[entry['filename']] = entry['size']
+    return files
+
+
+def wait_for(client, futures):
+    #prints every finished transfer, returns the number that failed
+    names = {transfer['future']: transfer['name'] for transfer in client.transfers.snapshot()}
+    failed = 0
+    for future in concurrent.futures.as_completed(futures):
+        try:
+            result = future.result()
+        except concurrent.futures.CancelledError:
+            print(f"Error: transfer of '{names[future]}' was cancelled.", file=sys.stderr)
+            failed += 1
+            continue
+        except Exception as e:
+            print(f"Error: transfer of '{names[future]}' failed: {e}", file=sys.stderr)
+            failed += 1
+            continue
+        for line in result if isinstance(result, list) else [result]:
+            print(line)
+    return failed
+
+
+def command_put(client, args):
+    files = local_files(args.paths, args.recursive)
+    return 1 if wait_for(client, client.queue_uploads(files)) else 0
+
+
+def command_get(client, args):
+    owner = args.owner or client.username
+    os.makedirs(args.directory, exist_ok=True)
+    files = remote_files(client, owner, args.names)
+    return 1 if wait_for(client, client.queue_downloads(list(files), owner, args.directory, files)) else 0
+
+
+def command_ls(client, args):
+    entries = []
+    for pattern in args.patterns or [None]:
+        entries.extend(client.list_files(owner=args.owner, pattern=pattern, sort=args.sort))
+    for entry in entries:
+        if args.long:
+            print(f"{entry['size']:>12}  {entry['owner']:<16}  {entry['filename']}")
+        else:
+            print(f"{entry['filename']}\t{entry['owner']}")
+    return 0
+
+
+def command_rm(client, args):
+    #only our own files can be deleted
+    files = remote_files(client, client.username, args.names)
+    deleted, errors = client.delete_files(list(files))
+    for filename in deleted:
+        print(filename)
+    for filename, error in errors.items():
+        print(f"Error: {error}", file=sys.stderr)
+    return 1 if errors else 0
+
+
+COMMANDS = {'put': command_put, 'get': command_get, 'ls': command_ls, 'rm': command_rm}
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser(description="Command line client of the file sharing server.")
+    parser.add_argument("--host", default="127.0.0.1", help="server address (default 127.0.0.1)")
+    parser.add_argument("--port", type=int, required=True, help="server port")
+    parser.add_argument("--user", default=getpass.getuser(), help="username (default: the login name)")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY, help="transfers run at once")
+    parser.add_argument("--streams", type=int, default=DEFAULT_STREAMS, help="connections used for one large file")
+    parser.add_argument("--compression", default="zlib", help="preferred codec, 'none' sends everything raw")
+    parser.add_argument("-v", "--verbose", action="store_true", help="print progress messages and notifications")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    put = commands.add_parser("put", help="upload files")
+    put.add_argument("paths", nargs="+", help="files, directories or patterns such as *.csv")
+    put.add_argument("-r", "--recursive", action="store_true", help="upload the files below directories")
+
+    get = commands.add_parser("get", help="download files")
+    get.add_argument("names", nargs="+", help="filenames or patterns such as *.csv")
+    get.add_argument("--owner", help="whose files to download (default: your own)")
+    get.add_argument("-o", "--directory", default=".", help="where to save them (default: the current directory)")
+
+    ls = commands.add_parser("ls", help="list files")
+    ls.add_argument("patterns", nargs="*", help="filename prefixes or patterns such as *.csv")
+    ls.add_argument("--owner", help="only files of this owner")
+    ls.add_argument("--sort", choices=["name", "owner", "size", "mtime"], help="sort order (default: upload order)")
+    ls.add_argument("-l", "--long", action="store_true", help="show sizes")
+
+    rm = commands.add_parser("rm", help="delete your files")
+    rm.add_argument("names", nargs="+", help="filenames or patterns such as *.csv")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+
+    def show_event(kind, message):
+        #errors of single transfers are printed with their results, the rest only on request
+        if args.verbose:
+            print(message, file=sys.stderr)
+
+    compression = None if args.compression == "none" else args.compression
+    with FileClient(args.streams, compression=compression, concurrency=args.concurrency, on_event=show_event) as client:
+        try:
+            client.connect(args.host, args.port, args.user)
+            return COMMANDS[args.command](client, args)
+        except (ServerError, OSError, ValueError) as e:
+            print(f"Error: {e}", file=sys.stderr)
+            return 1
+        except KeyboardInterrupt:
+            return 130
+
+
+if __name__ == "__main__":
+    sys.exit(main())
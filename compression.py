@@ -0,0 +1,79 @@
+import lzma
+import os
+import time
+import zlib
+
+#codecs a transfer can be compressed with, each entry makes a fresh compressor and decompressor;
+#the server announces the names it knows in its HELLO reply
+CODECS = {
+    "zlib": (lambda: zlib.compressobj(6), zlib.decompressobj),
+    "lzma": (lzma.LZMACompressor, lzma.LZMADecompressor),
+}
+#file data is compressed in blocks of this size
+COMPRESS_BLOCK_SIZE = 1024 * 1024
+#compressed data frames carry at most a block; a receiver reads a frame whole, so it turns away bigger
+#ones, and takes the decompressed output in pieces since a small frame can expand a lot
+MAX_COMPRESSED_FRAME = 2 * COMPRESS_BLOCK_SIZE
+DECOMPRESS_PIECE_SIZE = 4 * COMPRESS_BLOCK_SIZE
+#smaller transfers are sent as they are
+MIN_COMPRESS_SIZE = 4096
+#samples taken from the start, middle and end of a file decide whether compressing it pays off
+SAMPLE_SIZE = 64 * 1024
+MIN_SAVING = 0.1
+
+
+def choose_codec(offered):
+    #the first codec of the peer's preference list that is known here
+    for name in offered or ():
+        if name in CODECS:
+            return name
+    return None
+
+
+def is_compressible(path):
+    #already compressed data (archives, media) does not shrink, so it is sent raw
+    size = os.path.getsize(path)
+    if size < MIN_COMPRESS_SIZE:
+        return False
+    sample = bytearray()
+    with open(path, "rb") as f:
+        for position in sorted({0, max(0, size // 2 - SAMPLE_SIZE // 2), max(0, size - SAMPLE_SIZE)}):
+            f.seek(position)
+            sample += f.read(SAMPLE_SIZE)
+    return len(zlib.compress(sample, 1)) <= len(sample) * (1 - MIN_SAVING)
+
+
+def compress_block(compressor, data, final):
+    #returns the compressed output and the cpu seconds spent on it
+    start = time.thread_time()
+    output = compressor.compress(data)
+    if final:
+        output += compressor.flush()
+    return output, time.thread_time() - start
+
+
+def frame_slices(output):
+    #the output for one block can be larger than the block when the data does not shrink
+    view = memoryview(output)
+    return [view[start:start + COMPRESS_BLOCK_SIZE] for start in range(0, len(view), COMPRESS_BLOCK_SIZE)]
+
+
+def pending_input(decompressor):
+    #what a decompressor stopped by max_length still has to work through: zlib hands the input back,
+    #lzma keeps it and continues on empty input
+    return getattr(decompressor, "unconsumed_tail", b"")
+
+
+def decompress_block(decompressor, data, max_length=-1):
+    start = time.thread_time()
+    if max_length < 0:
+        output = decompressor.decompress(data)
+    else:
+        output = decompressor.decompress(data, max_length)
+    return output, time.thread_time() - start
+
+
+def describe_savings(codec, raw_bytes, wire_bytes, cpu):
+    saved = raw_bytes - wire_bytes
+    percent = 100.0 * saved / raw_bytes if raw_bytes else 0.0
+    return f"{codec}: {wire_bytes} bytes on the wire for {raw_bytes} ({saved} saved, {percent:.1f}%, {cpu:.2f}s CPU)"
@@ -0,0 +1,69 @@
+import collections
+import threading
+
+
+class FileCache:
+    #contents of small, often downloaded files kept in memory within a byte budget, the least
+    #recently used entries go first. entries are keyed by (digest, codec): codec None holds the raw
+    #content and a codec name the compressed copy sent to clients that asked for it. the content
+    #under a digest never changes, so an entry only has to go when its blob is removed
+    def __init__(self, max_bytes, max_file_size):
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size  #larger files are always streamed from disk
+        self.entries = collections.OrderedDict()  #(digest, codec) -> bytes, least recently used first
+        self.codecs = {}  #digest -> codecs it has entries for
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.lock = threading.Lock()  #used from the event loop and from disk threads
+
+    def accepts(self, size):
+        return size <= self.max_file_size and size <= self.max_bytes
+
+    def get(self, digest, codec=None):
+        key = (digest, codec)
+        with self.lock:
+            data = self.entries.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, digest, codec, data):
+        if len(data) > self.max_bytes:
+            return
+        key = (digest, codec)
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous)
+            self.entries[key] = data
+            self.codecs.setdefault(digest, set()).add(codec)
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                (old_digest, old_codec), old_data = self.entries.popitem(last=False)
+                self.forget(old_digest, old_codec)
+                self.size -= len(old_data)
+                self.evictions += 1
+
+    def invalidate(self, digest):
+        with self.lock:
+            for codec in self.codecs.pop(digest, ()):
+                self.size -= len(self.entries.pop((digest, codec)))
+                self.invalidations += 1
+
+    def forget(self, digest, codec):
+        codecs = self.codecs[digest]
+        codecs.discard(codec)
+        if not codecs:
+            del self.codecs[digest]
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'bytes': self.size, 'max_bytes': self.max_bytes,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'invalidations': self.invalidations}
@@ -0,0 +1,108 @@
+import collections
+import os
+import queue
+import threading
+import time
+
+#defaults for the server log
+LOG_FLUSH_BYTES = 64 * 1024
+LOG_FLUSH_INTERVAL = 0.5
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+RECENT_LINES = 1000
+
+
+class LogWriter:
+    #request handlers only put lines on a queue; one background thread appends them to the
+    #log file in batches (flushed by size or age) and rotates the file when it gets too big.
+    #the most recent lines are also kept in a bounded ring buffer the gui drains on its own thread
+    def __init__(self, path, flush_bytes=LOG_FLUSH_BYTES, flush_interval=LOG_FLUSH_INTERVAL,
+                 max_bytes=LOG_MAX_BYTES, backup_count=LOG_BACKUP_COUNT, recent_lines=RECENT_LINES):
+        self.path = path
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.recent = collections.deque(maxlen=recent_lines) if recent_lines else None
+        self.queue = queue.SimpleQueue()
+        self.file = None
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def write(self, message):
+        if self.recent is not None:
+            self.recent.append(message)
+        self.queue.put(message)
+
+    def drain_recent(self, limit):
+        #called from the gui thread, returns at most limit of the lines logged since the last call
+        lines = []
+        while self.recent and len(lines) < limit:
+            try:
+                lines.append(self.recent.popleft())
+            except IndexError:
+                break
+        return lines
+
+    def run(self):
+        batch = []
+        batch_bytes = 0
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                message = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                message = ""
+            if message is None:
+                self.flush(batch)
+                return
+            if message:
+                line = message + "\n"
+                batch.append(line)
+                batch_bytes += len(line)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+            if batch and (batch_bytes >= self.flush_bytes or time.monotonic() >= deadline):
+                self.flush(batch)
+                batch = []
+                batch_bytes = 0
+                deadline = None
+
+    def flush(self, batch):
+        if not batch:
+            return
+        try:
+            if self.file is None:
+                self.file = open(self.path, "a")
+            self.file.write("".join(batch))
+            self.file.flush()
+            if self.max_bytes and self.file.tell() >= self.max_bytes:
+                self.rotate()
+        except OSError as e:
+            print(f"Logging error: {e}")
+
+    def rotate(self):
+        #server_log.txt -> server_log.txt.1 -> ... -> server_log.txt.<backup_count>
+        self.file.close()
+        self.file = None
+        for index in range(self.backup_count - 1, 0, -1):
+            source = f"{self.path}.{index}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{index + 1}")
+        if self.backup_count:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+
+    def close(self):
+        #writes everything still queued before returning
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join(timeout=5)
+        if self.file:
+            self.file.close()
+            self.file = None
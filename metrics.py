@@ -0,0 +1,134 @@
+import threading
+import time
+
+#upper bounds in seconds of the latency histogram buckets, the last one catches everything
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, float("inf"))
+#most lock acquisitions do not wait at all, those land in the first bucket
+LOCK_WAIT_BUCKETS = (0.0, 0.00001, 0.00005) + LATENCY_BUCKETS
+
+
+class Histogram:
+    #counts observations per bucket; quantiles are estimated as the upper bound of the bucket they fall in
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = 0
+        while value > self.buckets[index]:
+            index += 1
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    def quantile(self, q):
+        with self.lock:
+            counts, count = list(self.counts), self.count
+        if not count:
+            return None
+        rank = q * count
+        seen = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            seen += bucket_count
+            if seen >= rank:
+                #the open last bucket has no bound, the largest finite one is the best we know
+                return bound if bound != float("inf") else self.buckets[-2]
+        return self.buckets[-2]
+
+    def summary(self):
+        return {'count': self.count, 'sum': round(self.sum, 6), 'p50': self.quantile(0.5), 'p99': self.quantile(0.99)}
+
+    def cumulative(self):
+        #(upper bound, observations up to it) pairs as prometheus histograms report them
+        with self.lock:
+            counts = list(self.counts)
+        total = 0
+        result = []
+        for bound, bucket_count in zip(self.buckets, counts):
+            total += bucket_count
+            result.append((bound, total))
+        return result
+
+
+class TimedLock:
+    #a threading.Lock that records how long callers waited for it; uncontended acquisitions only
+    #cost a failed try and are counted as zero waits
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.waits = Histogram(LOCK_WAIT_BUCKETS)
+
+    def acquire(self, blocking=True, timeout=-1):
+        if self.lock.acquire(False):
+            self.waits.observe(0.0)
+            return True
+        if not blocking:
+            return False
+        start = time.perf_counter()
+        acquired = self.lock.acquire(True, timeout)
+        self.waits.observe(time.perf_counter() - start)
+        return acquired
+
+    def release(self):
+        self.lock.release()
+
+    def locked(self):
+        return self.lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class Metrics:
+    #request counters and latencies per command, filled in by the server
+    def __init__(self):
+        self.started = time.time()
+        self.requests = {}  #command -> Histogram of handling times
+        self.errors = {}  #command -> number of requests answered with an error
+        self.rejected = 0  #connections and transfers turned away as busy
+        self.lock = threading.Lock()
+
+    def observe_request(self, command, seconds, failed=False):
+        histogram = self.requests.get(command)
+        if histogram is None:
+            with self.lock:
+                histogram = self.requests.setdefault(command, Histogram())
+        histogram.observe(seconds)
+        if failed:
+            with self.lock:
+                self.errors[command] = self.errors.get(command, 0) + 1
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels.items()) + "}"
+
+
+def format_bound(bound):
+    return "+Inf" if bound == float("inf") else repr(float(bound))
+
+
+def prometheus_text(families):
+    #families are (name, type, help, samples) with samples (labels, value) for counters and gauges
+    #and (labels, Histogram) for histograms; returns the text exposition format
+    lines = []
+    for name, kind, description, samples in families:
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            if kind == "histogram":
+                for bound, count in value.cumulative():
+                    lines.append(f"{name}_bucket{format_labels(dict(labels, le=format_bound(bound)))} {count}")
+                lines.append(f"{name}_sum{format_labels(labels)} {value.sum}")
+                lines.append(f"{name}_count{format_labels(labels)} {value.count}")
+            else:
+                lines.append(f"{name}{format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,453 @@
+import asyncio
+import collections
+import json
+import socket
+import struct
+import threading
+
+#every message on the wire is a frame: fixed header followed by the payload
+#header layout: version (1 byte), frame type (1 byte), request id (4 bytes), payload length (8 bytes)
+PROTOCOL_VERSION = 1
+HEADER = struct.Struct("!BBIQ")
+HEADER_SIZE = HEADER.size
+
+#control frames carry small json documents, anything bigger is a broken peer
+MAX_CONTROL_PAYLOAD = 16 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+#data frames produced by sendfile, large so the kernel does most of the work per call
+SENDFILE_FRAME_SIZE = 4 * 1024 * 1024
+#staging buffer of every asyncio connection for frame headers and control payloads; it starts small so
+#idle connections stay cheap and grows for a larger payload, anything above the maximum bypasses it
+READ_BUFFER_MIN = 16 * 1024
+READ_BUFFER_MAX = 256 * 1024
+#unsolicited messages waiting for a slow connection, older ones are dropped past this
+OUTBOX_LIMIT = 100
+
+#frame types
+HELLO = 1         #client -> server, payload is the username
+REQUEST = 2       #client -> server, json command
+RESPONSE = 3      #server -> client, json reply to a request
+ERROR = 4         #server -> client, json error reply to a request
+DATA = 5          #raw file bytes belonging to a request
+END = 6           #end of the data stream of a request
+NOTIFICATION = 7  #server -> client, unsolicited json message (request id 0)
+SHUTDOWN = 8      #server -> client, server is closing (request id 0)
+EVENT = 9         #server -> client, catalog change pushed to a SUBSCRIBE request
+
+FRAME_NAMES = {
+    HELLO: "HELLO",
+    REQUEST: "REQUEST",
+    RESPONSE: "RESPONSE",
+    ERROR: "ERROR",
+    DATA: "DATA",
+    END: "END",
+    NOTIFICATION: "NOTIFICATION",
+    SHUTDOWN: "SHUTDOWN",
+    EVENT: "EVENT",
+}
+
+#request id used for messages that do not answer a request
+NO_REQUEST = 0
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def pack_header(frame_type, request_id, length):
+    return HEADER.pack(PROTOCOL_VERSION, frame_type, request_id, length)
+
+
+def unpack_header(header):
+    version, frame_type, request_id, length = HEADER.unpack(header)
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError(f"Unsupported protocol version {version}.")
+    if frame_type not in FRAME_NAMES:
+        raise ProtocolError(f"Unknown frame type {frame_type}.")
+    if frame_type != DATA and length > MAX_CONTROL_PAYLOAD:
+        raise ProtocolError(f"Control frame too large ({length} bytes).")
+    return frame_type, request_id, length
+
+
+def encode_message(fields):
+    return json.dumps(fields, separators=(",", ":")).encode()
+
+
+def decode_message(payload):
+    try:
+        message = json.loads(payload.decode())
+    except (UnicodeDecodeError, ValueError) as e:
+        raise ProtocolError(f"Malformed message payload: {e}")
+    if not isinstance(message, dict):
+        raise ProtocolError("Message payload must be an object.")
+    return message
+
+
+def recv_exact(sock, size):
+    #returns None if the peer closed the connection before sending anything
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:], size - received)
+        if count == 0:
+            if received == 0:
+                return None
+            raise ConnectionError("Connection closed in the middle of a frame.")
+        received += count
+    return bytes(buffer)
+
+
+def set_nodelay(sock):
+    #a reply written as header and payload would otherwise wait for the peer's delayed ack
+    if sock is not None and sock.family in (socket.AF_INET, socket.AF_INET6):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+class FramedSocket:
+    #wraps a blocking socket so several threads can send whole frames without interleaving
+    def __init__(self, sock):
+        self.sock = sock
+        self.send_lock = threading.Lock()
+        set_nodelay(sock)
+
+    def send_frame(self, frame_type, request_id, payload=b""):
+        header = pack_header(frame_type, request_id, len(payload))
+        with self.send_lock:
+            #small frames go out in one call, big payloads are not copied just to prepend the header
+            if len(payload) < CHUNK_SIZE:
+                self.sock.sendall(header + payload)
+            else:
+                self.sock.sendall(header)
+                self.sock.sendall(payload)
+
+    def send_message(self, frame_type, request_id, **fields):
+        self.send_frame(frame_type, request_id, encode_message(fields))
+
+    def send_file(self, request_id, file, offset, count):
+        #data frames whose payload is copied by the kernel (socket.sendfile falls back to send)
+        end = offset + count
+        with self.send_lock:
+            while offset < end:
+                size = min(SENDFILE_FRAME_SIZE, end - offset)
+                self.sock.sendall(pack_header(DATA, request_id, size))
+                sent = self.sock.sendfile(file, offset, size)
+                if sent != size:
+                    raise ConnectionError("File changed size while it was being sent.")
+                offset += size
+
+    def recv_frame(self):
+        #returns (frame type, request id, payload) or None when the peer closed the connection
+        header = recv_exact(self.sock, HEADER_SIZE)
+        if header is None:
+            return None
+        frame_type, request_id, length = unpack_header(header)
+        payload = recv_exact(self.sock, length) if length else b""
+        if payload is None:
+            raise ConnectionError("Connection closed in the middle of a frame.")
+        return frame_type, request_id, payload
+
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout)
+
+    def close(self):
+        self.sock.close()
+
+
+class FrameProtocol(asyncio.BufferedProtocol):
+    #receives with recv_into: frame headers and control payloads land in a staging buffer,
+    #data payloads read with readinto go from the kernel straight into the caller's buffer
+    def __init__(self, on_connection):
+        self.on_connection = on_connection  #coroutine function called with the FramedStream
+        self.transport = None
+        self.stream = None
+        self.task = None
+        self.buffer = bytearray(READ_BUFFER_MIN)
+        self.view = memoryview(self.buffer)
+        self.start = 0  #unread bytes are buffer[start:end]
+        self.end = 0
+        self.target = None  #caller buffer filled directly while a payload is read with readinto
+        self.target_filled = 0
+        self.receiving_direct = False
+        self.reading_paused = False
+        self.writing_paused = False
+        self.waiter = None
+        self.drain_waiters = []
+        self.eof = False
+        self.exception = None
+        self.bytes_received = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        #asyncio leaves nagle on for sockets accepted from a listener made with socket.socket()
+        set_nodelay(transport.get_extra_info("socket"))
+        self.stream = FramedStream(self)
+        self.task = asyncio.get_running_loop().create_task(self.on_connection(self.stream))
+
+    def connection_lost(self, exc):
+        self.eof = True
+        self.exception = exc
+        self.wake_reader()
+        for waiter in self.drain_waiters:
+            if not waiter.done():
+                waiter.set_exception(ConnectionResetError("Connection lost."))
+        self.drain_waiters = []
+
+    def eof_received(self):
+        self.eof = True
+        self.wake_reader()
+        return False
+
+    def get_buffer(self, sizehint):
+        #with nothing staged, the kernel can write the payload straight into the caller's buffer
+        self.receiving_direct = self.target is not None and self.start == self.end
+        if self.receiving_direct:
+            return self.target[self.target_filled:]
+        if self.end == len(self.buffer) and self.start:
+            self.compact()
+        return self.view[self.end:]
+
+    def buffer_updated(self, nbytes):
+        self.bytes_received += nbytes
+        if self.receiving_direct:
+            self.target_filled += nbytes
+        else:
+            self.end += nbytes
+            #staging buffer full, stop reading until the application catches up
+            if self.end == len(self.buffer) and self.start == 0:
+                self.transport.pause_reading()
+                self.reading_paused = True
+        self.wake_reader()
+
+    def pause_writing(self):
+        self.writing_paused = True
+
+    def resume_writing(self):
+        self.writing_paused = False
+        for waiter in self.drain_waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self.drain_waiters = []
+
+    def compact(self):
+        #moves the unread bytes to the front of the staging buffer
+        remaining = self.end - self.start
+        self.view[:remaining] = self.view[self.start:self.end]
+        self.start = 0
+        self.end = remaining
+
+    def grow(self, size):
+        #a larger staging buffer for a payload that does not fit, the unread bytes move along
+        capacity = len(self.buffer)
+        while capacity < size:
+            capacity *= 2
+        buffer = bytearray(capacity)
+        remaining = self.end - self.start
+        buffer[:remaining] = self.view[self.start:self.end]
+        self.buffer = buffer
+        self.view = memoryview(buffer)
+        self.start = 0
+        self.end = remaining
+        if self.reading_paused:
+            self.reading_paused = False
+            self.transport.resume_reading()
+
+    def consumed(self, count):
+        self.start += count
+        if self.start == self.end:
+            self.start = self.end = 0
+            if len(self.buffer) > READ_BUFFER_MIN:
+                #back to the small buffer once the large payload is read
+                self.buffer = bytearray(READ_BUFFER_MIN)
+                self.view = memoryview(self.buffer)
+        if self.reading_paused:
+            self.reading_paused = False
+            self.transport.resume_reading()
+
+    def wake_reader(self):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    async def wait_for_data(self):
+        if self.eof:
+            raise ConnectionError("Connection closed in the middle of a frame.")
+        self.waiter = asyncio.get_running_loop().create_future()
+        try:
+            await self.waiter
+        finally:
+            self.waiter = None
+
+    async def readexactly(self, size):
+        if size > READ_BUFFER_MAX:
+            result = bytearray(size)
+            await self.readinto(memoryview(result))
+            return bytes(result)
+        if size > len(self.buffer):
+            self.grow(size)
+        if self.start + size > len(self.buffer):
+            self.compact()
+        while self.end - self.start < size:
+            await self.wait_for_data()
+        data = bytes(self.view[self.start:self.start + size])
+        self.consumed(size)
+        return data
+
+    async def readinto(self, target):
+        #fills the whole memoryview, staged bytes first and then directly from the socket
+        staged = min(self.end - self.start, len(target))
+        if staged:
+            target[:staged] = self.view[self.start:self.start + staged]
+            self.consumed(staged)
+        if staged == len(target):
+            return
+        self.target = target
+        self.target_filled = staged
+        if self.reading_paused:
+            self.consumed(0)
+        try:
+            while self.target_filled < len(target):
+                await self.wait_for_data()
+        finally:
+            self.target = None
+
+    async def skip(self, size):
+        while size:
+            count = min(size, len(self.buffer))
+            await self.readexactly(count)
+            size -= count
+
+    async def drain(self):
+        if self.transport.is_closing():
+            raise ConnectionResetError("Connection lost.")
+        if not self.writing_paused:
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self.drain_waiters.append(waiter)
+        await waiter
+
+
+class FramedStream:
+    #frame level view of a FrameProtocol connection, writes are buffered by the transport
+    def __init__(self, protocol):
+        self.protocol = protocol
+        self.transport = protocol.transport
+        #the transport refuses writes while sendfile runs, frames sent meanwhile wait here
+        self.sending_file = False
+        self.deferred_frames = []
+        #notifications and other unsolicited messages, written one at a time by a single writer task
+        self.outbox = collections.deque()  #[frame type, request id, fields, times posted]
+        self.outbox_dropped = 0
+        self.outbox_writer = None
+        self.bytes_sent = 0
+        self.failed_requests = set()  #request ids answered with an ERROR frame, cleared by the handler
+
+    def send_frame(self, frame_type, request_id, payload=b""):
+        if self.sending_file:
+            self.deferred_frames.append((frame_type, request_id, payload))
+            return
+        if frame_type == ERROR:
+            self.failed_requests.add(request_id)
+        #header and payload are queued without yielding so frames never interleave
+        self.transport.write(pack_header(frame_type, request_id, len(payload)))
+        if payload:
+            self.transport.write(payload)
+        self.bytes_sent += HEADER_SIZE + len(payload)
+
+    async def send_file(self, request_id, file, offset, count):
+        #streams count bytes of file as data frames, the bytes go from the page cache to the socket
+        loop = asyncio.get_running_loop()
+        end = offset + count
+        while offset < end:
+            size = min(SENDFILE_FRAME_SIZE, end - offset)
+            self.transport.write(pack_header(DATA, request_id, size))
+            self.bytes_sent += HEADER_SIZE
+            self.sending_file = True
+            try:
+                #falls back to plain reads and writes where os.sendfile is not available
+                sent = await loop.sendfile(self.transport, file, offset, size, fallback=True)
+            finally:
+                self.sending_file = False
+                deferred, self.deferred_frames = self.deferred_frames, []
+                for frame in deferred:
+                    self.send_frame(*frame)
+            self.bytes_sent += sent
+            if sent != size:
+                raise ConnectionError("File changed size while it was being sent.")
+            offset += size
+
+    def send_message(self, frame_type, request_id, **fields):
+        self.send_frame(frame_type, request_id, encode_message(fields))
+
+    def post(self, frame_type, request_id, **fields):
+        #queues a message for the writer and returns at once, so whoever posts never waits on this
+        #peer. a message equal to one still queued is merged into it with a repeat count, and when a
+        #slow reader lets the queue fill up the oldest messages are dropped and reported once
+        for entry in self.outbox:
+            if entry[0] == frame_type and entry[1] == request_id and entry[2] == fields:
+                entry[3] += 1
+                return
+        if len(self.outbox) >= OUTBOX_LIMIT:
+            self.outbox_dropped += self.outbox.popleft()[3]
+        self.outbox.append([frame_type, request_id, fields, 1])
+        if self.outbox_writer is None:
+            self.outbox_writer = asyncio.get_running_loop().create_task(self.write_outbox())
+
+    async def write_outbox(self):
+        try:
+            while self.outbox:
+                if self.outbox_dropped:
+                    self.send_message(NOTIFICATION, NO_REQUEST, message=f"{self.outbox_dropped} notifications "
+                                      "were dropped because they could not be delivered in time.")
+                    self.outbox_dropped = 0
+                frame_type, request_id, fields, count = self.outbox.popleft()
+                if count > 1:
+                    fields = dict(fields, repeat=count)
+                self.send_message(frame_type, request_id, **fields)
+                #the next message is taken once this one is on its way, merging happens meanwhile
+                await self.drain()
+        except ConnectionError:
+            self.outbox.clear()
+        finally:
+            self.outbox_writer = None
+
+    async def flush(self):
+        #waits until everything posted so far is handed to the transport
+        if self.outbox_writer:
+            await asyncio.shield(self.outbox_writer)
+        await self.drain()
+
+    async def drain(self):
+        await self.protocol.drain()
+
+    @property
+    def bytes_received(self):
+        return self.protocol.bytes_received
+
+    async def read_header(self):
+        #returns (frame type, request id, payload length) or None when the peer closed the connection
+        try:
+            header = await self.protocol.readexactly(HEADER_SIZE)
+        except ConnectionError:
+            if self.protocol.start == self.protocol.end:
+                return None
+            raise
+        return unpack_header(header)
+
+    async def read_payload(self, length):
+        return await self.protocol.readexactly(length) if length else b""
+
+    async def readinto(self, view):
+        await self.protocol.readinto(view)
+
+    async def skip(self, length):
+        await self.protocol.skip(length)
+
+    async def read_frame(self):
+        header = await self.read_header()
+        if header is None:
+            return None
+        frame_type, request_id, length = header
+        return frame_type, request_id, await self.read_payload(length)
+
+    def close(self):
+        self.transport.close()
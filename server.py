@@ -1,18 +1,243 @@
 import os
 import socket
+import asyncio
+import errno
+import argparse
+import collections
+import configparser
+import functools
+import hashlib
+import json
+import secrets
+import signal
+import sys
+import tarfile
 import threading
-from tkinter import Tk, Label, Button, Listbox, Scrollbar, filedialog, Entry, END, messagebox, Text
+import time
+from concurrent.futures import ThreadPoolExecutor
 import traceback
+from metrics import Metrics, TimedLock, prometheus_text
+from log_writer import LogWriter, LOG_MAX_BYTES, LOG_BACKUP_COUNT, RECENT_LINES
+from admission import TransferSlots, BUSY_RETRY_AFTER, BUSY_CLOSE_GRACE
+from bandwidth import Shaper, SHAPING_SLICE
+from blob_store import BlobStore
+from file_cache import FileCache
+from compression import (
+    CODECS, COMPRESS_BLOCK_SIZE, MIN_COMPRESS_SIZE, MAX_COMPRESSED_FRAME, DECOMPRESS_PIECE_SIZE, choose_codec, is_compressible,
+    compress_block, decompress_block, describe_savings, frame_slices, pending_input,
+)
+from catalog import Catalog, CatalogJournal, ChangeLog, FileRecord, SORT_KEYS, matches_name, select_page
+from protocol import (
+    FrameProtocol, ProtocolError, decode_message, FRAME_NAMES, NO_REQUEST, CHUNK_SIZE,
+    HELLO, REQUEST, RESPONSE, ERROR, DATA, END as END_FRAME, NOTIFICATION, SHUTDOWN, EVENT,
+)
+
+try:
+    import resource
+except ImportError:  #not available on windows
+    resource = None
+
+#threads used for blocking disk work so the event loop never waits on the filesystem
+DISK_WORKERS = 16
+#seconds a client connection may stay silent before it is closed
+IDLE_TIMEOUT = 300
+#upload receive buffers start small and double per batch written to disk
+UPLOAD_BUFFER_MIN = 256 * 1024
+UPLOAD_BUFFER_MAX = 8 * 1024 * 1024
+#list replies are streamed in batches of this many entries
+LIST_BATCH_SIZE = 500
+MAX_LIST_PAGE_SIZE = 10000
+#the gui log shows at most this many lines and adds at most a batch per refresh
+GUI_LOG_LINES = 5000
+GUI_LOG_BATCH = 500
+#unsent bytes after which a subscriber that does not keep up is dropped
+SUBSCRIBER_BUFFER_LIMIT = 4 * 1024 * 1024
+#uploads are received into this subdirectory and renamed into place once complete, an interrupted
+#one stays there so the client can continue it; the ones nobody came back for are removed after a week
+PARTIAL_DIRECTORY = ".partial"
+PARTIAL_MAX_AGE = 7 * 24 * 3600
+HASH_BLOCK_SIZE = 1024 * 1024
+#large files are moved in chunks over several connections of the same client
+MAX_STREAMS = 8
+TRANSFER_CHUNK_SIZE = 8 * 1024 * 1024
+MIN_CHUNK_SIZE = 256 * 1024
+MAX_CHUNK_SIZE = 256 * 1024 * 1024
+#remembered compressibility of stored contents, forgotten wholesale when it grows past this
+COMPRESSIBLE_CACHE_SIZE = 100000
+#batch requests name at most this many files, files of a batch upload are received into memory
+MAX_BATCH_FILES = 1000
+MAX_BATCH_FILE_SIZE = 4 * 1024 * 1024
+#seconds between background checks of the catalog against the blobs on disk, 0 turns them off;
+#each check stats the blobs in small slices so it never competes with requests for long
+VERIFY_INTERVAL = 3600
+VERIFY_BATCH = 200
+VERIFY_PAUSE = 0.05
+#small files that are downloaded over and over are served from memory, the budget covers raw and
+#compressed copies together; 0 turns the cache off
+CACHE_BYTES = 64 * 1024 * 1024
+CACHE_MAX_FILE_SIZE = 1024 * 1024
+#bytes per second each client and all clients together may move in each direction, 0 means unlimited
+CLIENT_RATE_LIMIT = 0
+GLOBAL_RATE_LIMIT = 0
+#admission control: pending connections the kernel queues, connections served at once, transfers
+#running at once and transfers waiting for one of them; past these limits requests get a BUSY reply
+BACKLOG = 128
+MAX_CONNECTIONS = 1000
+MAX_TRANSFERS = 64
+MAX_QUEUED_TRANSFERS = 256
+#metrics are served over http for prometheus when a port is given, on localhost unless told otherwise
+METRICS_PORT = 0
+METRICS_HOST = "127.0.0.1"
+#commands timed separately in the metrics, anything else a client sends is counted as OTHER
+COMMANDS = {"UPLOAD", "UPLOAD_BATCH", "UPLOAD_DIGEST", "UPLOAD_STATUS", "OPEN_UPLOAD", "UPLOAD_CHUNK", "FINISH_UPLOAD",
+            "OPEN_STREAMS", "STAT", "LIST", "DELETE", "DELETE_BATCH", "DOWNLOAD", "DOWNLOAD_BATCH", "DOWNLOAD_ARCHIVE",
+            "STATS", "SUBSCRIBE", "UNSUBSCRIBE"}
+TRANSFER_COMMANDS = {"UPLOAD", "UPLOAD_BATCH", "UPLOAD_CHUNK", "DOWNLOAD", "DOWNLOAD_BATCH", "DOWNLOAD_ARCHIVE"}
+
+
+def write_all(f, view):
+    #unbuffered file writes may be partial
+    while view:
+        written = f.write(view)
+        view = view[written:]
+
+
+def read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def write_new_file(path, data):
+    #writes a complete file received into memory and returns its digest
+    with open(path, "wb", 0) as f:
+        write_all(f, memoryview(data))
+    return hashlib.sha256(data).hexdigest()
+
+
+def tar_header(record):
+    #archive members are named owner/filename, pax headers keep long and non-ascii names intact
+    info = tarfile.TarInfo(f"{record.owner}/{record.filename}")
+    info.size = record.size
+    info.mtime = int(record.mtime or 0)
+    info.mode = 0o644
+    info.uname = record.owner
+    return info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+
+
+def tar_padding(size):
+    return (tarfile.BLOCKSIZE - size % tarfile.BLOCKSIZE) % tarfile.BLOCKSIZE
+
+
+def preallocate(f, size):
+    #reserving the blocks up front avoids fragmentation and fails early when the disk is full
+    try:
+        os.posix_fallocate(f.fileno(), 0, size)
+    except OSError as e:
+        if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL, errno.ENOSYS):
+            raise
+
+
+def hash_file_prefix(path, length, hasher):
+    #the digest of a resumed upload also covers the bytes received before the interruption
+    with open(path, "rb") as f:
+        while length:
+            block = f.read(min(length, HASH_BLOCK_SIZE))
+            if not block:
+                raise ValueError("Partial upload is shorter than expected.")
+            hasher.update(block)
+            length -= len(block)
+
+
+def write_partial_session(path, size, validator, received, chunk_size=None, done=()):
+    #chunked uploads also record the chunk size and which chunks are complete
+    session = {'size': size, 'validator': validator, 'received': received}
+    if chunk_size:
+        session['chunk_size'] = chunk_size
+        session['done'] = sorted(done)
+    with open(path, "w") as f:
+        json.dump(session, f)
+
+
+def open_at(path, position):
+    f = open(path, "r+b", 0)
+    f.seek(position)
+    return f
+
+
+def file_digest(path):
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(HASH_BLOCK_SIZE)
+            if not block:
+                return hasher.hexdigest()
+            hasher.update(block)
+
+
+def is_digest(value):
+    return isinstance(value, str) and len(value) == 64 and all(c in "0123456789abcdef" for c in value)
+
+
+def is_valid_name(name):
+    #filenames and usernames end up in paths on both sides and in the line-based catalog files,
+    #so they have to be single path components without control characters
+    return (bool(name) and name != "." and ".." not in name and "/" not in name and "\\" not in name
+            and not any(ord(c) < 32 or ord(c) == 127 for c in name))
 
 class Server:
-    def __init__(self):
+    def __init__(self, host="", log_file="server_log.txt", error_log_file="server_error_log.txt",
+                 log_max_bytes=LOG_MAX_BYTES, log_backup_count=LOG_BACKUP_COUNT, gui_log=True,
+                 disk_workers=DISK_WORKERS, idle_timeout=IDLE_TIMEOUT, max_list_page_size=MAX_LIST_PAGE_SIZE,
+                 max_streams=MAX_STREAMS, verify_interval=VERIFY_INTERVAL, cache_bytes=CACHE_BYTES,
+                 cache_max_file_size=CACHE_MAX_FILE_SIZE, client_rate_limit=CLIENT_RATE_LIMIT,
+                 global_rate_limit=GLOBAL_RATE_LIMIT, backlog=BACKLOG, max_connections=MAX_CONNECTIONS,
+                 max_transfers=MAX_TRANSFERS, max_queued_transfers=MAX_QUEUED_TRANSFERS,
+                 metrics_port=METRICS_PORT, metrics_host=METRICS_HOST):
+        self.host = host
+        self.disk_workers = disk_workers
+        self.idle_timeout = idle_timeout  #seconds a connection may stay silent
+        self.max_list_page_size = max_list_page_size
+        self.max_streams = max_streams  #extra connections a client may attach for one transfer
+        self.verify_interval = verify_interval
+        self.backlog = backlog
+        self.max_connections = max_connections  #0 means unlimited
+        self.connections = set()  #open connections including data connections, only used on the event loop
+        self.metrics = Metrics()
+        self.closed_bytes = {'received': 0, 'sent': 0}  #traffic of connections that are already closed
+        self.metrics_port = metrics_port
+        self.metrics_host = metrics_host
+        self.metrics_server = None
+        self.transfer_slots = TransferSlots(max_transfers, max_queued_transfers)
+        self.verify_task = None
         self.server_socket = None
-        self.clients = {}  #for mapping client names to sockets
-        self.clients_lock = threading.Lock()  #lock for accessing clients dictionary
+        self.async_server = None
+        self.loop = None  #event loop running all client connections
+        self.disk_executor = None
+        self.clients = {}  #for mapping client names to connections
+        self.clients_lock = TimedLock()  #lock for accessing clients dictionary
         self.file_directory = None
-        self.file_list = []  #tuples: (filename, owner)
-        self.file_list_lock = threading.Lock()  #lock for accessing file_list
+        self.catalog = Catalog()  #indexed by (owner, filename), owner and filename
+        self.file_list_lock = TimedLock()  #lock for accessing the catalog
+        self.journal = None  #append-only log of catalog changes in the file directory
+        self.blobs = None  #content of the cataloged files by sha256, set up by load_file_list
+        self.changes = ChangeLog()  #versioned change events for subscribed clients
+        self.subscribers = {}  #connection -> subscription state, only used on the event loop
+        #state of multi-stream transfers, also only used on the event loop
+        self.stream_grants = {}  #token -> client, control connection and attached streams
+        self.upload_sessions = {}  #token -> chunked upload
+        self.partials_in_use = set()  #partial files an upload is writing to
+        self.compressible = {}  #digest -> whether downloads of it are worth compressing
+        self.file_cache = FileCache(cache_bytes, cache_max_file_size) if cache_bytes > 0 else None
+        #token buckets per client and overall, transfers take turns for the shared budget
+        self.download_shaper = Shaper(client_rate_limit, global_rate_limit)
+        self.upload_shaper = Shaper(client_rate_limit, global_rate_limit)
+        self.compression_totals = {'raw': 0, 'wire': 0, 'cpu': 0.0}  #over all compressed transfers
         self.error_log = []
+        #without the gui nobody drains the ring buffer of recent lines
+        self.log_writer = LogWriter(log_file, max_bytes=log_max_bytes, backup_count=log_backup_count,
+                                    recent_lines=RECENT_LINES if gui_log else 0)
+        self.error_writer = LogWriter(error_log_file, max_bytes=log_max_bytes, backup_count=log_backup_count, recent_lines=0)
+        self.use_sendfile = hasattr(os, "sendfile")  #zero-copy downloads where the platform supports it
         self.notification_lock = threading.Lock()  #lock for notifications
 
     def get_client_socket(self, username):
@@ -23,368 +248,1756 @@ class Server:
         try:
             #creating the socket for the server to start it
             self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.server_socket.bind(("", port))
-            self.server_socket.listen(5)
-            self.log_message(f"Server started on port {port}. Waiting for connections...")
-            threading.Thread(target=self.accept_clients, daemon=True).start()
+            if os.name != "nt":
+                #a restarted daemon can bind while old connections are in TIME_WAIT
+                self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.server_socket.bind((self.host, port))
+            self.server_socket.listen(self.backlog)
+            self.raise_file_limit()
+            self.disk_executor = ThreadPoolExecutor(max_workers=self.disk_workers, thread_name_prefix="disk")
+            self.loop = asyncio.new_event_loop()
+            #port 0 asks the system for a free port, the log names the one that was bound
+            self.log_message(f"Server started on port {self.server_socket.getsockname()[1]}. Waiting for connections...")
+            threading.Thread(target=self.run_event_loop, daemon=True).start()
+            return True
         except Exception as e:
             self.log_message(f"Error starting server: {e}")
+            if self.server_socket:
+                self.server_socket.close()
+                self.server_socket = None
+            return False
 
-    def accept_clients(self):
+    def raise_file_limit(self):
+        #every connection is a file descriptor, the default soft limit is often only 1024
+        if resource is None:
+            return
         try:
-            while True:
-                try:
-                    #creating thread for each client
-                    client_socket, client_address = self.server_socket.accept()
-                    threading.Thread(target=self.handle_client, args=(client_socket,), daemon=True).start()
-                except OSError:
-                    break
+            soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+            if hard == resource.RLIM_INFINITY or soft < hard:
+                resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError) as e:
+            self.log_message(f"Could not raise open file limit: {e}")
+
+    def run_event_loop(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.serve())
         except Exception as e:
             self.log_message(f"Error accepting clients: {e}")
+        finally:
+            #connections still open when the server stops are cancelled
+            pending = asyncio.all_tasks(self.loop)
+            for task in pending:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+            self.loop.close()
 
-    def handle_client(self, client_socket):
+    async def serve(self):
+        self.async_server = await self.loop.create_server(lambda: FrameProtocol(self.handle_client), sock=self.server_socket)
+        if self.verify_interval:
+            self.verify_task = self.loop.create_task(self.verify_metadata())
+        if self.metrics_port:
+            try:
+                self.metrics_server = await asyncio.start_server(self.serve_metrics, self.metrics_host, self.metrics_port)
+                self.log_message(f"Metrics available at http://{self.metrics_host}:{self.metrics_port}/metrics")
+            except OSError as e:
+                self.log_message(f"Could not start the metrics endpoint: {e}")
+        try:
+            await self.async_server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+
+    def collect_stats(self):
+        #everything the STATS command and the metrics endpoint report, as one json friendly dict
+        connections = list(self.connections)
+        with self.clients_lock:
+            client_count = len(self.clients)
+        with self.file_list_lock:
+            file_count = len(self.catalog)
+            blob_count = len(self.blobs) if self.blobs else 0
+        requests = {}
+        for command, histogram in sorted(self.metrics.requests.items()):
+            requests[command] = dict(histogram.summary(), errors=self.metrics.errors.get(command, 0))
+        cache = self.file_cache.stats() if self.file_cache else None
+        if cache:
+            lookups = cache['hits'] + cache['misses']
+            cache['hit_rate'] = cache['hits'] / lookups if lookups else None
+        return {
+            'uptime': time.time() - self.metrics.started,
+            'requests': requests,
+            'bytes_received': self.closed_bytes['received'] + sum(c.bytes_received for c in connections),
+            'bytes_sent': self.closed_bytes['sent'] + sum(c.bytes_sent for c in connections),
+            'connections': len(connections),
+            'clients': client_count,
+            'transfers': {'active': self.transfer_slots.active, 'queued': len(self.transfer_slots.waiting),
+                          'rejected': self.metrics.rejected},
+            'lock_waits': {'file_list_lock': self.file_list_lock.waits.summary(),
+                           'clients_lock': self.clients_lock.waits.summary()},
+            'cache': cache,
+            'compression': dict(self.compression_totals),
+            'files': file_count,
+            'blobs': blob_count,
+        }
+
+    def metrics_text(self):
+        #the same numbers in the prometheus text format, histograms with all their buckets
+        stats = self.collect_stats()
+        families = [
+            ("fileserver_uptime_seconds", "gauge", "Seconds since the server started.", [({}, stats['uptime'])]),
+            ("fileserver_request_duration_seconds", "histogram", "Time from receiving a request to finishing it, by command.",
+             [({'command': command}, histogram) for command, histogram in sorted(self.metrics.requests.items())]),
+            ("fileserver_request_errors_total", "counter", "Requests answered with an error, by command.",
+             [({'command': command}, count) for command, count in sorted(self.metrics.errors.items())]),
+            ("fileserver_received_bytes_total", "counter", "Bytes received from clients.", [({}, stats['bytes_received'])]),
+            ("fileserver_sent_bytes_total", "counter", "Bytes sent to clients.", [({}, stats['bytes_sent'])]),
+            ("fileserver_connections", "gauge", "Open connections, data connections included.", [({}, stats['connections'])]),
+            ("fileserver_clients", "gauge", "Logged in clients.", [({}, stats['clients'])]),
+            ("fileserver_transfers_active", "gauge", "Transfers holding a slot.", [({}, stats['transfers']['active'])]),
+            ("fileserver_transfers_queued", "gauge", "Transfers waiting for a slot.", [({}, stats['transfers']['queued'])]),
+            ("fileserver_rejected_total", "counter", "Connections and transfers turned away as busy.",
+             [({}, stats['transfers']['rejected'])]),
+            ("fileserver_lock_wait_seconds", "histogram", "Time spent waiting for a server lock.",
+             [({'lock': "file_list_lock"}, self.file_list_lock.waits), ({'lock': "clients_lock"}, self.clients_lock.waits)]),
+            ("fileserver_files", "gauge", "Files in the catalog.", [({}, stats['files'])]),
+            ("fileserver_blobs", "gauge", "Distinct stored contents.", [({}, stats['blobs'])]),
+            ("fileserver_compression_raw_bytes_total", "counter", "Uncompressed bytes of compressed transfers.",
+             [({}, stats['compression']['raw'])]),
+            ("fileserver_compression_wire_bytes_total", "counter", "Bytes on the wire of compressed transfers.",
+             [({}, stats['compression']['wire'])]),
+        ]
+        if stats['cache']:
+            cache = stats['cache']
+            families += [
+                ("fileserver_cache_hits_total", "counter", "Downloads answered from the file cache.", [({}, cache['hits'])]),
+                ("fileserver_cache_misses_total", "counter", "File cache lookups that missed.", [({}, cache['misses'])]),
+                ("fileserver_cache_evictions_total", "counter", "File cache entries evicted for space.", [({}, cache['evictions'])]),
+                ("fileserver_cache_bytes", "gauge", "Bytes held by the file cache.", [({}, cache['bytes'])]),
+            ]
+        return prometheus_text(families)
+
+    async def serve_metrics(self, reader, writer):
+        #just enough http for a prometheus scrape: GET /metrics gets the text format and the connection closes
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 10)
+            while await asyncio.wait_for(reader.readline(), 10) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                status, content_type = "200 OK", "text/plain; version=0.0.4; charset=utf-8"
+                body = self.metrics_text().encode()
+            else:
+                status, content_type, body = "404 Not Found", "text/plain", b"Not found\n"
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+                         f"Connection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        except Exception as e:
+            self.log_message(f"Error serving metrics: {e}")
+        finally:
+            writer.close()
+
+    async def run_blocking(self, func, *args):
+        return await self.loop.run_in_executor(self.disk_executor, functools.partial(func, *args))
+
+    async def handle_client(self, connection):
         client_name = None
         disconnection_logged = False
         client_registered = False
-        try:
-            client_socket.settimeout(60) 
+        stream_grant = None  #set when this is an extra stream of another connection
+        uploads = {}  #request id -> upload in progress on this connection
+        held_slots = set()  #request ids of this connection holding a transfer slot
+        handling = {}  #request id -> command and start time of requests not answered yet
 
-            #receive username of the client
-            client_name = client_socket.recv(1024).decode().strip()
-            #checking the username
-            if not client_name:
-                client_socket.send("ERROR: Username cannot be empty.".encode())
-                client_socket.close()
-                return
+        def settle_requests():
+            #a request is done once its handler returned and no upload is left open for it;
+            #then its time is recorded and a transfer gives its slot back
+            for settled_id in [settled_id for settled_id in handling if settled_id not in uploads]:
+                command, started = handling.pop(settled_id)
+                failed = settled_id in connection.failed_requests
+                connection.failed_requests.discard(settled_id)
+                self.metrics.observe_request(command, time.perf_counter() - started, failed)
+                if settled_id in held_slots:
+                    held_slots.discard(settled_id)
+                    self.transfer_slots.release()
 
-            with self.clients_lock:
-                if client_name in self.clients:
-                    client_socket.send("ERROR: Username already connected.".encode())
-                    client_socket.close()
+        self.connections.add(connection)
+        try:
+            #the limit is checked as soon as the connection is accepted, so idle connections count as well
+            if self.max_connections and len(self.connections) > self.max_connections:
+                self.send_busy(connection, NO_REQUEST)
+                #the first frame is still read for a moment, closing on unread data would reset the connection
+                #before the client sees the reply
+                try:
+                    await asyncio.wait_for(connection.read_frame(), BUSY_CLOSE_GRACE)
+                except (asyncio.TimeoutError, ConnectionError, ProtocolError):
+                    pass
+                return
+            #the first frame has to be the username of the client or an ATTACH request of a stream
+            frame = await asyncio.wait_for(connection.read_frame(), 60)
+            if frame is not None and frame[0] == REQUEST:
+                stream_grant = self.attach_stream(connection, frame[1], decode_message(frame[2]))
+                if stream_grant is None:
                     return
-                self.clients[client_name] = client_socket
-                client_registered = True  #mark as registered
+                client_name = stream_grant['client']
+            elif frame is None or frame[0] != HELLO:
+                connection.send_message(ERROR, NO_REQUEST, message="Expected HELLO frame.")
+                return
+            else:
+                client_name = frame[2].decode().strip()
+                #checking the username
+                if not client_name:
+                    connection.send_message(ERROR, NO_REQUEST, message="Username cannot be empty.")
+                    return
+                if not is_valid_name(client_name):
+                    connection.send_message(ERROR, NO_REQUEST, message="Invalid username.")
+                    return
+
+                with self.clients_lock:
+                    if client_name in self.clients:
+                        connection.send_message(ERROR, NO_REQUEST, message="Username already connected.")
+                        return
+                    self.clients[client_name] = connection
+                    client_registered = True  #mark as registered
 
-            self.log_message(f"Client connected: {client_name}")
-            client_socket.send("CONNECTED".encode())
+                self.log_message(f"Client connected: {client_name}")
+                connection.send_message(RESPONSE, NO_REQUEST, message="CONNECTED", codecs=list(CODECS))
 
             while True:
                 try:
-                    client_socket.settimeout(300)
-                    command = client_socket.recv(1024).decode()
+                    header = await asyncio.wait_for(connection.read_header(), self.idle_timeout)
 
-                    if not command:
-                        self.log_message(f"Client {client_name} disconnected.")
+                    if header is None:
+                        if stream_grant is None:
+                            self.log_message(f"Client {client_name} disconnected.")
                         disconnection_logged = True
                         break
-                    
+                    frame_type, request_id, length = header
+
+                    #file bytes of an upload that is in flight, received straight into its buffer
+                    if frame_type == DATA:
+                        #reading pauses while the client is over its rate, tcp then slows the sender down
+                        await self.upload_shaper.wait(client_name, length)
+                        if 'batch' in uploads.get(request_id, ()):
+                            await self.receive_batch_data(connection, request_id, length, uploads)
+                        else:
+                            await self.handle_upload_data(connection, request_id, length, uploads)
+                        settle_requests()
+                        continue
+                    payload = await asyncio.wait_for(connection.read_payload(length), self.idle_timeout)
+                    if frame_type == END_FRAME:
+                        if 'batch' in uploads.get(request_id, ()):
+                            await self.finish_batch(client_name, connection, request_id, uploads.pop(request_id))
+                        else:
+                            await self.finish_upload(client_name, connection, request_id, uploads)
+                        settle_requests()
+                        continue
+                    if frame_type != REQUEST:
+                        connection.send_message(ERROR, request_id, message=f"Unexpected {FRAME_NAMES[frame_type]} frame.")
+                        continue
+
+                    request = decode_message(payload)
+                    command = request.get("command")
+                    if command != "DISCONNECT":
+                        handling[request_id] = (command if command in COMMANDS else "OTHER", time.perf_counter())
+                    #transfers wait in a bounded queue for a free slot, a full queue is answered with BUSY.
+                    #slots still held here belong to uploads waiting for their data on this connection,
+                    #the reader must not stop for a slot then or those uploads never finish
+                    if command in TRANSFER_COMMANDS:
+                        if not await self.transfer_slots.acquire(wait=not held_slots):
+                            self.send_busy(connection, request_id)
+                            settle_requests()
+                            continue
+                        held_slots.add(request_id)
+
                     #handling client operations
-                    if command.startswith("UPLOAD"):
-                        self.handle_upload(client_name, client_socket, command)
-                    elif command.startswith("LIST"):
-                        self.handle_list(client_socket)
-                    elif command.startswith("DELETE"):
-                        self.handle_delete(client_name, client_socket, command)
-                    elif command.startswith("DOWNLOAD"):
-                        self.handle_download(client_name, client_socket, command)
-                    elif command.startswith("DISCONNECT"):
-                        self.handle_disconnect(client_name)
+                    if command == "UPLOAD":
+                        await self.handle_upload(client_name, connection, request_id, request, uploads)
+                    elif command == "UPLOAD_BATCH":
+                        await self.handle_upload_batch(client_name, connection, request_id, request, uploads)
+                    elif command == "UPLOAD_DIGEST":
+                        await self.handle_upload_digest(client_name, connection, request_id, request)
+                    elif command == "UPLOAD_STATUS":
+                        await self.handle_upload_status(client_name, connection, request_id, request)
+                    elif command == "OPEN_UPLOAD":
+                        await self.handle_open_upload(client_name, connection, request_id, request)
+                    elif command == "UPLOAD_CHUNK":
+                        await self.handle_upload_chunk(client_name, connection, request_id, request, uploads)
+                    elif command == "FINISH_UPLOAD":
+                        await self.handle_finish_upload(client_name, connection, request_id, request)
+                    elif command == "OPEN_STREAMS":
+                        self.handle_open_streams(client_name, connection, request_id, stream_grant)
+                    elif command == "STAT":
+                        await self.handle_stat(connection, request_id, request)
+                    elif command == "LIST":
+                        await self.handle_list(connection, request_id, request)
+                    elif command == "DELETE":
+                        await self.handle_delete(client_name, connection, request_id, request)
+                    elif command == "DELETE_BATCH":
+                        await self.handle_delete_batch(client_name, connection, request_id, request)
+                    elif command == "DOWNLOAD":
+                        await self.handle_download(client_name, connection, request_id, request)
+                    elif command == "DOWNLOAD_BATCH":
+                        await self.handle_download_batch(client_name, connection, request_id, request)
+                    elif command == "DOWNLOAD_ARCHIVE":
+                        await self.handle_download_archive(client_name, connection, request_id, request)
+                    elif command == "STATS":
+                        connection.send_message(RESPONSE, request_id, stats=self.collect_stats())
+                    elif command == "SUBSCRIBE":
+                        await self.handle_subscribe(connection, request_id, request)
+                    elif command == "UNSUBSCRIBE":
+                        self.handle_unsubscribe(connection, request_id)
+                    elif command == "DISCONNECT":
+                        #closing a stream leaves the control connection of the client alone
+                        if stream_grant is None:
+                            self.handle_disconnect(client_name)
                         disconnection_logged = True
-                        #remove client from self.clients immediately
-                        with self.clients_lock:
-                            if client_name in self.clients:
-                                del self.clients[client_name]
                         break
+                    else:
+                        connection.send_message(ERROR, request_id, message=f"Unknown command '{command}'.")
+                    settle_requests()
 
-                except socket.timeout:
+                except asyncio.TimeoutError:
                     self.log_message(f"Client {client_name} disconnected due to timeout.")
                     disconnection_logged = True
                     break
-                except (ConnectionResetError, BrokenPipeError) as conn_error:
+                except ProtocolError as protocol_error:
+                    self.log_message(f"Protocol error from client {client_name}: {protocol_error}")
+                    disconnection_logged = True
+                    break
+                except (ConnectionError, BrokenPipeError) as conn_error:
                     self.log_message(f"Client {client_name} disconnected unexpectedly: {conn_error}")
                     disconnection_logged = True
                     break
 
+        except asyncio.TimeoutError:
+            self.log_message("Client did not send a username in time.")
         except Exception as e:
             self.log_message(f"Error with client {client_name}: {e}")
         finally:
             #cleanup
             try:
+                self.subscribers.pop(connection, None)
+                if stream_grant is not None:
+                    self.detach_stream(connection, stream_grant)
+                else:
+                    self.revoke_streams(connection)
+                #uploads that never got their END frame are kept so they can be resumed
+                for upload in uploads.values():
+                    if 'batch' in upload:
+                        #a batch is only stored once all of it arrived, the client sends it again
+                        await self.discard_batch(upload)
+                        continue
+                    if 'session' in upload:
+                        #the chunk is not marked done and will be sent again
+                        upload['session']['writing'].discard(upload['index'])
+                        await self.close_upload(upload)
+                        continue
+                    try:
+                        await self.suspend_upload(upload)
+                        self.log_message(f"Upload of '{upload['filename']}' by {client_name} was interrupted, "
+                                         f"{upload['bytes_received']} of {upload['filesize']} bytes kept.")
+                    except Exception as e:
+                        self.log_message(f"Error keeping interrupted upload of '{upload['filename']}': {e}")
                 with self.clients_lock:
                     #remove if the client was registered by this handler
-                    if client_registered and client_name and client_name in self.clients:
+                    if client_registered and client_name and self.clients.get(client_name) is connection:
                         del self.clients[client_name]
+                        self.download_shaper.forget(client_name)
+                        self.upload_shaper.forget(client_name)
                         if not disconnection_logged:
                             self.log_message(f"Client {client_name} disconnected.")
-                client_socket.close()
+                connection.close()
             except Exception as e:
                 self.log_message(f"Error during cleanup for client {client_name}: {e}")
+            #slots of transfers that were interrupted go back as well, and they count as failed
+            for _ in held_slots:
+                self.transfer_slots.release()
+            for command, started in handling.values():
+                self.metrics.observe_request(command, time.perf_counter() - started, True)
+            self.connections.discard(connection)
+            self.closed_bytes['received'] += connection.bytes_received
+            self.closed_bytes['sent'] += connection.bytes_sent
+
+    def send_busy(self, connection, request_id):
+        #the client comes back after retry_after seconds instead of waiting on a saturated server
+        self.metrics.rejected += 1
+        connection.send_message(ERROR, request_id, message="Server is busy, try again later.",
+                                code="BUSY", retry_after=BUSY_RETRY_AFTER)
 
-    def handle_upload(self, client_name, client_socket, command):
+    async def handle_upload(self, client_name, connection, request_id, request, uploads):
         try:
-            parts = command.split(" ", 2)
-            if len(parts) < 3:
-                client_socket.send("ERROR: Invalid UPLOAD command format.".encode())
-                return
-            _, filename, filesize = parts
-            filename = filename.strip()
-            filesize = int(filesize.strip())
+            filename = str(request.get("filename", "")).strip()
+            filesize = int(request.get("size", -1))
+            offset = int(request.get("offset", 0))
+            validator = request.get("validator")
+            codec = request.get("codec")
 
             #checking the filenamee and the directory
             if not filename:
-                client_socket.send("ERROR: Filename cannot be empty.".encode())
+                connection.send_message(ERROR, request_id, message="Filename cannot be empty.")
+                return
+            if not is_valid_name(filename):
+                connection.send_message(ERROR, request_id, message=f"Invalid filename {filename!r}.")
+                return
+            if filesize < 0 or not 0 <= offset <= filesize:
+                connection.send_message(ERROR, request_id, message="Invalid UPLOAD command format.")
+                return
+            if codec is not None and codec not in CODECS:
+                connection.send_message(ERROR, request_id, message=f"Unsupported codec '{codec}'.")
                 return
             if not self.file_directory:
-                client_socket.send("ERROR: Server file directory not set.".encode())
+                connection.send_message(ERROR, request_id, message="Server file directory not set.")
+                return
+            if request_id in uploads:
+                connection.send_message(ERROR, request_id, message="Request ID already in use.")
                 return
 
             full_filename = f"{client_name}_{filename}"
-            filepath = os.path.join(self.file_directory, full_filename)
+            part_path, session_path = self.partial_paths(full_filename)
+            if part_path in self.partials_in_use:
+                connection.send_message(ERROR, request_id, message=f"'{filename}' is already being uploaded.")
+                return
 
-            #if the file already exists**
-            file_exists = os.path.exists(filepath)
+            #the data frames of this request are written to the partial file as they arrive
+            self.partials_in_use.add(part_path)
+            f = None
+            try:
+                f, hasher = await self.run_blocking(self.open_partial, full_filename, filesize, validator, offset)
+            except ValueError as e:
+                connection.send_message(ERROR, request_id, message=str(e))
+                return
+            finally:
+                if f is None:
+                    self.partials_in_use.discard(part_path)
+            uploads[request_id] = self.new_upload(filename, filesize, offset, f, hasher, codec,
+                                                  part_path=part_path, session_path=session_path, validator=validator)
+            if filesize > offset and hasattr(os, "posix_fallocate"):
+                await self.run_blocking(preallocate, f, filesize)
+
+        except (ValueError, TypeError):
+            connection.send_message(ERROR, request_id, message="Invalid UPLOAD command format.")
+        except Exception as e:
+            self.log_message(f"Unexpected error during upload: {e}")
+            connection.send_message(ERROR, request_id, message=str(e))
 
-            #receive and write the file data**
-            with open(filepath, "wb") as f:
-                bytes_received = 0
-                while bytes_received < filesize:
-                    chunk = client_socket.recv(min(4096, filesize - bytes_received))
-                    if not chunk:
-                        raise ConnectionError("Client disconnected during upload.")
-                    f.write(chunk)
-                    bytes_received += len(chunk)
+    def new_upload(self, filename, filesize, received, f, hasher, codec=None, **fields):
+        upload = {
+            'filename': filename,
+            'filesize': filesize,
+            'bytes_received': received,
+            'file': f,
+            #two receive buffers: one fills from the socket while the other is written to disk
+            'buffers': [bytearray(0), bytearray(0)],
+            'active': 0,
+            'filled': 0,
+            'batch_size': min(UPLOAD_BUFFER_MIN, filesize - received) or 1,
+            'pending_write': None,
+            'hasher': hasher,
+            #compressed uploads are decompressed before they are buffered, sizes and offsets stay uncompressed
+            'codec': codec,
+            'decompressor': CODECS[codec][1]() if codec else None,
+            'raw_bytes': 0,
+            'wire_bytes': 0,
+            'cpu': 0.0,
+        }
+        upload.update(fields)
+        return upload
 
-            with self.file_list_lock:
-                #remove existing entry if any
-                self.file_list = [
-                    (f, o) for f, o in self.file_list
-                    if not (f == filename and o == client_name)
-                ]
-                #adding the new file
-                self.file_list.append((filename, client_name))
-                self.update_file_list()
-
-            #displaying a message based on the existence of the fiile
-            if file_exists:
-                success_msg = f"UPLOAD_RESPONSE: File '{filename}' overwritten successfully."
+    async def handle_upload_status(self, client_name, connection, request_id, request):
+        #tells the client how much of an interrupted upload of the same file version the server holds
+        try:
+            filename = str(request.get("filename", "")).strip()
+            filesize = int(request.get("size", -1))
+            if not is_valid_name(filename) or filesize < 0:
+                connection.send_message(ERROR, request_id, message="Invalid UPLOAD_STATUS command format.")
+                return
+            if not self.file_directory:
+                connection.send_message(ERROR, request_id, message="Server file directory not set.")
+                return
+            offset = await self.run_blocking(self.partial_offset, f"{client_name}_{filename}", filesize, request.get("validator"))
+            connection.send_message(RESPONSE, request_id, filename=filename, offset=offset)
+        except (ValueError, TypeError):
+            connection.send_message(ERROR, request_id, message="Invalid UPLOAD_STATUS command format.")
+
+    def partial_paths(self, full_filename):
+        directory = os.path.join(self.file_directory, PARTIAL_DIRECTORY)
+        return os.path.join(directory, full_filename + ".part"), os.path.join(directory, full_filename + ".json")
+
+    def partial_offset(self, full_filename, filesize, validator):
+        #the client's validator (size and modification time of its copy) has to match, otherwise
+        #the kept bytes belong to another version of the file and the upload starts over
+        if not validator:
+            return 0
+        part_path, session_path = self.partial_paths(full_filename)
+        try:
+            with open(session_path, "r") as f:
+                session = json.load(f)
+            held = os.path.getsize(part_path)
+        except (OSError, ValueError):
+            return 0
+        if session.get("size") != filesize or session.get("validator") != validator:
+            return 0
+        return min(int(session.get("received", 0)), held)
+
+    def open_partial(self, full_filename, filesize, validator, offset):
+        #returns the partial file positioned at offset and the digest state of the bytes before it
+        part_path, session_path = self.partial_paths(full_filename)
+        hasher = hashlib.sha256()
+        if offset:
+            if self.partial_offset(full_filename, filesize, validator) < offset:
+                raise ValueError("There is no partial upload to resume from this offset.")
+            hash_file_prefix(part_path, offset, hasher)
+            f = open(part_path, "r+b", 0)
+            f.truncate(offset)
+            f.seek(offset)
+        else:
+            os.makedirs(os.path.dirname(part_path), exist_ok=True)
+            f = open(part_path, "wb", 0)
+        #received is only updated when the upload stops, preallocated blocks must not count as data
+        write_partial_session(session_path, filesize, validator, 0)
+        return f, hasher
+
+    def save_partial(self, upload):
+        with open(upload['part_path'], "r+b") as f:
+            f.truncate(upload['bytes_received'])
+        write_partial_session(upload['session_path'], upload['filesize'], upload['validator'], upload['bytes_received'])
+
+    def commit_partial(self, upload, record):
+        #the complete file replaces the old version in one step, downloads never see a half written file;
+        #returns the record it replaced
+        previous = self.add_to_file_list(record, upload['part_path'])
+        try:
+            os.remove(upload['session_path'])
+        except FileNotFoundError:
+            pass
+        return previous
+
+    def discard_partial(self, upload):
+        for path in (upload['part_path'], upload['session_path']):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def remove_stale_partials(self):
+        directory = os.path.join(self.file_directory, PARTIAL_DIRECTORY)
+        cutoff = time.time() - PARTIAL_MAX_AGE
+        removed = 0
+        try:
+            entries = os.scandir(directory)
+        except FileNotFoundError:
+            return
+        with entries:
+            for entry in entries:
+                try:
+                    if entry.stat().st_mtime < cutoff:
+                        os.remove(entry.path)
+                        removed += 1
+                except OSError:
+                    pass
+        if removed:
+            self.log_message(f"Removed {removed} abandoned partial upload files.")
+
+    async def handle_upload_data(self, connection, request_id, length, uploads):
+        upload = uploads.get(request_id)
+        if upload is None:
+            #data of an upload that was already rejected
+            await asyncio.wait_for(connection.skip(length), self.idle_timeout)
+            return
+        try:
+            if upload['decompressor']:
+                #a compressed frame is read whole, so its size is bounded
+                if length > MAX_COMPRESSED_FRAME:
+                    raise ValueError(f"Compressed data frame of {length} bytes is too large.")
+                payload = await asyncio.wait_for(connection.read_payload(length), self.idle_timeout)
+                length = 0
+                upload['wire_bytes'] += len(payload)
+                decompressor = upload['decompressor']
+                while True:
+                    remaining = upload['filesize'] - upload['bytes_received']
+                    #one byte more than expected is enough to tell the client sent too much
+                    limit = min(remaining + 1, DECOMPRESS_PIECE_SIZE)
+                    data, cpu = await self.run_blocking(decompress_block, decompressor, payload, limit)
+                    upload['cpu'] += cpu
+                    if len(data) > remaining:
+                        raise ValueError("Received more data than announced.")
+                    await self.buffer_upload(upload, memoryview(data))
+                    #a full piece means the frame may hold more output
+                    if len(data) < limit or decompressor.eof:
+                        return
+                    payload = pending_input(decompressor)
+            if upload['bytes_received'] + length > upload['filesize']:
+                raise ValueError("Received more data than announced.")
+            upload['raw_bytes'] += length
+            upload['wire_bytes'] += length
+            while length:
+                buffer = upload['buffers'][upload['active']]
+                if len(buffer) < upload['batch_size']:
+                    buffer = upload['buffers'][upload['active']] = bytearray(upload['batch_size'])
+                #recv_into the free part of the active buffer, no bytes objects per chunk
+                count = min(length, len(buffer) - upload['filled'])
+                view = memoryview(buffer)[upload['filled']:upload['filled'] + count]
+                await asyncio.wait_for(connection.readinto(view), self.idle_timeout)
+                upload['filled'] += count
+                upload['bytes_received'] += count
+                length -= count
+                if upload['filled'] == len(buffer):
+                    await self.flush_upload(upload)
+        except (ConnectionError, asyncio.TimeoutError):
+            raise
+        except Exception as e:
+            del uploads[request_id]
+            await self.close_upload(upload)
+            if 'session' in upload:
+                upload['session']['writing'].discard(upload['index'])
             else:
-                success_msg = f"UPLOAD_RESPONSE: File '{filename}' uploaded successfully."
+                await self.run_blocking(self.discard_partial, upload)
+                self.partials_in_use.discard(upload['part_path'])
+            self.log_message(f"Unexpected error during upload: {e}")
+            connection.send_message(ERROR, request_id, message=str(e))
+            #the rest of the frame still has to be read to stay in sync with the stream
+            await asyncio.wait_for(connection.skip(length), self.idle_timeout)
 
-            #sending the success message to the client**
-            self.log_message(success_msg)
-            client_socket.send(success_msg.encode())
+    async def buffer_upload(self, upload, data):
+        #copies decompressed data into the receive buffers, flushing them like received data
+        while data:
+            buffer = upload['buffers'][upload['active']]
+            if len(buffer) < upload['batch_size']:
+                buffer = upload['buffers'][upload['active']] = bytearray(upload['batch_size'])
+            count = min(len(data), len(buffer) - upload['filled'])
+            buffer[upload['filled']:upload['filled'] + count] = data[:count]
+            upload['filled'] += count
+            upload['bytes_received'] += count
+            upload['raw_bytes'] += count
+            data = data[count:]
+            if upload['filled'] == len(buffer):
+                await self.flush_upload(upload)
+
+    def record_compression(self, codec, raw_bytes, wire_bytes, cpu, description=None):
+        totals = self.compression_totals
+        totals['raw'] += raw_bytes
+        totals['wire'] += wire_bytes
+        totals['cpu'] += cpu
+        if description:
+            self.log_message(f"{description} compressed with {describe_savings(codec, raw_bytes, wire_bytes, cpu)}")
+
+    async def flush_upload(self, upload):
+        #waits for the previous batch, then hands the filled buffer to a disk thread
+        if upload['pending_write']:
+            await upload['pending_write']
+            upload['pending_write'] = None
+        if not upload['filled']:
+            return
+        view = memoryview(upload['buffers'][upload['active']])[:upload['filled']]
+        #hashing and writing the same batch run side by side, both release the gil;
+        #chunks of a multi-stream upload arrive out of order and are hashed once complete
+        tasks = [self.loop.run_in_executor(self.disk_executor, write_all, upload['file'], view)]
+        if upload['hasher']:
+            tasks.append(self.loop.run_in_executor(self.disk_executor, upload['hasher'].update, view))
+        upload['pending_write'] = asyncio.gather(*tasks)
+        upload['active'] ^= 1
+        upload['filled'] = 0
+        #batches grow while the upload keeps coming, so big files end up with few large writes
+        upload['batch_size'] = min(upload['batch_size'] * 2, UPLOAD_BUFFER_MAX, upload['filesize'])
+
+    async def close_upload(self, upload):
+        try:
+            if upload['pending_write']:
+                await upload['pending_write']
+        finally:
+            upload['pending_write'] = None
+            await self.run_blocking(upload['file'].close)
+
+    async def suspend_upload(self, upload):
+        #writes out what arrived and records it, the client continues from there with UPLOAD_STATUS
+        try:
+            try:
+                await self.flush_upload(upload)
+            finally:
+                await self.close_upload(upload)
+            await self.run_blocking(self.save_partial, upload)
+        finally:
+            self.partials_in_use.discard(upload['part_path'])
+
+    async def finish_upload(self, client_name, connection, request_id, uploads):
+        upload = uploads.pop(request_id, None)
+        if upload is None:
+            return
+        if 'session' in upload:
+            await self.finish_chunk(connection, request_id, upload)
+            return
+        try:
+            try:
+                await self.flush_upload(upload)
+            finally:
+                await self.close_upload(upload)
+            filename = upload['filename']
+            if upload['bytes_received'] != upload['filesize'] or (upload['decompressor'] and not upload['decompressor'].eof):
+                await self.run_blocking(self.save_partial, upload)
+                raise ConnectionError("Client ended the upload before sending the whole file.")
+            if upload['codec']:
+                self.record_compression(upload['codec'], upload['raw_bytes'], upload['wire_bytes'], upload['cpu'], f"Upload of '{filename}'")
+
+            record = FileRecord(filename, client_name, upload['filesize'], time.time(), upload['hasher'].hexdigest())
+            previous = await self.run_blocking(self.commit_partial, upload, record)
+            self.report_upload(connection, request_id, filename, previous is not None)
 
         except ConnectionError as conn_err:
             self.log_message(f"Connection error during upload: {conn_err}")
-            client_socket.send(f"ERROR: Connection error during upload.".encode())
+            connection.send_message(ERROR, request_id, message="Connection error during upload.")
         except Exception as e:
             self.log_message(f"Unexpected error during upload: {e}")
-            client_socket.send(f"ERROR: {e}".encode())
+            connection.send_message(ERROR, request_id, message=str(e))
+        finally:
+            self.partials_in_use.discard(upload['part_path'])
 
-    def load_file_list(self):
+    def report_upload(self, connection, request_id, filename, file_exists, **fields):
+        #displaying a message based on the existence of the fiile
+        if file_exists:
+            success_msg = f"File '{filename}' overwritten successfully."
+        else:
+            success_msg = f"File '{filename}' uploaded successfully."
+
+        #sending the success message to the client**
+        self.log_message(success_msg)
+        connection.send_message(RESPONSE, request_id, message=success_msg, filename=filename, overwritten=file_exists, **fields)
+
+    async def handle_upload_batch(self, client_name, connection, request_id, request, uploads):
+        #many small files in one request: the data frames carry their contents back to back, each
+        #file is written and hashed as soon as it is complete and all of them are committed together
         try:
-            file_list_path = os.path.join(self.file_directory, "file_list.txt")
+            files = request.get("files")
+            if not isinstance(files, list) or not 0 < len(files) <= MAX_BATCH_FILES:
+                connection.send_message(ERROR, request_id, message=f"A batch holds 1 to {MAX_BATCH_FILES} files.")
+                return
+            entries = [(str(entry["filename"]).strip(), int(entry["size"])) for entry in files]
+            if any(not filename or not 0 <= size <= MAX_BATCH_FILE_SIZE for filename, size in entries):
+                connection.send_message(ERROR, request_id, message=f"Files of a batch need a name and at most {MAX_BATCH_FILE_SIZE} bytes.")
+                return
+            invalid = [filename for filename, _ in entries if not is_valid_name(filename)]
+            if invalid:
+                connection.send_message(ERROR, request_id, message=f"Invalid filename {invalid[0]!r}.")
+                return
+            if len({filename for filename, _ in entries}) != len(entries):
+                connection.send_message(ERROR, request_id, message="A batch cannot name a file twice.")
+                return
+            if not self.file_directory:
+                connection.send_message(ERROR, request_id, message="Server file directory not set.")
+                return
+            if request_id in uploads:
+                connection.send_message(ERROR, request_id, message="Request ID already in use.")
+                return
+            directory = os.path.join(self.file_directory, PARTIAL_DIRECTORY)
+            await self.run_blocking(functools.partial(os.makedirs, directory, exist_ok=True))
+            batch = {
+                'batch': entries,
+                'index': 0,  #file the next data bytes belong to
+                'buffer': None,
+                'filled': 0,
+                'prefix': os.path.join(directory, f"{client_name}_batch_{secrets.token_hex(8)}_"),
+                'paths': [],  #written files that are not in the blob store yet
+                'digests': [],
+                'pending_write': None,
+            }
+            uploads[request_id] = batch
+            #empty files at the start are complete before any data arrives
+            await self.settle_batch(batch)
+        except (ValueError, TypeError, KeyError):
+            connection.send_message(ERROR, request_id, message="Invalid UPLOAD_BATCH command format.")
+        except Exception as e:
+            self.log_message(f"Unexpected error during upload: {e}")
+            connection.send_message(ERROR, request_id, message=str(e))
 
-            #creating the file if it doesn't exist
-            if not os.path.exists(file_list_path):
-                with open(file_list_path, "w") as f:
-                    pass 
+    async def receive_batch_data(self, connection, request_id, length, uploads):
+        batch = uploads[request_id]
+        try:
+            while length:
+                if batch['index'] == len(batch['batch']):
+                    raise ValueError("Received more data than announced.")
+                size = batch['batch'][batch['index']][1]
+                if batch['buffer'] is None:
+                    batch['buffer'] = bytearray(size)
+                count = min(length, size - batch['filled'])
+                view = memoryview(batch['buffer'])[batch['filled']:batch['filled'] + count]
+                await asyncio.wait_for(connection.readinto(view), self.idle_timeout)
+                batch['filled'] += count
+                length -= count
+                await self.settle_batch(batch)
+        except (ConnectionError, asyncio.TimeoutError):
+            raise
+        except Exception as e:
+            del uploads[request_id]
+            await self.discard_batch(batch)
+            self.log_message(f"Unexpected error during upload: {e}")
+            connection.send_message(ERROR, request_id, message=str(e))
+            await asyncio.wait_for(connection.skip(length), self.idle_timeout)
 
-            #reading the file list
-            with open(file_list_path, "r") as f:
-                lines = f.readlines()
+    async def settle_batch(self, batch):
+        #hands every complete file to a disk thread, its write overlaps with receiving the next one
+        while batch['index'] < len(batch['batch']):
+            size = batch['batch'][batch['index']][1]
+            if batch['filled'] < size:
+                return
+            if batch['pending_write']:
+                batch['digests'].append(await batch['pending_write'])
+                batch['pending_write'] = None
+            path = batch['prefix'] + str(batch['index'])
+            batch['paths'].append(path)
+            batch['pending_write'] = self.loop.run_in_executor(self.disk_executor, write_new_file, path, batch['buffer'] or b"")
+            batch['index'] += 1
+            batch['buffer'] = None
+            batch['filled'] = 0
 
-            #parsing the file list, handling potential formatting issues
-            self.file_list = []
-            for line in lines:
-                line = line.strip()
-                if line:
-                    try:
-                        filename, owner = line.split(",")
-                        self.file_list.append((filename, owner))
-                    except ValueError:
-                        self.log_message(f"Malformed line in file list: {line}")
+    async def finish_batch(self, client_name, connection, request_id, batch):
+        try:
+            if batch['index'] != len(batch['batch']):
+                raise ValueError("Client ended the batch before sending every file.")
+            if batch['pending_write']:
+                batch['digests'].append(await batch['pending_write'])
+                batch['pending_write'] = None
+            now = time.time()
+            records = [FileRecord(filename, client_name, size, now, digest)
+                       for (filename, size), digest in zip(batch['batch'], batch['digests'])]
+            #one catalog update and journal sync for the whole batch
+            previous = await self.run_blocking(self.add_records, list(zip(records, batch['paths'])))
+            files = [{'filename': record.filename, 'overwritten': replaced is not None} for record, replaced in zip(records, previous)]
+            success_msg = f"{len(records)} files uploaded successfully."
+            self.log_message(f"{client_name} uploaded {len(records)} files in one batch.")
+            connection.send_message(RESPONSE, request_id, message=success_msg, files=files)
+        except Exception as e:
+            self.log_message(f"Unexpected error during upload: {e}")
+            connection.send_message(ERROR, request_id, message=str(e))
+        finally:
+            await self.discard_batch(batch)
 
-            self.log_message(f"Loaded {len(self.file_list)} files from file list.")
+    async def discard_batch(self, batch):
+        #removes what was written but not stored, the blob store already took the rest
+        if batch['pending_write']:
+            try:
+                await batch['pending_write']
+            except Exception:
+                pass
+            batch['pending_write'] = None
+        for path in batch['paths']:
+            try:
+                await self.run_blocking(os.remove, path)
+            except FileNotFoundError:
+                pass
+
+    async def handle_upload_digest(self, client_name, connection, request_id, request):
+        #an upload of content the store already has is finished without any data being sent
+        try:
+            filename = str(request.get("filename", "")).strip()
+            filesize = int(request.get("size", -1))
+            digest = request.get("digest")
+            if not is_valid_name(filename) or filesize < 0 or not is_digest(digest):
+                connection.send_message(ERROR, request_id, message="Invalid UPLOAD_DIGEST command format.")
+                return
+            #the size of stored content is known from the catalog, the disk is not asked
+            if self.blobs is None or self.blobs.size(digest) != filesize:
+                connection.send_message(RESPONSE, request_id, filename=filename, stored=False)
+                return
+            record = FileRecord(filename, client_name, filesize, time.time(), digest)
+            try:
+                previous = await self.run_blocking(self.add_to_file_list, record)
+            except LookupError:
+                #the last copy was deleted in the meantime
+                connection.send_message(RESPONSE, request_id, filename=filename, stored=False)
+                return
+            self.report_upload(connection, request_id, filename, previous is not None, stored=True)
+        except (ValueError, TypeError):
+            connection.send_message(ERROR, request_id, message="Invalid UPLOAD_DIGEST command format.")
         except Exception as e:
-            self.log_message(f"Error loading file list: {e}")
-            self.file_list = []
+            self.log_message(f"Unexpected error during upload: {e}")
+            connection.send_message(ERROR, request_id, message=str(e))
 
-    def update_file_list(self):
+    def handle_open_streams(self, client_name, connection, request_id, stream_grant):
+        #hands out a transfer token, data connections of this client present it in ATTACH so file
+        #bytes never share the control connection with listings and notifications
+        if stream_grant is not None:
+            connection.send_message(ERROR, request_id, message="Streams can only be opened from the control connection.")
+            return
+        token = secrets.token_hex(16)
+        self.stream_grants[token] = {'client': client_name, 'control': connection, 'streams': set()}
+        connection.send_message(RESPONSE, request_id, token=token, max_streams=self.max_streams)
+
+    def attach_stream(self, connection, request_id, request):
+        grant = self.stream_grants.get(request.get("token")) if request.get("command") == "ATTACH" else None
+        if grant is None:
+            connection.send_message(ERROR, request_id, message="Invalid stream token.")
+            return None
+        if len(grant['streams']) >= self.max_streams:
+            connection.send_message(ERROR, request_id, message=f"At most {self.max_streams} streams are allowed.")
+            return None
+        grant['streams'].add(connection)
+        connection.send_message(RESPONSE, request_id, message="ATTACHED")
+        return grant
+
+    def detach_stream(self, connection, grant):
+        #a transfer token ends with the last data connection that used it
+        grant['streams'].discard(connection)
+        if not grant['streams']:
+            for token, other in list(self.stream_grants.items()):
+                if other is grant:
+                    del self.stream_grants[token]
+
+    def revoke_streams(self, connection):
+        #streams and upload sessions end with the control connection that opened them, the
+        #chunks already received stay in the manifest for the next attempt
+        for token, grant in list(self.stream_grants.items()):
+            if grant['control'] is connection:
+                del self.stream_grants[token]
+                for stream in grant['streams']:
+                    stream.close()
+        for token, session in list(self.upload_sessions.items()):
+            if session['control'] is connection:
+                del self.upload_sessions[token]
+                self.partials_in_use.discard(session['part_path'])
+
+    async def handle_open_upload(self, client_name, connection, request_id, request):
         try:
+            filename = str(request.get("filename", "")).strip()
+            filesize = int(request.get("size", -1))
+            chunk_size = min(max(int(request.get("chunk_size", TRANSFER_CHUNK_SIZE)), MIN_CHUNK_SIZE), MAX_CHUNK_SIZE)
+            validator = request.get("validator")
+            if not is_valid_name(filename) or filesize < 0:
+                connection.send_message(ERROR, request_id, message="Invalid OPEN_UPLOAD command format.")
+                return
+            if not self.file_directory:
+                connection.send_message(ERROR, request_id, message="Server file directory not set.")
+                return
+            full_filename = f"{client_name}_{filename}"
+            part_path, session_path = self.partial_paths(full_filename)
+            for token, session in list(self.upload_sessions.items()):
+                if session['part_path'] == part_path and not session['writing']:
+                    #an earlier attempt that was not finished, the new session continues from its manifest
+                    del self.upload_sessions[token]
+                    self.partials_in_use.discard(part_path)
+            if part_path in self.partials_in_use:
+                connection.send_message(ERROR, request_id, message=f"'{filename}' is already being uploaded.")
+                return
+
+            self.partials_in_use.add(part_path)
+            done = None
+            try:
+                done = await self.run_blocking(self.open_chunked_partial, full_filename, filesize, validator, chunk_size)
+            finally:
+                if done is None:
+                    self.partials_in_use.discard(part_path)
+
+            token = secrets.token_hex(16)
+            chunks = (filesize + chunk_size - 1) // chunk_size
+            self.upload_sessions[token] = {
+                'client': client_name,
+                'control': connection,
+                'filename': filename,
+                'part_path': part_path,
+                'session_path': session_path,
+                'validator': validator,
+                'filesize': filesize,
+                'chunk_size': chunk_size,
+                'chunks': chunks,
+                'done': done,
+                'writing': set(),  #chunks being received right now
+                'lock': threading.Lock(),  #manifest writes happen on disk threads
+            }
+            missing = [index for index in range(chunks) if index not in done]
+            connection.send_message(RESPONSE, request_id, session=token, chunk_size=chunk_size, chunks=chunks, missing=missing)
+        except (ValueError, TypeError):
+            connection.send_message(ERROR, request_id, message="Invalid OPEN_UPLOAD command format.")
+        except Exception as e:
+            self.log_message(f"Unexpected error opening upload: {e}")
+            connection.send_message(ERROR, request_id, message=str(e))
+
+    def open_chunked_partial(self, full_filename, filesize, validator, chunk_size):
+        #returns the chunks a previous attempt at the same file version already received
+        part_path, session_path = self.partial_paths(full_filename)
+        done = set()
+        try:
+            with open(session_path, "r") as f:
+                saved = json.load(f)
+            held = os.path.getsize(part_path)
+        except (OSError, ValueError):
+            saved = None
+        if saved and validator and saved.get("size") == filesize and saved.get("validator") == validator:
+            if saved.get("chunk_size") == chunk_size:
+                done = set(saved.get("done", []))
+            elif "chunk_size" not in saved:
+                #an interrupted single-stream upload covers the chunks below what it received
+                done = set(range(min(int(saved.get("received", 0)), held) // chunk_size))
+            f = open(part_path, "r+b")
+        else:
+            os.makedirs(os.path.dirname(part_path), exist_ok=True)
+            f = open(part_path, "wb")
+        with f:
+            if filesize and hasattr(os, "posix_fallocate"):
+                preallocate(f, filesize)
+            else:
+                f.truncate(filesize)
+        write_partial_session(session_path, filesize, validator, 0, chunk_size, done)
+        return done
+
+    def save_chunked_session(self, session, done):
+        with session['lock']:
+            write_partial_session(session['session_path'], session['filesize'], session['validator'], 0,
+                                  session['chunk_size'], done)
+
+    async def handle_upload_chunk(self, client_name, connection, request_id, request, uploads):
+        #one chunk of an OPEN_UPLOAD session, its data frames are written at the chunk's position
+        try:
+            session = self.upload_sessions.get(request.get("session"))
+            index = int(request.get("index", -1))
+            if session is None or session['client'] != client_name:
+                connection.send_message(ERROR, request_id, message="Unknown upload session.")
+                return
+            if not 0 <= index < session['chunks']:
+                connection.send_message(ERROR, request_id, message="Invalid chunk index.")
+                return
+            if index in session['writing'] or request_id in uploads:
+                connection.send_message(ERROR, request_id, message="Chunk is already being uploaded.")
+                return
+            codec = request.get("codec")
+            if codec is not None and codec not in CODECS:
+                connection.send_message(ERROR, request_id, message=f"Unsupported codec '{codec}'.")
+                return
+            start = index * session['chunk_size']
+            length = min(session['chunk_size'], session['filesize'] - start)
+            session['writing'].add(index)
+            f = None
+            try:
+                f = await self.run_blocking(open_at, session['part_path'], start)
+            finally:
+                if f is None:
+                    session['writing'].discard(index)
+            uploads[request_id] = self.new_upload(session['filename'], length, 0, f, None, codec, session=session, index=index)
+        except (ValueError, TypeError):
+            connection.send_message(ERROR, request_id, message="Invalid UPLOAD_CHUNK command format.")
+        except Exception as e:
+            self.log_message(f"Unexpected error during upload: {e}")
+            connection.send_message(ERROR, request_id, message=str(e))
+
+    async def finish_chunk(self, connection, request_id, upload):
+        session = upload['session']
+        try:
+            try:
+                await self.flush_upload(upload)
+            finally:
+                await self.close_upload(upload)
+            if upload['bytes_received'] != upload['filesize'] or (upload['decompressor'] and not upload['decompressor'].eof):
+                raise ConnectionError("Client ended the chunk before sending all of it.")
+            if upload['codec']:
+                #chunks only count towards the totals, logging each one would flood the log
+                self.record_compression(upload['codec'], upload['raw_bytes'], upload['wire_bytes'], upload['cpu'])
+            session['done'].add(upload['index'])
+            await self.run_blocking(self.save_chunked_session, session, sorted(session['done']))
+            connection.send_message(RESPONSE, request_id, index=upload['index'])
+        except ConnectionError as conn_err:
+            self.log_message(f"Connection error during upload: {conn_err}")
+            connection.send_message(ERROR, request_id, message="Connection error during upload.")
+        except Exception as e:
+            self.log_message(f"Unexpected error during upload: {e}")
+            connection.send_message(ERROR, request_id, message=str(e))
+        finally:
+            session['writing'].discard(upload['index'])
+
+    async def handle_finish_upload(self, client_name, connection, request_id, request):
+        token = request.get("session")
+        session = self.upload_sessions.get(token)
+        if session is None or session['client'] != client_name:
+            connection.send_message(ERROR, request_id, message="Unknown upload session.")
+            return
+        missing = session['chunks'] - len(session['done'])
+        if missing or session['writing']:
+            connection.send_message(ERROR, request_id, message=f"{missing} chunks of '{session['filename']}' are still missing.")
+            return
+        del self.upload_sessions[token]
+        try:
+            #the chunks arrived out of order, so the digest is computed from the finished file
+            hasher = hashlib.sha256()
+            await self.run_blocking(hash_file_prefix, session['part_path'], session['filesize'], hasher)
+            record = FileRecord(session['filename'], client_name, session['filesize'], time.time(), hasher.hexdigest())
+            previous = await self.run_blocking(self.commit_partial, session, record)
+            self.report_upload(connection, request_id, session['filename'], previous is not None)
+        except Exception as e:
+            self.log_message(f"Unexpected error during upload: {e}")
+            connection.send_message(ERROR, request_id, message=str(e))
+        finally:
+            self.partials_in_use.discard(session['part_path'])
+
+    async def handle_stat(self, connection, request_id, request):
+        #size and version of a stored file, used to split a download over several streams
+        filename = str(request.get("filename", "")).strip()
+        owner = str(request.get("owner", "")).strip()
+        if not filename or not owner:
+            connection.send_message(ERROR, request_id, message="Filename and owner cannot be empty.")
+            return
+        with self.file_list_lock:
+            record = self.catalog.get(owner, filename)
+        if record is None or not record.digest:
+            connection.send_message(ERROR, request_id, message="File does not exist.")
+            return
+        connection.send_message(RESPONSE, request_id, filename=filename, owner=owner, size=record.size,
+                                mtime=record.mtime, etag=record.digest)
+
+    def add_to_file_list(self, record, source=None):
+        #source is the finished upload to move into the blob store, without one the content has to
+        #be stored already (LookupError otherwise); returns the record that was replaced
+        return self.add_records([(record, source)])[0]
+
+    def add_records(self, entries):
+        #(record, source) pairs added under one lock, their journal lines share one sync;
+        #returns the replaced record (or None) of each
+        replaced = []
+        sequence = None
+        stored = []
+        unused = []
+        try:
+            #the uploads are moved into the blob store before the lock, the loop waits on it
+            for record, source in entries:
+                if source is not None:
+                    self.blobs.store(source, record.digest)
+                    stored.append(record.digest)
+            with self.file_list_lock:
+                for record, source in entries:
+                    if source is None and record.digest not in self.blobs:
+                        raise LookupError(record.digest)
+                    #replaces an existing entry of the same owner and filename
+                    previous = self.catalog.add(record)
+                    self.blobs.add_ref(record.digest, record.size)
+                    if previous and self.release_blob(previous.digest):
+                        unused.append(previous.digest)
+                    sequence = self.journal.append_add(record)
+                    self.record_change("OVERWRITE" if previous else "ADD", record)
+                    replaced.append(previous)
+                    self.compact_file_list()
+        finally:
+            unused += self.blobs.unpin(stored)
+            self.blobs.remove_unused(unused)
+            #the reply goes out once the changes are on disk, fsyncs are shared between concurrent writers
+            if sequence is not None:
+                self.journal.wait_synced(sequence)
+        return replaced
+
+    async def verify_metadata(self):
+        #requests trust the sizes in the catalog, this checks them against the disk now and then
+        #and drops records whose content is gone or damaged
+        while True:
+            await asyncio.sleep(self.verify_interval)
+            try:
+                with self.file_list_lock:
+                    records = list(self.catalog)
+                damaged = []
+                for start in range(0, len(records), VERIFY_BATCH):
+                    damaged += await self.run_blocking(self.check_blobs, records[start:start + VERIFY_BATCH])
+                    await asyncio.sleep(VERIFY_PAUSE)
+                if damaged:
+                    await self.run_blocking(self.drop_damaged_records, damaged)
+            except Exception as e:
+                self.log_message(f"Error verifying the catalog: {e}")
+
+    def check_blobs(self, records):
+        #returns (record, reason) for every record the disk disagrees with
+        damaged = []
+        sizes = {}
+        for record in records:
+            if not record.digest:
+                continue
+            if record.digest not in sizes:
+                try:
+                    sizes[record.digest] = os.stat(self.blobs.path(record.digest)).st_size
+                except FileNotFoundError:
+                    sizes[record.digest] = None
+            size = sizes[record.digest]
+            if size is None:
+                damaged.append((record, "its content is missing"))
+            elif size != record.size:
+                damaged.append((record, f"its content has {size} bytes instead of {record.size}"))
+        return damaged
+
+    def drop_damaged_records(self, damaged):
+        sequence = None
+        unused = []
+        with self.file_list_lock:
+            for record, reason in damaged:
+                #skipped when it was replaced or deleted after it was checked
+                if self.catalog.get(record.owner, record.filename) is not record:
+                    continue
+                self.catalog.remove(record.owner, record.filename)
+                sequence = self.journal.append_delete(record.owner, record.filename)
+                if self.release_blob(record.digest):
+                    unused.append(record.digest)
+                self.record_change("DELETE", record)
+                self.log_message(f"Removed '{record.filename}' of {record.owner} from the catalog, {reason}.")
+            self.compact_file_list()
+        self.blobs.remove_unused(unused)
+        if sequence is not None:
+            self.journal.wait_synced(sequence)
+
+    def release_blob(self, digest):
+        #called with file_list_lock held, cached copies of a content go together with its blob;
+        #returns whether the blob is unused now, the caller removes it once the lock is released
+        if not self.blobs.release(digest):
+            return False
+        if self.file_cache:
+            self.file_cache.invalidate(digest)
+        return True
+
+    def record_change(self, kind, record):
+        #called with file_list_lock held so events reach the loop in version order
+        event = self.changes.append(kind, record)
+        if self.loop and self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.publish_change, event)
+
+    def publish_change(self, event):
+        #runs on the event loop, pushes the event to every subscription that has not seen it
+        for connection, subscription in list(self.subscribers.items()):
+            if event['version'] <= subscription['version']:
+                continue
+            if subscription['backlog'] is not None:
+                #still streaming the snapshot, the event follows it
+                subscription['backlog'].append(event)
+                continue
+            self.send_change(connection, subscription, event)
+
+    def send_change(self, connection, subscription, event):
+        #a subscriber that does not read its events is dropped instead of buffering without limit
+        if connection.transport.get_write_buffer_size() > SUBSCRIBER_BUFFER_LIMIT:
+            del self.subscribers[connection]
+            connection.send_message(ERROR, subscription['request_id'], message="Subscription dropped because events were not read in time.", version=subscription['version'])
+            return
+        connection.send_message(EVENT, subscription['request_id'], **event)
+        subscription['version'] = event['version']
+
+    async def handle_subscribe(self, connection, request_id, request):
+        try:
+            if connection in self.subscribers:
+                connection.send_message(ERROR, request_id, message="Already subscribed.")
+                return
+            since = request.get("since")
+            epoch = request.get("epoch")
+
+            #the starting point and the registration happen together so no change is missed
+            with self.file_list_lock:
+                version = self.changes.version
+                events = None
+                if since is not None and epoch == self.changes.epoch:
+                    events = self.changes.since(int(since))
+                snapshot = self.catalog.candidates() if events is None else None
+                subscription = {'request_id': request_id, 'version': version, 'backlog': []}
+                self.subscribers[connection] = subscription
+
+            if events is not None:
+                #the client only needs what changed since its version
+                connection.send_message(RESPONSE, request_id, mode="incremental", epoch=self.changes.epoch, version=version, count=len(events))
+                for event in events:
+                    connection.send_message(EVENT, request_id, **event)
+            else:
+                connection.send_message(RESPONSE, request_id, mode="snapshot", epoch=self.changes.epoch, version=version, count=len(snapshot))
+                for start in range(0, len(snapshot), LIST_BATCH_SIZE):
+                    files = [{'filename': r.filename, 'owner': r.owner, 'size': r.size, 'mtime': r.mtime} for r in snapshot[start:start + LIST_BATCH_SIZE]]
+                    connection.send_message(DATA, request_id, files=files)
+                    await connection.drain()
+                connection.send_frame(END_FRAME, request_id)
+
+            #changes that happened while the snapshot was streamed
+            backlog, subscription['backlog'] = subscription['backlog'], None
+            for event in backlog:
+                if self.subscribers.get(connection) is subscription:
+                    self.send_change(connection, subscription, event)
+            self.log_message(f"Client subscribed to catalog changes from version {version}.")
+
+        except ConnectionError:
+            raise
+        except (ValueError, TypeError):
+            self.subscribers.pop(connection, None)
+            connection.send_message(ERROR, request_id, message="Invalid SUBSCRIBE command format.")
+        except Exception as e:
+            self.subscribers.pop(connection, None)
+            self.log_message(f"Error handling subscription: {e}")
+            connection.send_message(ERROR, request_id, message=str(e))
+
+    def handle_unsubscribe(self, connection, request_id):
+        subscription = self.subscribers.pop(connection, None)
+        if subscription is None:
+            connection.send_message(ERROR, request_id, message="Not subscribed.")
+            return
+        #the subscription request ends as well
+        connection.send_frame(END_FRAME, subscription['request_id'])
+        connection.send_message(RESPONSE, request_id, message="Unsubscribed.")
+
+    def compact_file_list(self):
+        #called with file_list_lock held, the journal is rotated and the snapshot written in the background
+        if self.journal.needs_compaction(len(self.catalog)):
+            self.journal.start_compaction(self.catalog_records)
+
+    def catalog_records(self):
+        with self.file_list_lock:
+            return list(self.catalog)
+
+    def load_file_list(self):
+        try:
+            #creating the file if it doesn't exist
             file_list_path = os.path.join(self.file_directory, "file_list.txt")
+            if not os.path.exists(file_list_path):
+                with open(file_list_path, "w") as f:
+                    pass 
 
-            #ensure directory exists
-            os.makedirs(os.path.dirname(file_list_path), exist_ok=True)
+            if self.journal:
+                self.journal.close()
+            self.journal = CatalogJournal(self.file_directory, log=self.log_message)
+            #versions restart with the loaded catalog, subscribers see a new epoch
+            self.changes = ChangeLog()
 
-            #write the file list
-            with open(file_list_path, "w") as f:
-                for filename, owner in self.file_list:
-                    f.write(f"{filename},{owner}\n")
+            #replaying the snapshot and the journal written since
+            with self.file_list_lock:
+                self.journal.load(self.catalog)
+                self.journal.open()
+                self.blobs = BlobStore(self.file_directory)
+                self.migrate_flat_files()
+                self.blobs.rebuild(self.catalog)
+                removed = self.blobs.collect_garbage()
+            if removed:
+                self.log_message(f"Removed {removed} unreferenced blobs.")
+            self.remove_stale_partials()
 
-            self.log_message(f"Updated file list with {len(self.file_list)} files.")
+            self.log_message(f"Loaded {len(self.catalog)} files from file list.")
         except Exception as e:
-            self.log_error(f"Error updating file list: {e}")
+            self.log_message(f"Error loading file list: {e}")
+            self.catalog.clear()
+
+    def migrate_flat_files(self):
+        #files stored as <owner>_<filename> before the blob store existed are moved into it once,
+        #called with file_list_lock held before the reference counts are built
+        flat_files = {entry.name for entry in os.scandir(self.file_directory) if entry.is_file()}
+        migrated = 0
+        for record in list(self.catalog):
+            flat_path = os.path.join(self.file_directory, f"{record.owner}_{record.filename}")
+            if os.path.basename(flat_path) not in flat_files:
+                continue
+            stat = os.stat(flat_path)
+            record.size = stat.st_size
+            record.mtime = record.mtime or stat.st_mtime
+            record.digest = file_digest(flat_path)
+            self.blobs.store(flat_path, record.digest)
+            self.blobs.unpin([record.digest])
+            self.journal.append_add(record)
+            migrated += 1
+        if migrated:
+            self.log_message(f"Moved {migrated} files into the blob store.")
 
-    def handle_list(self, client_socket):
+    async def handle_list(self, connection, request_id, request):
         try:
-            if not self.file_list:
-                self.load_file_list()
+            if self.journal is None and self.file_directory:
+                await self.run_blocking(self.load_file_list)
 
-            #preparing file list message
-            if self.file_list:
-                file_list_message = "\n".join([f"{filename} (Owner: {owner})" for filename, owner in self.file_list])
-                client_socket.send(file_list_message.encode())
-                self.log_message("File list sent to client.")
+            #reading the filters
+            owner = request.get("owner") or None
+            pattern = request.get("pattern") or None
+            sort = request.get("sort") or None
+            cursor = request.get("cursor")
+            page_size = request.get("page_size")
+            if sort is not None and sort not in SORT_KEYS:
+                connection.send_message(ERROR, request_id, message=f"Unknown sort key '{sort}'.")
+                return
+            if page_size is not None:
+                page_size = int(page_size)
+                if not 0 < page_size <= self.max_list_page_size:
+                    connection.send_message(ERROR, request_id, message=f"Page size must be between 1 and {self.max_list_page_size}.")
+                    return
+
+            #the lock is only held to copy the candidates, filtering and sorting run on a disk thread
+            with self.file_list_lock:
+                candidates = self.catalog.candidates(owner)
+            try:
+                page, next_cursor, total = await self.run_blocking(select_page, candidates, pattern, sort, cursor, page_size)
+            except (ValueError, TypeError):
+                connection.send_message(ERROR, request_id, message="Invalid cursor.")
+                return
+
+            #streaming the page in bounded batches, the header says how much is coming
+            connection.send_message(RESPONSE, request_id, total=total, count=len(page), next_cursor=next_cursor)
+            for start in range(0, len(page), LIST_BATCH_SIZE):
+                files = [{'filename': r.filename, 'owner': r.owner, 'size': r.size} for r in page[start:start + LIST_BATCH_SIZE]]
+                connection.send_message(DATA, request_id, files=files)
+                await connection.drain()
+            connection.send_frame(END_FRAME, request_id)
+            if page:
+                self.log_message(f"File list sent to client ({len(page)} of {total} files).")
             else:
-                client_socket.send("No files available.".encode())
                 self.log_message("File list is empty.")
 
+        except ConnectionError:
+            raise
         except Exception as e:
             error_message = f"Error handling file list: {e}"
             self.log_message(error_message)
             try:
-                client_socket.send(error_message.encode())
+                connection.send_message(ERROR, request_id, message=error_message)
             except:
                 pass
 
-    def handle_delete(self, client_name, client_socket, command):
+    async def handle_delete(self, client_name, connection, request_id, request):
         try:
-            parts = command.split(" ", 1)
-            if len(parts) < 2:
-                client_socket.send("ERROR: Invalid DELETE command format.".encode())
-                return
-            _, filename = parts
-            filename = filename.strip()
+            filename = str(request.get("filename", "")).strip()
             #checking the filename
             if not filename:
-                client_socket.send("ERROR: Filename cannot be empty.".encode())
+                connection.send_message(ERROR, request_id, message="Filename cannot be empty.")
                 return
 
-            full_filename = f"{client_name}_{filename}"
-            filepath = os.path.join(self.file_directory, full_filename)
-
-            with self.file_list_lock:
-                if (filename, client_name) in self.file_list:
-                    #deleting if the file exists
-                    if os.path.exists(filepath):
-                        os.remove(filepath)
-                        self.file_list.remove((filename, client_name))
-                        self.update_file_list()
-                        success_msg = f"DELETE_RESPONSE: File '{filename}' deleted successfully."
-                        client_socket.send(success_msg.encode())
-                        self.log_message(f"{client_name} deleted file '{filename}'.")
-                        #displaying an error message if the file does not exist
-                    else:
-                        client_socket.send("ERROR: File does not exist.".encode())
-                        self.log_message(f"{client_name} attempted to delete non-existent file '{filename}'.")
-                else:
-                    #check if the file exists but is owned by another client
-                    file_exists = False
-                    for f, o in self.file_list:
-                        if f == filename:
-                            file_exists = True
-                            if o != client_name:
-                                #if file is owned by someone else
-                                error_msg = "ERROR: You cannot delete a file you didn't upload."
-                                client_socket.send(error_msg.encode())
-                                self.log_message(f"{client_name} attempted to delete '{filename}' owned by '{o}'.")
-                                return
-                    if not file_exists:
-                        #if file does not exist 
-                        error_msg = f"ERROR: File '{filename}' does not exist."
-                        client_socket.send(error_msg.encode())
-                        self.log_message(error_msg)
+            #the file system and file list work happens off the event loop
+            error_msg = await self.run_blocking(self.delete_owned_file, client_name, filename)
+            if error_msg:
+                connection.send_message(ERROR, request_id, message=error_msg)
+            else:
+                success_msg = f"File '{filename}' deleted successfully."
+                connection.send_message(RESPONSE, request_id, message=success_msg)
 
         except Exception as e:
             error_msg = f"Error during file deletion: {e}"
             self.log_message(error_msg)
             try:
-                client_socket.send(f"ERROR: {e}".encode())
+                connection.send_message(ERROR, request_id, message=str(e))
             except:
                 self.log_message("Failed to send error message to client.")
 
-    def handle_download(self, client_name, client_socket, command):
+    async def handle_delete_batch(self, client_name, connection, request_id, request):
         try:
-            parts = command.split(" ", 2)
-            if len(parts) < 3:
-                client_socket.send("ERROR: Invalid DOWNLOAD command format.".encode())
+            filenames = request.get("filenames")
+            if not isinstance(filenames, list) or not 0 < len(filenames) <= MAX_BATCH_FILES:
+                connection.send_message(ERROR, request_id, message=f"A batch holds 1 to {MAX_BATCH_FILES} files.")
+                return
+            filenames = [str(filename).strip() for filename in filenames]
+            if not all(filenames):
+                connection.send_message(ERROR, request_id, message="Filename cannot be empty.")
                 return
-            _, filename, owner = parts
-            filename = filename.strip()
-            owner = owner.strip()
+            #files that cannot be deleted are reported, the others are deleted anyway
+            errors = await self.run_blocking(self.delete_owned_files, client_name, filenames)
+            deleted = [filename for filename in dict.fromkeys(filenames) if filename not in errors]
+            connection.send_message(RESPONSE, request_id, message=f"{len(deleted)} files deleted successfully.",
+                                    deleted=deleted, errors=errors)
+        except Exception as e:
+            self.log_message(f"Error during file deletion: {e}")
+            connection.send_message(ERROR, request_id, message=str(e))
+
+    def delete_owned_file(self, client_name, filename):
+        #returns an error message for the client or None if the file was deleted
+        return self.delete_owned_files(client_name, [filename]).get(filename)
+
+    def delete_owned_files(self, client_name, filenames):
+        #deletes under one lock with one journal sync, returns filename -> error message for the client
+        errors = {}
+        deleted = []
+        sequence = None
+        unused = []
+        with self.file_list_lock:
+            for filename in filenames:
+                if (client_name, filename) in self.catalog:
+                    #the content is only removed when no other file refers to it
+                    record = self.catalog.remove(client_name, filename)
+                    sequence = self.journal.append_delete(client_name, filename)
+                    if self.release_blob(record.digest):
+                        unused.append(record.digest)
+                    self.record_change("DELETE", record)
+                    self.compact_file_list()
+                    deleted.append(filename)
+                    continue
+                if filename in deleted:
+                    continue
+
+                #check if the file exists but is owned by another client
+                owners = self.catalog.owners_of(filename)
+                if owners:
+                    #if file is owned by someone else
+                    self.log_message(f"{client_name} attempted to delete '{filename}' owned by '{owners[0]}'.")
+                    errors[filename] = "You cannot delete a file you didn't upload."
+                    continue
+
+                #if file does not exist 
+                error_msg = f"File '{filename}' does not exist."
+                self.log_message(error_msg)
+                errors[filename] = error_msg
+
+        self.blobs.remove_unused(unused)
+        if sequence is not None:
+            self.journal.wait_synced(sequence)
+        for filename in deleted:
+            self.log_message(f"{client_name} deleted file '{filename}'.")
+        return errors
+
+    async def handle_download(self, client_name, connection, request_id, request):
+        try:
+            filename = str(request.get("filename", "")).strip()
+            owner = str(request.get("owner", "")).strip()
+            #optional byte range, a client resuming a download asks for the bytes after what it has
+            offset = int(request.get("offset", 0))
+            length = request.get("length")
+            length = None if length is None else int(length)
 
             #checking filename and owner
             if not filename or not owner:
-                client_socket.send("ERROR: Filename and owner cannot be empty.".encode())
+                connection.send_message(ERROR, request_id, message="Filename and owner cannot be empty.")
                 return
-            full_filename = f"{owner}_{filename}"
-            filepath = os.path.join(self.file_directory, full_filename)
+            if offset < 0 or (length is not None and length < 0):
+                connection.send_message(ERROR, request_id, message="Invalid DOWNLOAD command format.")
+                return
+            with self.file_list_lock:
+                record = self.catalog.get(owner, filename)
 
             #displaying an error message if the file does not exist
-            if not os.path.exists(filepath):
-                client_socket.send("ERROR: File does not exist.".encode())
+            if record is None or not record.digest:
+                connection.send_message(ERROR, request_id, message="File does not exist.")
                 return
-            file_size = os.path.getsize(filepath)
-            client_socket.send(f"FILESIZE {file_size}".encode())
-
-            #waiting for client's READY acknowledgment
+            file_size = record.size
+            #the content digest names exactly one version, a range of another version would corrupt the copy
+            etag = record.digest
+            if request.get("if_range") not in (None, etag):
+                offset, length = 0, None
+            if offset > file_size:
+                connection.send_message(ERROR, request_id, message="Requested range is outside the file.")
+                return
+            count = file_size - offset if length is None else min(length, file_size - offset)
+            #compressed when the client accepts a codec we know and the content is worth it
+            codec = choose_codec(request.get("codecs"))
             try:
-                ready_message = client_socket.recv(1024).decode().strip()
-                if ready_message != "READY":
-                    self.log_message(f"Client {client_name} did not send READY. Aborting download.")
-                    return
-            except socket.timeout:
-                self.log_message(f"Timeout waiting for READY from {client_name}. Aborting download.")
+                if codec and (count < MIN_COMPRESS_SIZE or not await self.is_compressible(record.digest)):
+                    codec = None
+                #small files come from memory, everything else is opened and streamed
+                content = f = None
+                if self.file_cache and self.file_cache.accepts(file_size) and (not codec or count == file_size):
+                    content = await self.cached_content(record, codec, filename)
+                else:
+                    f = await self.run_blocking(open, self.blobs.path(record.digest), "rb")
+            except FileNotFoundError:
+                connection.send_message(ERROR, request_id, message="File does not exist.")
                 return
+            try:
+                #the size and range go out in the reply header, the data frames of this request follow it
+                connection.send_message(RESPONSE, request_id, filename=filename, owner=owner, size=file_size,
+                                        offset=offset, length=count, etag=etag, codec=codec)
 
-            #notifying the owner that their file is being downloaded
-            owner_socket = self.get_client_socket(owner)
-            if owner_socket:
-                owner_socket.send(f"NOTIFICATION: Your file '{filename}' was downloaded by '{client_name}'.".encode())
-                self.log_message(f"Sent download notification to {owner}")
+                #notifying the owner that their file is being downloaded, resumed transfers are not reported again
+                owner_connection = self.get_client_socket(owner)
+                if owner_connection and offset == 0:
+                    owner_connection.post(NOTIFICATION, NO_REQUEST, message=f"Your file '{filename}' was downloaded by '{client_name}'.")
+                    self.log_message(f"Sent download notification to {owner}")
 
-            #sending the file data
-            with open(filepath, "rb") as f:
-                while True:
-                    chunk = f.read(4096)
-                    if not chunk:
-                        break
-                    client_socket.sendall(chunk)
+                #sending the file data
+                if content is not None:
+                    if not codec:
+                        content = memoryview(content)[offset:offset + count]
+                    await self.send_data(client_name, connection, request_id, content)
+                elif codec:
+                    await self.send_file_compressed(client_name, connection, request_id, f, offset, count, codec, filename)
+                else:
+                    await self.send_file_range(client_name, connection, request_id, f, offset, count)
+            finally:
+                if f:
+                    await self.run_blocking(f.close)
+            connection.send_frame(END_FRAME, request_id)
             self.log_message(f"File '{filename}' sent to {client_name}.")
+        except ConnectionError:
+            raise
+        except (ValueError, TypeError):
+            connection.send_message(ERROR, request_id, message="Invalid DOWNLOAD command format.")
         except Exception as e:
             self.log_message(f"Unexpected error during download: {e}")
-            client_socket.send(f"ERROR: {e}".encode())
+            connection.send_message(ERROR, request_id, message=str(e))
+
+    async def handle_download_batch(self, client_name, connection, request_id, request):
+        #the reply lists the files with their sizes, their contents follow back to back as data frames
+        try:
+            files = request.get("files")
+            if not isinstance(files, list) or not 0 < len(files) <= MAX_BATCH_FILES:
+                connection.send_message(ERROR, request_id, message=f"A batch holds 1 to {MAX_BATCH_FILES} files.")
+                return
+            names = [(str(entry["owner"]).strip(), str(entry["filename"]).strip()) for entry in files]
+            with self.file_list_lock:
+                records = [self.catalog.get(owner, filename) for owner, filename in names]
+            entries = []
+            for (owner, filename), record in zip(names, records):
+                if record is None or not record.digest:
+                    entries.append({'owner': owner, 'filename': filename, 'error': "File does not exist."})
+                else:
+                    entries.append({'owner': owner, 'filename': filename, 'size': record.size, 'etag': record.digest})
+            records = [record for record in records if record is not None and record.digest]
+            connection.send_message(RESPONSE, request_id, files=entries)
+            self.notify_downloads(client_name, records)
+            for record in records:
+                await self.send_blob(client_name, connection, request_id, record)
+            connection.send_frame(END_FRAME, request_id)
+            self.log_message(f"{len(records)} files sent to {client_name} in one batch.")
+        except ConnectionError:
+            raise
+        except (ValueError, TypeError, KeyError):
+            connection.send_message(ERROR, request_id, message="Invalid DOWNLOAD_BATCH command format.")
+        except Exception as e:
+            self.log_message(f"Unexpected error during download: {e}")
+            connection.send_message(ERROR, request_id, message=str(e))
+
+    async def handle_download_archive(self, client_name, connection, request_id, request):
+        #a tar stream of the selected files, built while it is sent: headers and padding come from
+        #memory and the file contents straight from the blob store, nothing is staged on disk
+        try:
+            owner = request.get("owner") or None
+            pattern = request.get("pattern") or None
+            with self.file_list_lock:
+                records = [record for record in self.catalog.candidates(owner)
+                           if record.digest and (not pattern or matches_name(record.filename, pattern))]
+            if not records:
+                connection.send_message(ERROR, request_id, message="No files match the selection.")
+                return
+            #the size is known up front so the client can show progress; headers are built again
+            #while sending rather than held in memory for large selections
+            size = 2 * tarfile.BLOCKSIZE
+            for record in records:
+                size += len(tar_header(record)) + record.size + tar_padding(record.size)
+            connection.send_message(RESPONSE, request_id, count=len(records), size=size)
+            self.notify_downloads(client_name, records)
+            for record in records:
+                connection.send_frame(DATA, request_id, tar_header(record))
+                await self.send_blob(client_name, connection, request_id, record)
+                padding = tar_padding(record.size)
+                if padding:
+                    connection.send_frame(DATA, request_id, bytes(padding))
+                await connection.drain()
+            #two zero blocks end the archive
+            connection.send_frame(DATA, request_id, bytes(2 * tarfile.BLOCKSIZE))
+            connection.send_frame(END_FRAME, request_id)
+            self.log_message(f"Archive of {len(records)} files sent to {client_name}.")
+        except ConnectionError:
+            raise
+        except Exception as e:
+            self.log_message(f"Unexpected error during download: {e}")
+            connection.send_message(ERROR, request_id, message=str(e))
+
+    async def send_blob(self, client_name, connection, request_id, record):
+        #the whole content of a stored file as data frames of the request; batches and archives
+        #use cached contents but do not fill the cache, a large selection would push out the hot files
+        content = self.file_cache.get(record.digest) if self.file_cache and self.file_cache.accepts(record.size) else None
+        if content is not None:
+            await self.send_data(client_name, connection, request_id, content)
+            return
+        f = await self.run_blocking(open, self.blobs.path(record.digest), "rb")
+        try:
+            await self.send_file_range(client_name, connection, request_id, f, 0, record.size)
+        finally:
+            await self.run_blocking(f.close)
+
+    def notify_downloads(self, client_name, records):
+        #one notification per owner instead of one per file
+        for owner, count in collections.Counter(record.owner for record in records).items():
+            owner_connection = self.get_client_socket(owner)
+            if owner_connection:
+                owner_connection.post(NOTIFICATION, NO_REQUEST, message=f"{count} of your files were downloaded by '{client_name}'.")
+
+    async def cached_content(self, record, codec, filename):
+        #the raw content, or the whole content compressed with codec, of a small file; read into the
+        #cache on a miss. compressed copies are made once and sent as they are on every later hit
+        content = self.file_cache.get(record.digest, codec)
+        if content is not None:
+            if codec:
+                self.record_compression(codec, record.size, len(content), 0.0)
+            return content
+        content = await self.run_blocking(read_file, self.blobs.path(record.digest))
+        if len(content) != record.size:
+            raise OSError(f"Stored content of '{filename}' does not match its size.")
+        if not codec:
+            self.file_cache.put(record.digest, None, content)
+        if codec:
+            content, cpu = await self.run_blocking(compress_block, CODECS[codec][0](), content, True)
+            self.file_cache.put(record.digest, codec, content)
+            self.record_compression(codec, record.size, len(content), cpu, f"Download of '{filename}'")
+        return content
+
+    async def is_compressible(self, digest):
+        #sampling reads the file, so the answer is remembered per content
+        compressible = self.compressible.get(digest)
+        if compressible is None:
+            compressible = await self.run_blocking(is_compressible, self.blobs.path(digest))
+            if len(self.compressible) >= COMPRESSIBLE_CACHE_SIZE:
+                self.compressible.clear()
+            self.compressible[digest] = compressible
+        return compressible
+
+    async def send_file_compressed(self, client_name, connection, request_id, f, offset, count, codec, filename):
+        #reading and compressing a block happen on a disk thread, the frames carry compressed bytes
+        compressor = CODECS[codec][0]()
+        await self.run_blocking(f.seek, offset)
+        raw_bytes = wire_bytes = 0
+        cpu = 0.0
+        while count:
+            block = await self.run_blocking(f.read, min(COMPRESS_BLOCK_SIZE, count))
+            if not block:
+                raise ConnectionError("File changed size while it was being sent.")
+            count -= len(block)
+            raw_bytes += len(block)
+            output, used = await self.run_blocking(compress_block, compressor, block, not count)
+            cpu += used
+            for piece in frame_slices(output):
+                await self.download_shaper.wait(client_name, len(piece))
+                connection.send_frame(DATA, request_id, piece)
+                wire_bytes += len(piece)
+                await connection.drain()
+        self.record_compression(codec, raw_bytes, wire_bytes, cpu, f"Download of '{filename}'")
+
+    async def send_data(self, client_name, connection, request_id, data):
+        #data frames from memory, cut into slices that wait for their turn when bandwidth is limited
+        view = memoryview(data)
+        if not view:
+            return
+        step = SHAPING_SLICE if self.download_shaper else len(view)
+        for start in range(0, len(view), step):
+            chunk = view[start:start + step]
+            await self.download_shaper.wait(client_name, len(chunk))
+            connection.send_frame(DATA, request_id, chunk)
+
+    async def send_file_range(self, client_name, connection, request_id, f, offset, count):
+        if not self.use_sendfile:
+            await self.send_file_chunked(client_name, connection, request_id, f, offset, count)
+            return
+        #zero-copy in one go, or in slices that wait for their turn when bandwidth is limited
+        step = SHAPING_SLICE if self.download_shaper else count
+        end = offset + count
+        while offset < end:
+            size = min(step, end - offset)
+            await self.download_shaper.wait(client_name, size)
+            await connection.send_file(request_id, f, offset, size)
+            offset += size
+
+    async def send_file_chunked(self, client_name, connection, request_id, f, offset, count):
+        #copying through python, used where the kernel cannot send files directly
+        await self.run_blocking(f.seek, offset)
+        while count:
+            chunk = await self.run_blocking(f.read, min(CHUNK_SIZE, count))
+            if not chunk:
+                raise ConnectionError("File changed size while it was being sent.")
+            await self.download_shaper.wait(client_name, len(chunk))
+            connection.send_frame(DATA, request_id, chunk)
+            count -= len(chunk)
+            await connection.drain()
 
     def handle_disconnect(self, client_name):
-        if client_name in self.clients:
-            self.clients[client_name].close()
-            del self.clients[client_name]
+        with self.clients_lock:
+            connection = self.clients.pop(client_name, None)
+        if connection:
+            connection.close()
             self.log_message(f"Client {client_name} disconnected.")
 
     def log_message(self, message):
-        try:
-            self.log_listbox.insert(END, message)
-            
-            with open('server_log.txt', 'a') as log_file:
-                log_file.write(message + '\n')
-        except Exception as e:
-            print(f"Logging error: {e}")
+        #never blocks: the writer thread batches lines to disk and the gui drains its ring buffer
+        self.log_writer.write(message)
 
     def log_error(self, error):
         error_trace = traceback.format_exc()
         full_error_message = f"Error: {error}\nTrace: {error_trace}"
         self.error_log.append(full_error_message)
         self.log_message(full_error_message)
+        self.error_writer.write(full_error_message + '\n')
 
-        
-        try:
-            with open('server_error_log.txt', 'a') as error_file:
-                error_file.write(full_error_message + '\n\n')
-        except:
-            print("Could not write to error log file")
-
-    def setup_gui(self):
+    def setup_gui(self, port=None):
+        #tkinter is only imported when there is a window to show
+        from tkinter import Tk, Label, Button, Listbox, Scrollbar, Entry
         self.root = Tk()
         self.root.title("Server")
         self.root.geometry("600x400")
@@ -392,6 +2005,8 @@ class Server:
         Label(self.root, text="Port:").pack()
         self.port_entry = Entry(self.root, width=30)
         self.port_entry.pack()
+        if port is not None:
+            self.port_entry.insert(0, str(port))
         self.start_button = Button(self.root, text="Start Server", command=self.start_server_gui)
         self.start_button.pack()
         Button(self.root, text="Select Directory", command=self.select_directory).pack()
@@ -402,8 +2017,24 @@ class Server:
         scrollbar.pack(side="right", fill="y")
         self.log_listbox.config(yscrollcommand=scrollbar.set)
         self.root.protocol("WM_DELETE_WINDOW", self.close_server)
+        self.process_log_buffer()
         self.root.mainloop()
 
+    def process_log_buffer(self):
+        #only the tk thread touches the listbox, it picks up new lines every 100 milliseconds
+        try:
+            lines = self.log_writer.drain_recent(GUI_LOG_BATCH)
+            if lines:
+                self.log_listbox.insert("end", *lines)
+                overflow = self.log_listbox.size() - GUI_LOG_LINES
+                if overflow > 0:
+                    self.log_listbox.delete(0, overflow - 1)
+                self.log_listbox.yview_moveto(1)
+        except Exception as e:
+            print(f"Logging error: {e}")
+        finally:
+            self.root.after(100, self.process_log_buffer)
+
     def start_server_gui(self):
         if not self.file_directory:
             self.log_message("Error: File directory must be selected before starting the server.")
@@ -421,27 +2052,7 @@ class Server:
 
     def close_server(self):
         try:
-            self.log_message("Shutting down server...")
-
-            #notifying all clients that the server is shutdown
-            with self.clients_lock:
-                for client_name in list(self.clients.keys()):
-                    client_socket = self.clients[client_name]
-                    try:
-                        shutdown_message = "SERVER_SHUTDOWN: The server is closing."
-                        client_socket.sendall(shutdown_message.encode('utf-8'))
-                        self.log_message(f"Sent shutdown notification to {client_name}")
-                        client_socket.close()
-                    except Exception as e:
-                        self.log_message(f"Error notifying client {client_name}: {e}")
-                    finally:
-                        self.log_message(f"Disconnected client {client_name}")
-                        self.clients.pop(client_name, None)  # Remove client from the list
-
-            #stop accepting new clients
-            if self.server_socket:
-                self.server_socket.close()
-                self.server_socket = None
+            self.stop_server()
 
             #reenable start button
             self.start_button.config(state='normal')
@@ -449,14 +2060,69 @@ class Server:
             #exit the application
             self.root.quit()
             self.root.destroy()
-            self.log_message("Server closed successfully.")
         except Exception as e:
             self.log_message(f"Error closing server: {e}")
             self.root.quit()
             self.root.destroy()
+        finally:
+            #writing out what is still queued
+            self.log_writer.close()
+            self.error_writer.close()
+
+    def stop_server(self):
+        #graceful stop shared by the gui and the headless daemon: clients are told, then everything closes
+        self.log_message("Shutting down server...")
+
+        #the connections belong to the event loop, so the shutdown runs there
+        if self.loop and self.loop.is_running():
+            asyncio.run_coroutine_threadsafe(self.shutdown(), self.loop).result(timeout=10)
+
+        #stop accepting new clients
+        if self.server_socket:
+            self.server_socket.close()
+            self.server_socket = None
+        if self.disk_executor:
+            self.disk_executor.shutdown(wait=False)
+            self.disk_executor = None
+        if self.journal:
+            self.journal.close()
+        if self.file_cache:
+            stats = self.file_cache.stats()
+            self.log_message(f"File cache: {stats['hits']} hits, {stats['misses']} misses, {stats['evictions']} evictions, "
+                             f"{stats['bytes']} of {stats['max_bytes']} bytes in use.")
+        self.log_message("Server closed successfully.")
+
+    async def shutdown(self):
+        #notifying all clients that the server is shutdown; the notices are queued behind whatever the
+        #clients still have to receive and flushed side by side, a slow client holds up the rest for at most 2s
+        with self.clients_lock:
+            clients = list(self.clients.items())
+            self.clients.clear()
+        for client_name, connection in clients:
+            connection.post(SHUTDOWN, NO_REQUEST, message="The server is closing.")
+        results = await asyncio.gather(*(asyncio.wait_for(connection.flush(), 2) for _, connection in clients),
+                                       return_exceptions=True)
+        for (client_name, connection), result in zip(clients, results):
+            if isinstance(result, Exception):
+                self.log_message(f"Error notifying client {client_name}: {str(result) or type(result).__name__}")
+            else:
+                self.log_message(f"Sent shutdown notification to {client_name}")
+            connection.close()
+            self.log_message(f"Disconnected client {client_name}")
+
+        if self.verify_task:
+            self.verify_task.cancel()
+            self.verify_task = None
+        if self.metrics_server:
+            self.metrics_server.close()
+            self.metrics_server = None
+        if self.async_server:
+            self.async_server.close()
+            self.async_server = None
 
     def select_directory(self):
         #selecting the directory for the files to upload
+        from tkinter import filedialog
         selected_directory = filedialog.askdirectory()
         if not selected_directory:
             self.log_message("Directory not selected.")
@@ -466,6 +2132,7 @@ class Server:
         self.load_file_list()
 
     def show_errors(self):
+        from tkinter import Tk, Text, END, messagebox
         if not self.error_log:
             messagebox.showinfo("Errors", "No errors logged.")
             return
@@ -480,6 +2147,106 @@ class Server:
 
         error_window.mainloop()
 
+#settings accepted in the [server] section of the config file and as command line flags
+CONFIG_TYPES = {
+    'port': int,
+    'host': str,
+    'directory': str,
+    'log_file': str,
+    'error_log_file': str,
+    'log_max_bytes': int,
+    'log_backup_count': int,
+    'disk_workers': int,
+    'idle_timeout': float,
+    'max_list_page_size': int,
+    'max_streams': int,
+    'verify_interval': float,
+    'cache_bytes': int,
+    'cache_max_file_size': int,
+    'client_rate_limit': int,
+    'global_rate_limit': int,
+    'backlog': int,
+    'max_connections': int,
+    'max_transfers': int,
+    'max_queued_transfers': int,
+    'metrics_port': int,
+    'metrics_host': str,
+}
+
+
+def load_config(path):
+    parser = configparser.ConfigParser()
+    if not parser.read(path):
+        raise ValueError(f"Config file '{path}' could not be read.")
+    if not parser.has_section("server"):
+        raise ValueError(f"Config file '{path}' has no [server] section.")
+    settings = {}
+    for key, value in parser.items("server"):
+        if key not in CONFIG_TYPES:
+            raise ValueError(f"Unknown setting '{key}' in '{path}'.")
+        settings[key] = CONFIG_TYPES[key](value)
+    return settings
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser(description="File sharing server. Starts the GUI unless --headless is given.")
+    parser.add_argument("--headless", action="store_true", help="run without a window, configured by flags or --config")
+    parser.add_argument("--config", help="INI file with a [server] section using the setting names below")
+    for key, value_type in CONFIG_TYPES.items():
+        parser.add_argument("--" + key.replace("_", "-"), dest=key, type=value_type)
+    return parser.parse_args(argv)
+
+
+def run_headless(settings):
+    for key in ('port', 'directory'):
+        if settings.get(key) is None:
+            print(f"Error: '{key}' must be given with --{key} or in the config file.", file=sys.stderr)
+            return 2
+
+    port = settings.pop('port')
+    directory = settings.pop('directory')
+    server = Server(gui_log=False, **settings)
+    os.makedirs(directory, exist_ok=True)
+    server.file_directory = directory
+    server.log_message(f"File directory set to: {directory}")
+    server.load_file_list()
+    if not server.start_server(port):
+        server.log_writer.close()
+        server.error_writer.close()
+        return 1
+
+    #SIGTERM and ctrl-c stop the server the same way the close button does
+    stop_requested = threading.Event()
+    def request_stop(signum, frame):
+        stop_requested.set()
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+    while not stop_requested.wait(1):
+        pass
+
+    try:
+        server.stop_server()
+    finally:
+        server.log_writer.close()
+        server.error_writer.close()
+    return 0
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    settings = load_config(args.config) if args.config else {}
+    settings.update({key: getattr(args, key) for key in CONFIG_TYPES if getattr(args, key) is not None})
+    if args.headless:
+        return run_headless(settings)
+    port = settings.pop('port', None)
+    directory = settings.pop('directory', None)
+    server = Server(**settings)
+    if directory:
+        server.file_directory = directory
+        server.load_file_list()
+    server.setup_gui(port)
+    return 0
+
+
 if __name__ == "__main__":
-    server = Server()
-    server.setup_gui()
+    sys.exit(main())
@@ -0,0 +1,29 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server import Server
+
+
+@pytest.fixture
+def start_server(tmp_path):
+    #headless servers on a free port with their files and logs under tmp_path, stopped after the test
+    servers = []
+
+    def start(**options):
+        server = Server(log_file=str(tmp_path / "server_log.txt"), error_log_file=str(tmp_path / "server_error_log.txt"),
+                        gui_log=False, **options)
+        server.file_directory = str(tmp_path / "files")
+        os.makedirs(server.file_directory, exist_ok=True)
+        server.load_file_list()
+        assert server.start_server(0)
+        server.port = server.server_socket.getsockname()[1]
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.stop_server()
@@ -0,0 +1,39 @@
+import socket
+import time
+
+from client_api import FileClient
+from protocol import FramedSocket, HELLO, RESPONSE, NO_REQUEST, decode_message
+
+
+def open_connection(port, username=None):
+    #a raw framed connection, logged in when a username is given
+    connection = FramedSocket(socket.create_connection(("127.0.0.1", port)))
+    connection.settimeout(10)
+    if username:
+        connection.send_frame(HELLO, NO_REQUEST, username.encode())
+        frame_type, _, payload = connection.recv_frame()
+        assert frame_type == RESPONSE and decode_message(payload)["message"] == "CONNECTED"
+    return connection
+
+
+def read_reply(connection):
+    #skips notifications and catalog events, returns the next frame of a request
+    while True:
+        frame_type, request_id, payload = connection.recv_frame()
+        if request_id != NO_REQUEST:
+            return frame_type, request_id, payload
+
+
+def make_client(server, username, events=None, streams=1, **options):
+    #a connected client library instance, events collects the messages it reports
+    client = FileClient(streams, on_event=lambda kind, message: events.append(message) if events is not None else None,
+                        **options)
+    client.connect("127.0.0.1", server.port, username)
+    return client
+
+
+def wait_until(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "condition not reached in time"
+        time.sleep(0.05)
@@ -0,0 +1,89 @@
+import asyncio
+import os
+import time
+
+import pytest
+
+from bandwidth import Shaper, TokenBucket
+from helpers import make_client
+
+
+def test_bucket_allows_a_burst_then_goes_into_debt():
+    bucket = TokenBucket(1000)
+    assert bucket.take(1000) == 0
+    assert bucket.take(500) == pytest.approx(0.5, abs=0.05)
+    #a request larger than the burst still goes through, the wait grows with the debt
+    assert bucket.take(2000) == pytest.approx(2.5, abs=0.05)
+
+
+def test_unlimited_shaper_does_not_wait():
+    shaper = Shaper()
+    assert not shaper
+
+    async def run():
+        start = time.monotonic()
+        for _ in range(100):
+            await shaper.wait("alice", 10 ** 9)
+        return time.monotonic() - start
+    assert asyncio.run(run()) < 0.1
+
+
+def test_client_rate_is_per_client():
+    shaper = Shaper(client_rate=1000 * 1000)
+
+    async def run():
+        start = time.monotonic()
+        await shaper.wait("alice", 1000 * 1000)
+        await shaper.wait("bob", 1000 * 1000)
+        burst = time.monotonic() - start
+        await shaper.wait("alice", 200 * 1000)
+        return burst, time.monotonic() - start
+    burst, total = asyncio.run(run())
+    assert burst < 0.1 and total >= 0.15
+
+
+def test_global_budget_is_shared_round_robin():
+    shaper = Shaper(global_rate=10 ** 9)
+    order = []
+
+    async def transfer(client, piece):
+        await shaper.wait(client, 1000)
+        order.append((client, piece))
+
+    async def run():
+        #alice has three slices queued before bob asks for one, bob gets the second turn
+        await asyncio.gather(*[transfer("alice", piece) for piece in range(3)], transfer("bob", 0))
+    asyncio.run(run())
+    assert order == [("alice", 0), ("bob", 0), ("alice", 1), ("alice", 2)]
+
+
+def test_cancelled_waiter_does_not_use_the_budget():
+    shaper = Shaper(global_rate=1000)
+
+    async def run():
+        await shaper.wait("alice", 1000)
+        #alice's next slice is paid for while bob waits in line behind it and gives up
+        paying = asyncio.ensure_future(shaper.wait("alice", 200))
+        cancelled = asyncio.ensure_future(shaper.wait("bob", 100 * 1000))
+        await asyncio.sleep(0.05)
+        cancelled.cancel()
+        await asyncio.wait_for(asyncio.gather(paying, shaper.wait("carol", 10)), 1)
+        return shaper.bucket.tokens
+    assert asyncio.run(run()) > -100
+
+
+def test_download_is_limited_per_client(start_server, tmp_path):
+    server = start_server(client_rate_limit=1024 * 1024)
+    source = tmp_path / "upload" / "data.bin"
+    source.parent.mkdir()
+    content = os.urandom(1536 * 1024)
+    source.write_bytes(content)
+    with make_client(server, "alice", compression=None) as client:
+        client.upload_file(str(source))
+        #downloads have a bucket of their own, only the part over the one second burst waits
+        start = time.monotonic()
+        saved = client.download_file("data.bin", "alice", str(tmp_path))
+        elapsed = time.monotonic() - start
+    assert elapsed >= 0.4
+    with open(saved, "rb") as f:
+        assert f.read() == content
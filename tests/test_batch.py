@@ -0,0 +1,65 @@
+import os
+import tarfile
+
+import client_api
+from helpers import make_client
+
+
+CONTENTS = {
+    "a.txt": b"first",
+    "empty.txt": b"",
+    "b, with commas.txt": os.urandom(70 * 1024),
+    "ünïcode.log": b"last",
+}
+
+
+def write_sources(directory, contents):
+    directory.mkdir()
+    paths = []
+    for filename, data in contents.items():
+        (directory / filename).write_bytes(data)
+        paths.append(str(directory / filename))
+    return paths
+
+
+def test_batch_upload_and_download(start_server, tmp_path):
+    server = start_server()
+    paths = write_sources(tmp_path / "upload", CONTENTS)
+    downloads = tmp_path / "downloads"
+    downloads.mkdir()
+    with make_client(server, "alice") as client:
+        assert client.upload_batch(paths) == list(CONTENTS)
+        assert sorted(record.filename for record in server.catalog.files_of("alice")) == sorted(CONTENTS)
+        saved = client.download_batch([("alice", filename) for filename in CONTENTS], str(downloads))
+    assert saved == [str(downloads / filename) for filename in CONTENTS]
+    for filename, data in CONTENTS.items():
+        assert (downloads / filename).read_bytes() == data
+    assert sorted(os.listdir(downloads)) == sorted(CONTENTS)
+
+
+def test_archive_of_every_owner_or_a_pattern(start_server, tmp_path):
+    server = start_server()
+    paths = write_sources(tmp_path / "upload", CONTENTS)
+    with make_client(server, "alice") as alice, make_client(server, "bob") as bob:
+        alice.upload_batch(paths)
+        bob.upload_batch(paths[:1])
+        everything = alice.download_archive(str(tmp_path / "all.tar"))
+        text = alice.download_archive(str(tmp_path / "text.tar"), owner="alice", pattern="*.txt")
+
+    with tarfile.open(everything) as archive:
+        names = archive.getnames()
+        assert sorted(names) == sorted([f"alice/{filename}" for filename in CONTENTS] + ["bob/a.txt"])
+        for filename, data in CONTENTS.items():
+            assert archive.extractfile(f"alice/{filename}").read() == data
+        assert archive.getmember("bob/a.txt").uname == "bob"
+    with tarfile.open(text) as archive:
+        assert sorted(archive.getnames()) == ["alice/a.txt", "alice/b, with commas.txt", "alice/empty.txt"]
+
+
+def test_batches_are_split_by_count_and_bytes(monkeypatch):
+    monkeypatch.setattr(client_api, "BATCH_MAX_FILES", 3)
+    monkeypatch.setattr(client_api, "BATCH_MAX_BYTES", 100)
+    client = client_api.FileClient()
+    sizes = [10, 10, 10, 10, 60, 50, 100]
+    groups = list(client.batch_groups(list(range(len(sizes))), lambda index: sizes[index]))
+    assert groups == [[0, 1, 2], [3, 4], [5], [6]]
@@ -0,0 +1,87 @@
+import hashlib
+import os
+
+from blob_store import BlobStore
+from catalog import FileRecord
+from helpers import make_client, wait_until
+
+
+def stored_blobs(directory):
+    return sorted(name for _, _, names in os.walk(os.path.join(directory, BlobStore.DIRECTORY_NAME)) for name in names)
+
+
+def upload_source(path, data):
+    path.write_bytes(data)
+    return str(path), hashlib.sha256(data).hexdigest()
+
+
+def test_store_keeps_one_copy_per_content(tmp_path):
+    blobs = BlobStore(str(tmp_path))
+    first, digest = upload_source(tmp_path / "first", b"same")
+    second, _ = upload_source(tmp_path / "second", b"same")
+    assert blobs.store(first, digest)
+    assert not blobs.store(second, digest)
+    assert not os.path.exists(first) and not os.path.exists(second)
+    assert stored_blobs(str(tmp_path)) == [digest]
+
+    #pinned until both records are in, then counted once per record
+    blobs.add_ref(digest, 4)
+    blobs.add_ref(digest, 4)
+    assert blobs.unpin([digest, digest]) == []
+    assert not blobs.release(digest)
+    assert blobs.release(digest)
+    assert digest not in blobs and blobs.size(digest) is None
+    blobs.remove_unused([digest])
+    assert stored_blobs(str(tmp_path)) == []
+
+
+def test_pinned_and_referenced_blobs_are_not_removed(tmp_path):
+    blobs = BlobStore(str(tmp_path))
+    source, digest = upload_source(tmp_path / "source", b"data")
+    blobs.store(source, digest)
+    #a removal racing with the upload that stored the blob again
+    blobs.remove_unused([digest])
+    assert stored_blobs(str(tmp_path)) == [digest]
+    #the upload failed before its record was added
+    assert blobs.unpin([digest]) == [digest]
+    blobs.remove_unused([digest])
+    assert stored_blobs(str(tmp_path)) == []
+
+
+def test_garbage_collection_after_a_crash(tmp_path):
+    blobs = BlobStore(str(tmp_path))
+    kept, kept_digest = upload_source(tmp_path / "kept", b"kept")
+    lost, lost_digest = upload_source(tmp_path / "lost", b"lost")
+    blobs.store(kept, kept_digest)
+    blobs.store(lost, lost_digest)
+    #only the first record made it into the catalog before the restart
+    restarted = BlobStore(str(tmp_path))
+    restarted.rebuild([FileRecord("kept.txt", "alice", 4, 1.0, kept_digest), FileRecord("old.txt", "bob")])
+    assert restarted.collect_garbage() == 1
+    assert stored_blobs(str(tmp_path)) == [kept_digest]
+    assert len(restarted) == 1 and restarted.size(kept_digest) == 4
+
+
+def test_shared_content_lives_until_its_last_record_is_gone(start_server, tmp_path):
+    server = start_server()
+    upload = tmp_path / "upload"
+    upload.mkdir()
+    content = os.urandom(64 * 1024)
+    source, digest = upload_source(upload / "shared.bin", content)
+    events = []
+    with make_client(server, "alice") as alice, make_client(server, "bob", events) as bob:
+        alice.upload_file(source)
+        received = server.collect_stats()['bytes_received']
+        bob.upload_file(source)
+        #bob only offered the digest
+        assert "'shared.bin' was already stored on the server, no data had to be sent." in events
+        assert server.collect_stats()['bytes_received'] - received < 1024
+        assert stored_blobs(server.file_directory) == [digest]
+
+        #overwriting drops the reference to the old content
+        (upload / "shared.bin").write_bytes(b"changed")
+        alice.upload_file(source)
+        assert len(stored_blobs(server.file_directory)) == 2
+        bob.delete_file("shared.bin")
+        wait_until(lambda: digest not in stored_blobs(server.file_directory))
+        assert server.blobs.refs == {hashlib.sha256(b"changed").hexdigest(): 1}
@@ -0,0 +1,164 @@
+import os
+import threading
+import time
+
+import pytest
+
+from catalog import Catalog, CatalogJournal, ChangeLog, FileRecord, format_file_list_line, parse_file_list_line, select_page, SORT_KEYS
+
+
+def snapshot(catalog):
+    return [(r.owner, r.filename, r.size, r.mtime, r.digest) for r in catalog]
+
+
+def reload(directory):
+    catalog = Catalog()
+    journal = CatalogJournal(directory, log=lambda message: None)
+    malformed = journal.load(catalog)
+    return catalog, malformed
+
+
+def open_journal(directory):
+    journal = CatalogJournal(directory, log=lambda message: None)
+    journal.load(Catalog())
+    journal.open()
+    return journal
+
+
+def test_journal_replays_adds_and_deletes(tmp_path):
+    journal = open_journal(str(tmp_path))
+    journal.append_add(FileRecord("a.txt", "alice", 3, 1.5, "a" * 64))
+    journal.append_add(FileRecord("b, with commas.txt", "bob", 4, 2.5, "b" * 64))
+    journal.append_add(FileRecord("a.txt", "alice", 5, 3.5, "c" * 64))
+    journal.wait_synced(journal.append_delete("bob", "b, with commas.txt"))
+    journal.close()
+    catalog, malformed = reload(str(tmp_path))
+    assert malformed == 0
+    assert snapshot(catalog) == [("alice", "a.txt", 5, 3.5, "c" * 64)]
+
+
+def test_journal_records_cannot_be_injected_through_a_filename(tmp_path):
+    journal = open_journal(str(tmp_path))
+    journal.append_add(FileRecord("secret.txt", "bob", 1, 1.0, "a" * 64))
+    journal.append_add(FileRecord("x\nDEL secret.txt,bob\nADD y,alice", "alice", 1, 1.0, "b" * 64))
+    journal.close()
+    catalog, malformed = reload(str(tmp_path))
+    assert malformed == 0
+    assert sorted(record.filename for record in catalog) == ["secret.txt", "x\nDEL secret.txt,bob\nADD y,alice"]
+
+
+def test_journal_reads_plain_lines_and_skips_a_torn_one(tmp_path):
+    with open(tmp_path / CatalogJournal.JOURNAL_NAME, "w") as f:
+        f.write("ADD a.txt,alice,3,1.5,\nADD b.txt,bob,,,\nDEL a.txt,alice\n")
+        f.write('{"op":"add","filename":"c.txt","owner":"carol","size":1,"mtime":2.0,"digest":null}\n')
+        f.write('{"op":"add","filename":"d.t')
+    catalog, malformed = reload(str(tmp_path))
+    assert malformed == 1
+    assert snapshot(catalog) == [("bob", "b.txt", None, None, None), ("carol", "c.txt", 1, 2.0, None)]
+
+
+def test_compaction_folds_the_journal_into_a_snapshot(tmp_path):
+    directory = str(tmp_path)
+    journal = open_journal(directory)
+    journal.COMPACT_MIN_RECORDS = 10
+    catalog = Catalog()
+    for index in range(50):
+        record = FileRecord(f"{index % 20}.txt", "alice", index, float(index), None)
+        catalog.add(record)
+        journal.append_add(record)
+    assert journal.needs_compaction(len(catalog))
+    journal.start_compaction(lambda: list(catalog))
+    #changes made while the snapshot is written land in the new journal
+    record = FileRecord("late.txt", "bob", 1, 1.0, None)
+    catalog.add(record)
+    journal.append_add(record)
+    deadline = time.monotonic() + 10
+    while journal.compacting:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    journal.close()
+    assert not os.path.exists(journal.compacting_path) and not os.path.exists(journal.rotated_path)
+    assert not journal.needs_compaction(len(catalog))
+    reloaded, malformed = reload(directory)
+    assert malformed == 0
+    assert snapshot(reloaded) == snapshot(catalog)
+
+
+def test_compaction_leaves_the_file_work_to_the_journal_threads(tmp_path, monkeypatch):
+    #start_compaction runs with the catalog lock held, which the event loop also takes
+    journal = open_journal(str(tmp_path))
+    journal.append_add(FileRecord("a.txt", "alice", 1, 1.0, None))
+    callers = []
+    replace = os.replace
+    monkeypatch.setattr(os, "replace", lambda *paths: (callers.append(threading.current_thread()), replace(*paths))[1])
+    journal.start_compaction(lambda: [FileRecord("a.txt", "alice", 1, 1.0, None)])
+    deadline = time.monotonic() + 10
+    while journal.compacting:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    journal.close()
+    assert callers and threading.current_thread() not in callers
+    assert snapshot(reload(str(tmp_path))[0]) == [("alice", "a.txt", 1, 1.0, None)]
+
+
+def test_file_list_lines_old_and_new():
+    digest = "ab" * 32
+    record = parse_file_list_line(format_file_list_line(FileRecord("a, b, c, d, e.txt", "alice", 7, 1.5, digest)).strip())
+    assert (record.filename, record.owner, record.size, record.mtime, record.digest) == ("a, b, c, d, e.txt", "alice", 7, 1.5, digest)
+    #old two-field lines, also with four or more commas in the filename
+    for filename in ("plain.txt", "a,b.txt", "one,2,3.5,four,five.txt", "x,1,2,,"):
+        record = parse_file_list_line(f"{filename},bob")
+        assert (record.filename, record.owner, record.size, record.digest) == (filename, "bob", None, None)
+    with pytest.raises(ValueError):
+        parse_file_list_line("no owner,")
+
+
+def test_change_log_resumes_only_from_retained_versions(monkeypatch):
+    monkeypatch.setattr(ChangeLog, "MAX_EVENTS", 3)
+    changes = ChangeLog()
+    assert changes.since(0) == []
+    for index in range(5):
+        changes.append("ADD", FileRecord(f"{index}.txt", "alice"))
+    assert [event['version'] for event in changes.since(2)] == [3, 4, 5]
+    assert changes.since(5) == []
+    #versions 1 and 2 are gone, and a version from the future belongs to another epoch
+    assert changes.since(1) is None
+    assert changes.since(6) is None
+
+
+def page_records():
+    #d.txt is an old entry without size and mtime
+    return [FileRecord(f"{name}.txt", owner, size, size and float(size))
+            for name, owner, size in [("b", "alice", 30), ("a", "bob", 10), ("c", "alice", 20), ("a", "alice", 10), ("d", "bob", None)]]
+
+
+@pytest.mark.parametrize("sort", [None, "name", "owner", "size", "mtime"])
+def test_pages_cover_every_record_once(sort):
+    records = page_records()
+    pages, cursor = [], None
+    while True:
+        page, cursor, total = select_page(records, sort=sort, cursor=cursor, limit=2)
+        assert total == len(records) and len(page) <= 2
+        pages.extend(page)
+        if cursor is None:
+            break
+    assert sorted(pages, key=id) == sorted(records, key=id)
+    assert pages == (records if sort is None else sorted(records, key=SORT_KEYS[sort]))
+
+
+def test_page_cursor_survives_changes_between_pages():
+    records = page_records()
+    page, cursor, _ = select_page(records, sort="name", limit=2)
+    assert [(r.filename, r.owner) for r in page] == [("a.txt", "alice"), ("a.txt", "bob")]
+    #a file added before the cursor and one removed after it
+    records.append(FileRecord("0.txt", "carol"))
+    records = [r for r in records if r.filename != "c.txt"]
+    page, cursor, _ = select_page(records, sort="name", cursor=cursor, limit=10)
+    assert [r.filename for r in page] == ["b.txt", "d.txt"] and cursor is None
+
+
+def test_page_pattern_is_a_glob_or_a_prefix():
+    records = page_records()
+    assert [r.filename for r in select_page(records, pattern="a")[0]] == ["a.txt", "a.txt"]
+    page, _, total = select_page(records, pattern="[bc]*", sort="size")
+    assert [r.filename for r in page] == ["c.txt", "b.txt"] and total == 2
@@ -0,0 +1,63 @@
+import os
+
+import pytest
+
+import client_cli
+from helpers import wait_until
+
+
+def make_tree(root):
+    (root / "data" / "nested").mkdir(parents=True)
+    (root / "data" / "a.csv").write_bytes(b"a" * 10)
+    (root / "data" / "b.csv").write_bytes(b"b" * 30)
+    (root / "data" / "nested" / "notes.txt").write_bytes(b"notes")
+    return root / "data"
+
+
+def test_local_files_expand_patterns_and_directories(tmp_path):
+    data = make_tree(tmp_path)
+    assert client_cli.local_files([str(data / "*.csv")], False) == [str(data / "a.csv"), str(data / "b.csv")]
+    assert client_cli.local_files([str(data), str(data / "a.csv")], True) == [
+        str(data / "a.csv"), str(data / "b.csv"), str(data / "nested" / "notes.txt")]
+
+    (tmp_path / "a.csv").write_bytes(b"other")
+    for paths, recursive, message in [([str(data)], False, "use -r"), ([str(data / "*.xls")], False, "No local files match"),
+                                      ([str(data / "missing.csv")], False, "does not exist"),
+                                      ([str(data / "a.csv"), str(tmp_path / "a.csv")], False, "would both be uploaded")]:
+        with pytest.raises(ValueError, match=message):
+            client_cli.local_files(paths, recursive)
+
+
+def test_put_ls_get_rm(start_server, tmp_path, capsys):
+    server = start_server()
+    data = make_tree(tmp_path)
+
+    def run(*argv):
+        code = client_cli.main(["--port", str(server.port), "--user", "alice", *argv])
+        wait_until(lambda: server.get_client_socket("alice") is None)
+        out, err = capsys.readouterr()
+        return code, out.splitlines(), err
+
+    code, lines, _ = run("put", "-r", str(data))
+    assert code == 0 and sorted(lines) == ["a.csv", "b.csv", "notes.txt"]
+
+    code, lines, _ = run("ls", "--sort", "size", "-l", "*.csv")
+    assert code == 0 and [line.split() for line in lines] == [["10", "alice", "a.csv"], ["30", "alice", "b.csv"]]
+    code, lines, _ = run("ls", "note")
+    assert lines == ["notes.txt\talice"]
+
+    downloads = tmp_path / "downloads"
+    code, lines, _ = run("get", "*.csv", "notes.txt", "-o", str(downloads))
+    assert code == 0 and len(lines) == 3
+    assert sorted(os.listdir(downloads)) == ["a.csv", "b.csv", "notes.txt"]
+    assert (downloads / "b.csv").read_bytes() == b"b" * 30
+
+    code, lines, _ = run("rm", "*.csv")
+    assert code == 0 and sorted(lines) == ["a.csv", "b.csv"]
+    assert [record.filename for record in server.catalog.files_of("alice")] == ["notes.txt"]
+
+    #nothing left to match, and a file that is not there
+    code, _, err = run("get", "*.csv", "-o", str(downloads))
+    assert code == 1 and "No files of 'alice' match '*.csv'." in err
+    code, _, err = run("rm", "missing.txt")
+    assert code == 1 and err.startswith("Error:")
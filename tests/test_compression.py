@@ -0,0 +1,83 @@
+import lzma
+import os
+import zlib
+
+import pytest
+
+from compression import CODECS, COMPRESS_BLOCK_SIZE, MAX_COMPRESSED_FRAME, compress_block, frame_slices, is_compressible
+from protocol import REQUEST, RESPONSE, ERROR, DATA, END, decode_message
+from helpers import open_connection, read_reply, make_client
+
+
+def compressible_bytes(size):
+    words = b"the quick brown fox jumps over the lazy dog "
+    return (words * (size // len(words) + 1))[:size]
+
+
+def test_only_compressible_files_are_compressed(tmp_path):
+    text = tmp_path / "text.txt"
+    text.write_bytes(compressible_bytes(256 * 1024))
+    noise = tmp_path / "noise.bin"
+    noise.write_bytes(os.urandom(256 * 1024))
+    assert is_compressible(str(text))
+    assert not is_compressible(str(noise))
+
+
+def test_frame_slices_stay_within_a_block():
+    compressor = CODECS["lzma"][0]()
+    output, _ = compress_block(compressor, os.urandom(3 * COMPRESS_BLOCK_SIZE), True)
+    slices = frame_slices(output)
+    assert all(len(piece) <= COMPRESS_BLOCK_SIZE for piece in slices)
+    assert b"".join(slices) == output
+    assert frame_slices(b"") == []
+
+
+@pytest.mark.parametrize("codec", sorted(CODECS))
+def test_compressed_round_trip(start_server, tmp_path, codec):
+    server = start_server()
+    source = tmp_path / "upload" / "text.txt"
+    source.parent.mkdir()
+    content = compressible_bytes(3 * COMPRESS_BLOCK_SIZE + 12345)
+    source.write_bytes(content)
+    events = []
+    with make_client(server, "alice", events, compression=codec) as client:
+        client.upload_file(str(source))
+        saved = client.download_file("text.txt", "alice", str(tmp_path))
+    with open(saved, "rb") as f:
+        assert f.read() == content
+    assert any(f"compressed with {codec}" in message for message in events)
+    totals = server.compression_totals
+    assert totals['raw'] == 2 * len(content) and totals['wire'] < totals['raw'] // 10
+
+
+def test_oversized_compressed_frame_is_rejected(start_server):
+    server = start_server()
+    connection = open_connection(server.port, "alice")
+    try:
+        connection.send_message(REQUEST, 1, command="UPLOAD", filename="big.txt", size=10 ** 9, codec="zlib")
+        connection.send_frame(DATA, 1, bytes(MAX_COMPRESSED_FRAME + 1))
+        frame_type, _, payload = read_reply(connection)
+        assert frame_type == ERROR and "too large" in decode_message(payload)["message"]
+        #the rest of the frame was skipped, the connection still works
+        connection.send_message(REQUEST, 2, command="STATS")
+        assert read_reply(connection)[:2] == (RESPONSE, 2)
+    finally:
+        connection.close()
+
+
+@pytest.mark.parametrize("codec", sorted(CODECS))
+def test_small_frame_that_expands_a_lot(start_server, codec):
+    #one frame holding far more output than a decompression piece
+    server = start_server()
+    size = 20 * 1024 * 1024
+    compress = zlib.compress if codec == "zlib" else lzma.compress
+    connection = open_connection(server.port, "alice")
+    try:
+        connection.send_message(REQUEST, 1, command="UPLOAD", filename="zeros.bin", size=size, codec=codec)
+        connection.send_frame(DATA, 1, compress(bytes(size)))
+        connection.send_frame(END, 1)
+        frame_type, _, payload = read_reply(connection)
+        assert frame_type == RESPONSE, decode_message(payload)
+        assert server.catalog.get("alice", "zeros.bin").size == size
+    finally:
+        connection.close()
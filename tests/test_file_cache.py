@@ -0,0 +1,48 @@
+from file_cache import FileCache
+from helpers import make_client
+
+
+def test_least_recently_used_entries_go_first():
+    cache = FileCache(10, 8)
+    assert cache.accepts(8) and not cache.accepts(9)
+    cache.put("a", None, b"aaaa")
+    cache.put("b", None, b"bbbb")
+    assert cache.get("a") == b"aaaa"
+    cache.put("c", None, b"cccc")
+    assert cache.get("b") is None and cache.get("a") == b"aaaa" and cache.get("c") == b"cccc"
+    stats = cache.stats()
+    assert (stats['entries'], stats['bytes'], stats['evictions'], stats['hits'], stats['misses']) == (2, 8, 1, 3, 1)
+
+
+def test_invalidate_drops_every_codec_of_a_digest():
+    cache = FileCache(100, 100)
+    cache.put("a", None, b"raw content")
+    cache.put("a", "zlib", b"packed")
+    cache.put("b", None, b"other")
+    cache.invalidate("a")
+    assert cache.get("a") is None and cache.get("a", "zlib") is None and cache.get("b") == b"other"
+    assert cache.stats()['bytes'] == 5 and cache.stats()['invalidations'] == 2
+    cache.invalidate("a")
+    assert cache.stats()['invalidations'] == 2
+
+
+def test_overwritten_file_is_not_served_from_the_cache(start_server, tmp_path):
+    server = start_server(cache_bytes=1024 * 1024)
+    source = tmp_path / "upload" / "hot.txt"
+    source.parent.mkdir()
+    source.write_bytes(b"old content " * 100)
+    with make_client(server, "alice", compression=None) as client:
+        client.upload_file(str(source))
+        first = server.catalog.get("alice", "hot.txt").digest
+        for _ in range(2):
+            saved = client.download_file("hot.txt", "alice", str(tmp_path))
+        assert server.file_cache.stats()['hits'] == 1
+        assert first in server.file_cache.codecs
+
+        source.write_bytes(b"new content " * 100)
+        client.upload_file(str(source))
+        assert first not in server.file_cache.codecs
+        saved = client.download_file("hot.txt", "alice", str(tmp_path))
+    with open(saved, "rb") as f:
+        assert f.read() == b"new content " * 100
+    assert server.file_cache.stats()['invalidations'] == 1
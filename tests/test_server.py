@@ -0,0 +1,384 @@
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+
+import pytest
+
+import server as server_module
+from catalog import FileRecord
+from client_api import ServerError, PARTIAL_SUFFIX, save_path_in
+from protocol import (
+    FramedSocket, HELLO, REQUEST, RESPONSE, ERROR, DATA, END, NO_REQUEST, ProtocolError, READ_BUFFER_MIN,
+    pack_header, unpack_header, encode_message, decode_message,
+)
+from helpers import open_connection, read_reply, make_client, wait_until
+
+
+def test_header_round_trip():
+    assert unpack_header(pack_header(DATA, 7, 1 << 40)) == (DATA, 7, 1 << 40)
+    with pytest.raises(ProtocolError):
+        unpack_header(pack_header(REQUEST, 1, 64 * 1024 * 1024))
+
+
+def test_message_round_trip():
+    fields = {'command': "UPLOAD", 'filename': "ünïcode.txt", 'size': 3}
+    assert decode_message(encode_message(fields)) == fields
+    with pytest.raises(ProtocolError):
+        decode_message(b"[1, 2]")
+
+
+def test_frames_over_a_socket():
+    left, right = socket.socketpair()
+    sender, receiver = FramedSocket(left), FramedSocket(right)
+    try:
+        payload = os.urandom(200 * 1024)  #big enough to be sent apart from its header
+        sender.send_frame(DATA, 3, payload)
+        sender.send_message(RESPONSE, 3, message="ok")
+        sender.send_frame(END, 3)
+        assert receiver.recv_frame() == (DATA, 3, payload)
+        assert receiver.recv_frame() == (RESPONSE, 3, b'{"message":"ok"}')
+        assert receiver.recv_frame() == (END, 3, b"")
+        sender.close()
+        assert receiver.recv_frame() is None
+    finally:
+        receiver.close()
+
+
+def test_hello_and_stats(start_server):
+    server = start_server()
+    connection = open_connection(server.port, "alice")
+    try:
+        connection.send_message(REQUEST, 1, command="STATS")
+        frame_type, request_id, payload = read_reply(connection)
+        assert (frame_type, request_id) == (RESPONSE, 1)
+        assert decode_message(payload)["stats"]["clients"] == 1
+    finally:
+        connection.close()
+
+
+def test_control_payloads_of_every_size(start_server):
+    #small, grown and bypassed staging buffer, all sent before any reply is read
+    server = start_server()
+    connection = open_connection(server.port, "alice")
+    try:
+        sizes = [100, 20 * 1024, 300 * 1024, 70 * 1024, 5]
+        for request_id, size in enumerate(sizes, 1):
+            connection.send_message(REQUEST, request_id, command="STAT", filename="x" * size, owner="alice")
+        replies = [read_reply(connection) for _ in sizes]
+        assert [(frame_type, request_id) for frame_type, request_id, _ in replies] == [(ERROR, i) for i in range(1, 6)]
+        #the staging buffer is small again once the large payloads are read
+        assert all(len(stream.protocol.buffer) == READ_BUFFER_MIN for stream in server.connections)
+    finally:
+        connection.close()
+
+
+def test_upload_and_download(start_server, tmp_path):
+    server = start_server()
+    source = tmp_path / "upload" / "data.bin"
+    source.parent.mkdir()
+    content = os.urandom(300 * 1024)
+    source.write_bytes(content)
+    with make_client(server, "alice") as client:
+        assert client.upload_file(str(source)) == "data.bin"
+        assert [entry['filename'] for entry in client.list_files(owner="alice")] == ["data.bin"]
+        saved = client.download_file("data.bin", "alice", str(tmp_path))
+    with open(saved, "rb") as f:
+        assert f.read() == content
+
+
+def test_list_pages_sorted_and_filtered(start_server, tmp_path):
+    server = start_server()
+    upload = tmp_path / "upload"
+    upload.mkdir()
+    with make_client(server, "alice") as alice, make_client(server, "bob") as bob:
+        for client, name, size in [(alice, "c.txt", 1), (alice, "a.txt", 3), (bob, "b.txt", 2), (alice, "b.log", 4)]:
+            (upload / name).write_bytes(b"x" * size)
+            client.upload_file(str(upload / name))
+        entries, cursor, total = alice.list_page(sort="size", page_size=2)
+        assert [entry['filename'] for entry in entries] == ["c.txt", "b.txt"] and total == 4
+        entries, cursor, _ = alice.list_page(sort="size", page_size=2, cursor=cursor)
+        assert [entry['size'] for entry in entries] == [3, 4] and cursor is None
+        assert [entry['filename'] for entry in alice.list_files(owner="alice", pattern="*.txt", sort="name")] == ["a.txt", "c.txt"]
+        assert [entry['filename'] for entry in alice.list_files(pattern="b")] == ["b.txt", "b.log"]
+        with pytest.raises(ServerError):
+            alice.list_page(page_size=server.max_list_page_size + 1)
+        with pytest.raises(ServerError):
+            alice.list_page(sort="color")
+        with pytest.raises(ServerError):
+            alice.list_page(sort="name", cursor="not json")
+
+
+def test_subscription_resyncs_after_a_reconnect(start_server, tmp_path):
+    server = start_server()
+    upload = tmp_path / "upload"
+    upload.mkdir()
+    for name in ("x.txt", "y.txt"):
+        (upload / name).write_bytes(name.encode())
+
+    def mirrored(client):
+        files = client.mirror_files()
+        return None if files is None else sorted(entry['filename'] for entry in files)
+
+    with make_client(server, "alice") as alice, make_client(server, "bob") as bob:
+        wait_until(lambda: mirrored(alice) == [])
+        bob.upload_file(str(upload / "x.txt"))
+        wait_until(lambda: mirrored(alice) == ["x.txt"])
+
+        modes = []
+        handle_frame = alice.handle_subscription_frame
+
+        def record_mode(request_id, subscription, frame_type, payload):
+            if frame_type == RESPONSE:
+                modes.append(decode_message(payload)["mode"])
+            handle_frame(request_id, subscription, frame_type, payload)
+        alice.handle_subscription_frame = record_mode
+
+        #changes made while alice is away arrive as events on top of her mirror
+        alice.disconnect()
+        bob.upload_file(str(upload / "y.txt"))
+        bob.delete_file("x.txt")
+        wait_until(lambda: server.get_client_socket("alice") is None)
+        alice.connect("127.0.0.1", server.port, "alice")
+        wait_until(lambda: mirrored(alice) == ["y.txt"])
+        assert modes == ["incremental"]
+
+        #reloading the catalog starts a new epoch, the old version means nothing there
+        alice.disconnect()
+        wait_until(lambda: server.get_client_socket("alice") is None)
+        server.load_file_list()
+        alice.connect("127.0.0.1", server.port, "alice")
+        wait_until(lambda: mirrored(alice) == ["y.txt"])
+        assert modes == ["incremental", "snapshot"]
+
+
+def test_download_of_a_missing_file_fails(start_server, tmp_path):
+    server = start_server()
+    with make_client(server, "alice") as client:
+        with pytest.raises(ServerError):
+            client.download_file("missing.bin", "alice", str(tmp_path))
+
+
+def test_interrupted_upload_resumes(start_server, tmp_path):
+    server = start_server()
+    source = tmp_path / "upload" / "big.bin"
+    source.parent.mkdir()
+    content = os.urandom(1024 * 1024)
+    source.write_bytes(content)
+    stat = os.stat(source)
+    validator = f"{stat.st_size}-{stat.st_mtime_ns}"
+
+    #the first attempt breaks off after part of the data
+    connection = open_connection(server.port, "alice")
+    connection.send_message(REQUEST, 1, command="UPLOAD", filename="big.bin", size=len(content), validator=validator)
+    connection.send_frame(DATA, 1, content[:400 * 1024])
+    wait_until(lambda: server.collect_stats()['bytes_received'] >= 400 * 1024)
+    connection.close()
+    wait_until(lambda: server.get_client_socket("alice") is None)
+
+    events = []
+    with make_client(server, "alice", events) as client:
+        wait_until(lambda: client.call("UPLOAD_STATUS", filename="big.bin", size=len(content),
+                                       validator=validator)["offset"] > 0)
+        client.upload_file(str(source))
+        saved = client.download_file("big.bin", "alice", str(tmp_path))
+    assert any(message.startswith("Resuming upload of 'big.bin' at byte ") for message in events)
+    with open(saved, "rb") as f:
+        assert f.read() == content
+
+
+def test_interrupted_download_resumes(start_server, tmp_path):
+    server = start_server()
+    source = tmp_path / "data.bin"
+    content = os.urandom(500 * 1024)
+    source.write_bytes(content)
+    directory = tmp_path / "downloads"
+    directory.mkdir()
+    events = []
+    with make_client(server, "alice", events) as client:
+        client.upload_file(str(source))
+        etag = client.call("STAT", filename="data.bin", owner="alice")["etag"]
+        #what an earlier attempt left behind
+        part_path = directory / ("data.bin" + PARTIAL_SUFFIX)
+        part_path.write_bytes(content[:123457])
+        with open(str(part_path) + ".json", "w") as f:
+            json.dump({'owner': "alice", 'etag': etag}, f)
+        saved = client.download_file("data.bin", "alice", str(directory))
+    assert "Resuming download of 'data.bin' at byte 123457..." in events
+    with open(saved, "rb") as f:
+        assert f.read() == content
+    assert not part_path.exists()
+
+
+def test_connection_over_the_limit_is_busy(start_server):
+    server = start_server(max_connections=1)
+    #a connection that never sends anything still counts
+    idle = socket.create_connection(("127.0.0.1", server.port))
+    try:
+        wait_until(lambda: len(server.connections) == 1)
+        connection = open_connection(server.port)
+        connection.send_frame(HELLO, NO_REQUEST, b"alice")
+        frame_type, _, payload = connection.recv_frame()
+        reply = decode_message(payload)
+        assert frame_type == ERROR and reply["code"] == "BUSY" and reply["retry_after"] > 0
+        connection.close()
+    finally:
+        idle.close()
+
+
+def test_transfer_over_the_limit_is_busy(start_server):
+    server = start_server(max_transfers=1, max_queued_transfers=0)
+    uploader = open_connection(server.port, "alice")
+    other = open_connection(server.port, "bob")
+    try:
+        #the open upload holds the only slot until its END frame
+        uploader.send_message(REQUEST, 1, command="UPLOAD", filename="a.txt", size=3)
+        wait_until(lambda: server.transfer_slots.active == 1)
+        other.send_message(REQUEST, 1, command="UPLOAD", filename="b.txt", size=3)
+        frame_type, _, payload = read_reply(other)
+        assert frame_type == ERROR and decode_message(payload)["code"] == "BUSY"
+
+        uploader.send_frame(DATA, 1, b"abc")
+        uploader.send_frame(END, 1)
+        frame_type, _, _ = read_reply(uploader)
+        assert frame_type == RESPONSE
+        wait_until(lambda: server.transfer_slots.active == 0)
+    finally:
+        uploader.close()
+        other.close()
+
+
+def test_pipelined_uploads_on_one_connection(start_server):
+    server = start_server()
+    connection = open_connection(server.port, "alice")
+    try:
+        #all requests go out before any of their data, the replies come back per request id
+        for request_id in (1, 2, 3):
+            connection.send_message(REQUEST, request_id, command="UPLOAD", filename=f"{request_id}.txt", size=3)
+        for request_id in (3, 1, 2):
+            connection.send_frame(DATA, request_id, str(request_id).encode() * 3)
+            connection.send_frame(END, request_id)
+        replies = dict((request_id, frame_type) for frame_type, request_id, _ in (read_reply(connection) for _ in range(3)))
+        assert replies == {1: RESPONSE, 2: RESPONSE, 3: RESPONSE}
+        assert sorted(record.filename for record in server.catalog.files_of("alice")) == ["1.txt", "2.txt", "3.txt"]
+    finally:
+        connection.close()
+
+
+def test_pipelined_upload_without_a_free_slot_is_busy(start_server):
+    #the second upload must not wait for the slot held by the first, whose data comes after it
+    server = start_server(max_transfers=1)
+    connection = open_connection(server.port, "alice")
+    try:
+        connection.send_message(REQUEST, 1, command="UPLOAD", filename="a.txt", size=3)
+        connection.send_message(REQUEST, 2, command="UPLOAD", filename="b.txt", size=3)
+        for request_id in (1, 2):
+            connection.send_frame(DATA, request_id, b"abc")
+            connection.send_frame(END, request_id)
+        replies = {}
+        for _ in range(2):
+            frame_type, request_id, payload = read_reply(connection)
+            replies[request_id] = (frame_type, decode_message(payload))
+        assert replies[1][0] == RESPONSE
+        assert replies[2][0] == ERROR and replies[2][1]["code"] == "BUSY"
+        wait_until(lambda: server.transfer_slots.active == 0 and not server.transfer_slots.waiting)
+    finally:
+        connection.close()
+
+
+@pytest.mark.parametrize("filename", ["../escaped.txt", "/etc/passwd", "a\\b.txt", "..", "x\nDEL secret.txt,bob", "nul\0.txt"])
+def test_unsafe_filenames_are_rejected(start_server, filename):
+    server = start_server()
+    connection = open_connection(server.port, "alice")
+    try:
+        connection.send_message(REQUEST, 1, command="UPLOAD_BATCH", files=[{'filename': filename, 'size': 1}])
+        frame_type, _, payload = read_reply(connection)
+        assert frame_type == ERROR and "Invalid filename" in decode_message(payload)["message"]
+        connection.send_message(REQUEST, 2, command="UPLOAD", filename=filename, size=1)
+        frame_type, _, _ = read_reply(connection)
+        assert frame_type == ERROR
+        assert not server.catalog.files_of("alice")
+    finally:
+        connection.close()
+
+
+def test_unsafe_username_is_rejected(start_server):
+    server = start_server()
+    connection = open_connection(server.port)
+    try:
+        connection.send_frame(HELLO, NO_REQUEST, b"../alice")
+        frame_type, _, payload = connection.recv_frame()
+        assert frame_type == ERROR and decode_message(payload)["message"] == "Invalid username."
+    finally:
+        connection.close()
+
+
+def test_client_refuses_names_outside_the_directory(start_server, tmp_path):
+    server = start_server()
+    source = tmp_path / "upload" / "data.bin"
+    source.parent.mkdir()
+    source.write_bytes(b"data")
+    directory = tmp_path / "downloads"
+    directory.mkdir()
+    with make_client(server, "alice") as client:
+        client.upload_file(str(source))
+        #a record with an unsafe name, as an older server could have stored it
+        stored = server.catalog.get("alice", "data.bin")
+        with server.file_list_lock:
+            server.catalog.add(FileRecord("../escaped.txt", "alice", stored.size, stored.mtime, stored.digest))
+        with pytest.raises(ValueError):
+            client.download_batch([("alice", "data.bin"), ("alice", "../escaped.txt")], str(directory))
+        with pytest.raises(ValueError):
+            client.download_file("../escaped.txt", "alice", str(directory))
+    assert not (tmp_path / "escaped.txt").exists()
+    assert save_path_in("dl", "a.txt") == os.path.join("dl", "a.txt")
+
+
+def test_config_file_and_flags(tmp_path):
+    config = tmp_path / "server.ini"
+    config.write_text("[server]\nport = 5000\nidle_timeout = 2.5\nmetrics_host = 0.0.0.0\n")
+    assert server_module.load_config(str(config)) == {'port': 5000, 'idle_timeout': 2.5, 'metrics_host': "0.0.0.0"}
+    args = server_module.parse_arguments(["--headless", "--config", str(config), "--max-transfers", "3"])
+    assert args.headless and args.max_transfers == 3 and args.port is None
+
+    for text, message in [("[server]\ncolor = blue\n", "Unknown setting"), ("[other]\nport = 1\n", r"no \[server\] section"),
+                          ("[server]\nport = high\n", "invalid literal")]:
+        config.write_text(text)
+        with pytest.raises(ValueError, match=message):
+            server_module.load_config(str(config))
+    with pytest.raises(ValueError, match="could not be read"):
+        server_module.load_config(str(tmp_path / "missing.ini"))
+
+
+def test_headless_needs_port_and_directory(tmp_path, capsys):
+    assert server_module.main(["--headless", "--port", "0"]) == 2
+    assert "'directory' must be given" in capsys.readouterr().err
+
+
+def test_headless_server_runs_until_sigterm(tmp_path):
+    probe = socket.create_server(("127.0.0.1", 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    config = tmp_path / "server.ini"
+    config.write_text(f"[server]\nport = 1\ndirectory = {tmp_path / 'files'}\nlog_file = {tmp_path / 'log.txt'}\n"
+                      f"error_log_file = {tmp_path / 'errors.txt'}\n")
+    #the flag wins over the port in the config file
+    process = subprocess.Popen([sys.executable, server_module.__file__, "--headless", "--config", str(config), "--port", str(port)],
+                               cwd=str(tmp_path))
+    try:
+        def connected():
+            try:
+                open_connection(port, "alice").close()
+                return True
+            except OSError:
+                return False
+        wait_until(connected)
+        process.send_signal(signal.SIGTERM)
+        assert process.wait(10) == 0
+    finally:
+        if process.poll() is None:
+            process.kill()
+    assert (tmp_path / "files" / "file_list.txt").exists()
+    assert "File directory set to" in (tmp_path / "log.txt").read_text()